@@ -0,0 +1,113 @@
+# balance APU cycles across NMI groups so that frequency adjustments in one
+# group don't push the groups after it around.
+
+# for every cycle we add, we have to remove from somewhere else. hypothetically,
+# this will stop frequency adjustment in one area from affecting the next,
+# because the total number of APU clock cycles will be the same no matter the
+# adjustment. we keep a running surplus (how many cycles we have to give away)
+# and use the groups we are allowed to fiddle with (ones that don't really
+# access the APU) to cancel it out.
+
+# everything works on columns (one entry per group) instead of the group dicts
+# so that rebuilding a whole TAS takes milliseconds instead of seconds. the
+# result is exactly the same as walking the groups one at a time.
+
+from collections import namedtuple
+
+import numpy as np
+
+from tasha.gateware.apu_calc import calculate_advanced, \
+    calculate_advanced_array
+
+# surpluses smaller than this aren't worth bothering with
+MIN_SURPLUS = 10
+
+class BalanceError(Exception): pass
+
+# the parts of each group which balancing needs and which don't change between
+# runs, as one array per field
+GroupColumns = namedtuple("GroupColumns",
+    ["latch_start", "num_latches", "latch_clocks", "should_balance"])
+
+# pull the columns out of the rundata's groups array (see rundata.py). groups
+# that access the APU at least min_apu_accesses times aren't balanced unless
+# the group says otherwise, since fiddling with the frequency might desync them.
+# the columns are copies, so they can be adjusted without affecting the groups.
+def group_columns(groups, min_apu_accesses):
+    should_balance = np.where(groups["balance"] < 0,
+        groups["apu_accesses"] < min_apu_accesses, groups["balance"] > 0)
+    return GroupColumns(groups["latch_start"].copy(),
+        groups["num_latches"].copy(), groups["latch_clocks"].copy(),
+        should_balance)
+
+# round like the scalar code did (int(x+0.5)) for arrays of non-negative x
+def _round(x):
+    return np.trunc(x+0.5).astype(np.int64)
+
+# apu_freqs: the frequency (in MHz) each group is asking for
+# latch_clocks: how many master clock cycles each group lasts for
+# should_balance: whether each group's frequency may be changed to cancel out
+#   the surplus
+# min_freq, max_freq: range of frequencies (in MHz) balancing may choose
+# m_freq: nominal master clock frequency (in MHz)
+# a_freq: nominal APU clock frequency (in MHz)
+
+# returns (actual, basic, advanced, surplus): the frequency each group really
+# gets, the register words which produce it, and the number of cycles left over
+# at the end.
+def balance_cycles(apu_freqs, latch_clocks, should_balance,
+        min_freq, max_freq, m_freq, a_freq):
+    apu_freqs = np.asarray(apu_freqs, dtype=np.float64)
+    latch_clocks = np.asarray(latch_clocks, dtype=np.float64)
+    should_balance = np.asarray(should_balance, dtype=bool)
+    num_groups = len(apu_freqs)
+    if len(latch_clocks) != num_groups or len(should_balance) != num_groups:
+        raise BalanceError("group columns have different lengths")
+    if np.any(np.isnan(apu_freqs)):
+        raise BalanceError("group {} doesn't have a frequency".format(
+            int(np.argmax(np.isnan(apu_freqs)))))
+
+    # calculate the closest frequency we can actually generate
+    basic, advanced, actual = calculate_advanced_array(apu_freqs)
+
+    passed_time = latch_clocks/(m_freq*1e6)
+    # how many cycles did we give (with the clock generator) each group?
+    cycles_given = _round(passed_time*(actual*1e6))
+    # and how many were taken (by the nominal passage of time)?
+    cycles_taken = _round(passed_time*a_freq*1e6)
+    # how the surplus changes over a group we leave alone
+    deltas = cycles_given - cycles_taken
+
+    # the only groups where the surplus can change in a way that isn't known
+    # up front are the ones we're allowed to adjust. the surplus before each of
+    # them is the sum of the deltas of every group before it, plus however much
+    # our adjustments changed things. so we skip over everything else with one
+    # cumulative sum and only walk the adjustable groups one at a time.
+    surplus_before = np.cumsum(deltas) - deltas - cycles_taken
+    balance_groups = np.flatnonzero(should_balance)
+
+    offset = 0 # how far our adjustments have moved the surplus
+    for gi, s, given, t in zip(balance_groups.tolist(),
+            surplus_before[balance_groups].tolist(),
+            cycles_given[balance_groups].tolist(),
+            passed_time[balance_groups].tolist()):
+        s += offset
+        # can we adjust the frequency of this group to cancel out our surplus?
+        if abs(s + given) < MIN_SURPLUS:
+            continue # avoid bothering with minor issues
+        if t == 0:
+            continue # a group that takes no time can't help
+        # what frequency would that be?
+        desired = min(max((-s/t)/1e6, min_freq), max_freq)
+        # what can we actually generate?
+        new_basic, new_advanced, desired = calculate_advanced(desired)
+        new_given = int(t*desired*1e6+0.5)
+        # would this leave us closer to a 0 surplus?
+        if abs(s + given) > abs(s + new_given):
+            offset += new_given - given # then use it
+            basic[gi] = new_basic
+            advanced[gi] = new_advanced
+            actual[gi] = desired
+
+    surplus = int(np.sum(deltas)) + offset
+    return actual, basic, advanced, surplus
@@ -0,0 +1,214 @@
+# build rundata from a log recorded by a game's measure_emulator.lua
+
+# the log starts with a greeting line and a line with the emulated frequencies,
+# then has one line per record:
+#   l,f,v,h: a latch happened at frame f, scanline v, pixel h
+#   n,f,v,h,f,v,h,apu_reads,apu_writes,joy_reads,joy_writes,...: an NMI
+#       started waiting at the first f,v,h and ended at the second. games may
+#       add more fields to the end.
+
+# logs from long TASes can be gigabytes, so the log is read in chunks which are
+# each parsed by numpy in one go, and the groups are found with array
+# operations instead of walking the NMIs.
+
+import numpy as np
+
+from .rundata import GROUP_DTYPE, RunData
+
+class BuildError(Exception): pass
+
+LOG_GREETING = b"hello from measure_emulator.lua v1\n"
+
+# fields every NMI record has. the wait and end times are converted to cycles.
+NMI_FIELDS = ("wait_cycle", "end_cycle",
+    "apu_reads", "apu_writes", "joy_reads", "joy_writes")
+
+# how many bytes of log to parse at once
+CHUNK_SIZE = 16*1024*1024
+
+# an NMI needs to end within this many cycles of its group's next latch
+LATCH_SLOP = 1000
+
+# record type markers. the fields are all non-negative so the markers can't be
+# mistaken for them.
+_LATCH_MARK = -1
+_NMI_MARK = -2
+
+# convert the pixel counter values to a cycle since reset. works on arrays too.
+# thanks Ilari for the formula
+def pixel_to_cycle(f, v, h):
+    return f * 357366 - f % 2 * 2 + (v + 21) % 262 * 1364 + h - 386008
+
+# read a measure_emulator.lua log. extra_fields names any fields the game adds
+# to the end of NMI records.
+
+# returns (freqs, latches, nmis): the emulated frequencies as a list of ints,
+# the cycle of each latch as an array, and a structured array of NMIs with the
+# NMI_FIELDS and extra fields.
+def read_emulator_log(path, extra_fields=(), chunk_size=CHUNK_SIZE):
+    nmi_dtype = np.dtype([(name, np.int64)
+        for name in (*NMI_FIELDS, *extra_fields)])
+    nmi_len = 10 + len(extra_fields) # raw fields in an NMI record
+
+    latch_chunks = []
+    nmi_chunks = []
+    with open(path, "rb") as f:
+        if f.readline() != LOG_GREETING:
+            raise BuildError("invalid greeting")
+
+        # get emulated frequencies
+        freqs = f.readline().strip().split(b",")
+        if freqs[0] != b"c":
+            raise BuildError("invalid frequency format")
+        freqs = [int(freq) for freq in freqs[1:]]
+
+        leftover = b""
+        while True:
+            data = f.read(chunk_size)
+            if len(data) == 0:
+                break
+            # only parse complete lines
+            data = leftover + data
+            end = data.rfind(b"\n") + 1
+            leftover = data[end:]
+            if end == 0: # no line ends in this chunk yet
+                continue
+            latches, nmis = _parse_chunk(data[:end], nmi_len)
+            latch_chunks.append(latches)
+            nmi_chunks.append(nmis)
+        if len(leftover.strip()) > 0:
+            # the last line doesn't end in a newline
+            latches, nmis = _parse_chunk(leftover + b"\n", nmi_len)
+            latch_chunks.append(latches)
+            nmi_chunks.append(nmis)
+
+    latches = np.concatenate([np.zeros((0, 3), dtype=np.int64),
+        *latch_chunks])
+    raw_nmis = np.concatenate([np.zeros((0, nmi_len), dtype=np.int64),
+        *nmi_chunks])
+
+    latches = pixel_to_cycle(latches[:, 0], latches[:, 1], latches[:, 2])
+    nmis = np.empty(len(raw_nmis), dtype=nmi_dtype)
+    nmis["wait_cycle"] = pixel_to_cycle(*raw_nmis[:, 0:3].T)
+    nmis["end_cycle"] = pixel_to_cycle(*raw_nmis[:, 3:6].T)
+    for fi, name in enumerate(nmi_dtype.names[2:]):
+        nmis[name] = raw_nmis[:, 6+fi]
+
+    return freqs, latches, nmis
+
+# parse a chunk of whole lines into arrays of raw latch and NMI fields
+def _parse_chunk(data, nmi_len):
+    # anything but record types, numbers, and separators is bogus
+    bogus = data.translate(None, b"ln0123456789,\n")
+    if len(bogus.strip()) > 0:
+        raise BuildError("invalid characters in log: {}".format(bogus[:20]))
+
+    # turn the record types into markers and parse the whole chunk as one big
+    # list of numbers
+    data = data.replace(b"l,", b"-1,").replace(b"n,", b"-2,")
+    data = data.rstrip(b"\n").replace(b"\n", b",")
+    try:
+        values = np.fromstring(data, dtype=np.int64, sep=",")
+    except ValueError: # what newer numpy does with a field that's not a number
+        raise BuildError("invalid field in log") from None
+    # older numpy just quietly stops there, so make sure it got all of them
+    if len(values) != data.count(b",") + 1:
+        raise BuildError("invalid field in log")
+
+    # the markers tell us where each record starts and what it is
+    starts = np.flatnonzero(values < 0)
+    if len(starts) == 0 or starts[0] != 0:
+        raise BuildError("invalid record type in log")
+    lens = np.diff(np.append(starts, len(values))) - 1
+    kinds = values[starts]
+
+    is_latch = kinds == _LATCH_MARK
+    is_nmi = kinds == _NMI_MARK
+    if np.any(is_latch & (lens != 3)) or np.any(is_nmi & (lens != nmi_len)):
+        raise BuildError("record with wrong number of fields in log")
+    if not np.all(is_latch | is_nmi):
+        raise BuildError("invalid record type in log")
+
+    latch_starts = starts[is_latch] + 1
+    nmi_starts = starts[is_nmi] + 1
+    latches = values[latch_starts[:, None] + np.arange(3)]
+    nmis = values[nmi_starts[:, None] + np.arange(nmi_len)]
+    return latches, nmis
+
+# figure out the latch each NMI starts at, which is when we will change the
+# freq. an NMI covers every latch up to LATCH_SLOP cycles before it ends.
+# returns an array with the start latch of each NMI, plus the total number of
+# latches at the end.
+
+# if require_latches, raises an exception if an NMI covers no latches.
+def find_nmi_start_latches(latches, nmis, require_latches=False):
+    if np.any(np.diff(latches) < 0):
+        raise BuildError("latches are out of order")
+    # each NMI ends where the latches are all at least LATCH_SLOP before its
+    # end (and never before the previous NMI ended)
+    ends = np.searchsorted(latches, nmis["end_cycle"]-LATCH_SLOP, side="left")
+    ends = np.maximum.accumulate(ends)
+    nmi_start_latches = np.concatenate([[0], ends[:-1], [len(latches)]])
+    if require_latches:
+        empty = np.flatnonzero(ends == nmi_start_latches[:-1])
+        if len(empty) > 0:
+            raise BuildError("NMI {} has no latches".format(empty[0]))
+
+    # validate that all nmis start close to their latch (or rather that they
+    # end close to the next)
+    next_latch = nmi_start_latches[1:-1]
+    has_next = next_latch < len(latches)
+    ni = np.flatnonzero(has_next)
+    off = np.abs(latches[next_latch[ni]] - nmis["end_cycle"][ni]) > LATCH_SLOP
+    for i in ni[off]:
+        print("NMI {} ends at {} but its next latch is at {}".format(
+            i, nmis["end_cycle"][i], latches[next_latch[i]]))
+
+    return nmi_start_latches
+
+# put NMIs into groups. one group is zero or more 100% busy frames followed by
+# a not busy frame. these will all be controlled by the same frequency.
+# trailing 100% busy NMIs which never get a not busy one aren't in any group.
+# returns (first NMI of each group, last NMI of each group).
+def find_groups(nmis):
+    last = np.flatnonzero(nmis["end_cycle"] != nmis["wait_cycle"])
+    first = np.concatenate([[0], last[:-1]+1]).astype(np.int64)
+    return first, last
+
+# build the groups array for RunData (see GROUP_DTYPE for the fields)
+def build_groups(latches, nmis, nmi_start_latches, first, last):
+    groups = np.zeros(len(first), dtype=GROUP_DTYPE)
+    groups["gid"] = np.arange(len(first))
+    groups["nmi_start"] = first
+    groups["num_nmis"] = last - first + 1
+    groups["latch_start"] = nmi_start_latches[first]
+    groups["num_latches"] = \
+        nmi_start_latches[last+1] - nmi_start_latches[first]
+    accesses = np.concatenate([[0],
+        np.cumsum(nmis["apu_reads"] + nmis["apu_writes"])])
+    groups["apu_accesses"] = accesses[last+1] - accesses[first]
+    groups["ex_end_cycle"] = nmis["end_cycle"][last]
+    groups["ex_wait_cycle"] = nmis["wait_cycle"][last]
+    latch_end = nmi_start_latches[last+1]
+    if np.any(latch_end >= len(latches)):
+        raise BuildError("group {} has no latch after it".format(
+            np.argmax(latch_end >= len(latches))))
+    groups["latch_clocks"] = \
+        latches[latch_end] - latches[nmi_start_latches[first]]
+    groups["override"] = np.nan
+    groups["balance"] = -1
+    return groups
+
+# do all of the above. if skip_last_nmi, the last NMI is ignored (e.g. because
+# it doesn't have a latch after it). returns (RunData, nmis, first, last) so
+# the caller can add game specific information to the groups.
+def build_rundata(path, extra_fields=(), skip_last_nmi=False,
+        require_latches=False):
+    freqs, latches, nmis = read_emulator_log(path, extra_fields)
+    nmi_start_latches = find_nmi_start_latches(latches, nmis, require_latches)
+    if skip_last_nmi:
+        first, last = find_groups(nmis[:-1])
+    else:
+        first, last = find_groups(nmis)
+    groups = build_groups(latches, nmis, nmi_start_latches, first, last)
+    return RunData(groups), nmis, first, last
@@ -0,0 +1,337 @@
+# the autosync loop: fix the problems from the last run, balance the cycles,
+# build the TAS with the new frequencies, then run it on the console to measure
+# what happens. repeat until it syncs (or forever, really).
+
+# everything specific to a game lives in its profile (a GameProfile subclass in
+# chrono_figure/game/<game>/profile.py), so the loop only has to be written and
+# sped up once.
+
+# usage: python3 -m chrono_figure.autosync.engine game rundata_in rundata_out
+#   r16m tasha_port
+
+import sys
+import time
+import importlib
+from collections import namedtuple
+
+import numpy as np
+
+from chrono_figure.host.interface import ChronoFigureInterface
+from tasha.host.latch_streamer import LatchStreamer
+from tasha.gateware.apu_calc import calculate_advanced, expand_to_latches
+from .balance import group_columns, balance_cycles
+from .fix import FixSettings, fix_problems
+from .rundata import load_rundata
+from .measure import MeasurementRunner
+
+class AutosyncError(Exception): pass
+
+# describes how to autosync a game. subclass it and set the attributes, then
+# override the methods for any hacks the game needs.
+class GameProfile:
+    # name of the game, for humans
+    name = None
+    # how we configure Chrono Figure's matchers. see gateware/core.py for what
+    # the numbers mean
+    matcher_config = None
+
+    # number of master clock cycles per frame
+    f_cyc = 357366
+    # nominal frequency of master clock in MHz. should match the emulator.
+    m_freq = 21.477272
+    # nominal frequency of APU clock in MHz. should match the emulator.
+    a_freq = 24.607104
+    # number of APU register accesses needed to consider a group as accessing
+    # the APU. many games (i.e. dkc2 and smw) access the APU 4 times per frame
+    # to play sound effects, so we set it higher than that to avoid fiddling
+    # with those.
+    min_apu_accesses = 12
+    # how close (in percent of frame time) an NMI can get to a frame boundary
+    # before we try to fix it
+    nmi_close = 10
+    # how far away we aim to move a close NMI
+    nmi_close_target = 20
+    # range of APU frequencies (in MHz) we're willing to use
+    min_freq = 14
+    max_freq = 24.75
+
+    # groups before this one aren't checked for desyncs
+    desync_start_group = 0
+    # if set, wait for the user to press enter before starting each measurement
+    wait_for_reset = False
+    # seconds to let the TAS keep running after it finishes to see that the
+    # ending worked
+    finish_wait = 0
+    # if set, don't stop autosync if streaming the end of the TAS fails
+    ignore_finish_errors = False
+    # if set, log every group's measurement to this file
+    mlf_path = None
+
+    # fix up the latches read from the TAS file (an array of rows of p1d0,
+    # p1d1, p2d0, p2d1, apu_freq_basic, apu_freq_advanced) and return the
+    # latches to use
+    def fixup_latches(self, latches):
+        return latches
+
+    # fix up the GroupColumns used for balancing in place
+    def fixup_group_columns(self, group_cols):
+        pass
+
+    # fix up a group's events as they are measured and return the events to
+    # use (see MeasurementRunner.groups). group is the group's row in
+    # rundata.groups.
+    def fixup_group(self, gi, group, group_events, clock):
+        return group_events
+
+    def fix_settings(self, default_freq):
+        return FixSettings(f_cyc=self.f_cyc,
+            min_apu_accesses=self.min_apu_accesses,
+            nmi_close=self.nmi_close, nmi_close_target=self.nmi_close_target,
+            min_freq=self.min_freq, max_freq=self.max_freq,
+            default_freq=default_freq)
+
+# how long each part of an iteration took, in seconds
+IterTimes = namedtuple("IterTimes", ["fix", "balance", "measure", "save"])
+
+class Autosync:
+    # profile: the game's GameProfile
+    # rundata_in: rundata store or JSON to start from
+    # rundata_out: rundata store to save to. measurements are logged there as
+    #   they are made, so a crash doesn't lose the run.
+    # latch_path: the TAS as an r16m file
+    # tasha_port: serial port TASHA is connected to
+    def __init__(self, profile, rundata_in, rundata_out, latch_path,
+            tasha_port):
+        self.profile = profile
+        self.tasha_port = tasha_port
+
+        print("loading...")
+        self.rundata = load_rundata(rundata_in)
+        self.rundata.save(rundata_out)
+
+        self.all_latches = profile.fixup_latches(
+            self._read_all_latches(latch_path))
+
+        # default (and on-powerup) clock frequency
+        self.default_basic, self.default_advanced, default_real = \
+            calculate_advanced(profile.a_freq)
+        # apply it to the TAS by default to ensure everything has a valid
+        # frequency even if we never set it
+        self.all_latches[:, 4] = self.default_basic
+        self.all_latches[:, 5] = self.default_advanced
+        self.fix_settings = profile.fix_settings(default_real)
+
+        # the parts of each group balancing needs. they don't change between
+        # runs.
+        self.group_cols = group_columns(self.rundata.groups,
+            profile.min_apu_accesses)
+        profile.fixup_group_columns(self.group_cols)
+
+        self.mlf = None
+        if profile.mlf_path is not None:
+            self.mlf = open(profile.mlf_path, "w")
+
+        self.cf = None
+        self.ls = None
+        self.runner = None
+        self.times = []
+
+    def _read_all_latches(self, latch_path):
+        with open(latch_path, "rb") as latch_file:
+            data = latch_file.read()
+        data = np.frombuffer(data, dtype='>u2').reshape(-1, 8)
+        return data[:, (0, 1, 4, 5, 0, 0)].astype(np.uint16)
+
+    def connect(self):
+        print("chrono figure setup...")
+        # connect to and set up chrono figure
+        self.cf = ChronoFigureInterface()
+        self.cf.connect()
+        # stop saves so our weirdness doesn't screw with the user's saves
+        self.cf.prevent_saving(True)
+        self.cf.configure_matchers(self.profile.matcher_config)
+
+        self.ls = LatchStreamer(controllers=["p1d0", "p1d1", "p2d0", "p2d1",
+            "apu_freq_basic", "apu_freq_advanced"])
+        # services tasha and chrono figure while we measure
+        self.runner = MeasurementRunner(self.ls, self.cf)
+
+    def balance_and_build(self):
+        print("balancing cycles")
+        rundata = self.rundata
+        # confirm every group actually got a new frequency
+        no_freq = np.flatnonzero(rundata.num_freqs != rundata.num_meas + 1)
+        if len(no_freq) > 0:
+            raise AutosyncError(
+                "group {} didn't get a frequency".format(no_freq[0]))
+
+        p = self.profile
+        actual, basic, advanced, surplus = balance_cycles(rundata.last_freq,
+            self.group_cols.latch_clocks, self.group_cols.should_balance,
+            p.min_freq, p.max_freq, p.m_freq, p.a_freq)
+
+        # remember the frequency we actually generate
+        rundata.set_next_freqs(np.arange(len(actual)), actual)
+        # and put the registers that generate it into the TAS
+        expand_to_latches(self.all_latches, (4, 5),
+            self.group_cols.latch_start, self.group_cols.num_latches,
+            np.stack((basic, advanced), axis=1))
+
+        print("surplus: {} cycles".format(surplus))
+
+    def measure(self):
+        print("starting measurement run...")
+        p = self.profile
+        cf, ls, runner = self.cf, self.ls, self.runner
+        groups = self.rundata.groups
+
+        ls.disconnect()
+        ls.clear_latch_queue()
+        # fill the queue with the TAS
+        ls.add_latches(self.all_latches)
+
+        # hold console in reset while we set up tasha so it doesn't latch
+        # anything it shouldn't
+        cf.assert_reset(True)
+        # erase save memory to ensure a clean start
+        cf.destroy_save_ram()
+        # connect to tasha to get the tas started
+        ls.connect(self.tasha_port, status_cb=lambda s: None,
+            num_priming_latches=200,
+            apu_freq_basic=self.default_basic,
+            apu_freq_advanced=self.default_advanced,
+        )
+        # tell it that we are done sending latches (we put the whole tas in
+        # already)
+        ls.add_latches(None)
+        # keep tasha full from now on
+        runner.start_streaming()
+
+        # start the chrono figure measurement. this will take the console out
+        # of reset so we can start reading them after.
+        if p.wait_for_reset:
+            input("reset")
+        cf.start_measurement()
+        runner.start_events()
+        if p.wait_for_reset:
+            print("let go")
+        print('measurement setup done')
+
+        def fixup(gi, group_events, clock):
+            return p.fixup_group(gi, groups[gi], group_events, clock)
+
+        desynced = False
+        for gi, group_events in runner.groups(len(groups), fixup):
+            group = groups[gi]
+
+            # store the measurement we made
+            end_cycle = int(group_events["end_cycle"][-1])
+            wait_cycle = int(group_events["wait_cycle"][-1])
+            self.rundata.add_measurement(gi, end_cycle, wait_cycle,
+                len(group_events))
+
+            # look at the last nmi in the group
+            busy = (p.f_cyc-end_cycle+wait_cycle)/p.f_cyc*100
+
+            if self.mlf is not None:
+                ex_end_cycle = group["ex_end_cycle"]
+                ex_wait_cycle = group["ex_wait_cycle"]
+                ex_busy = (p.f_cyc-ex_end_cycle+ex_wait_cycle)/p.f_cyc*100
+                m = "{}, {}, {}, {}, {}, {}, {}\n".format(gi, busy, ex_busy,
+                    end_cycle, wait_cycle, ex_end_cycle, ex_wait_cycle)
+                self.mlf.write(m)
+
+            # if this group doesn't have the same number of NMIs, we must have
+            # desynced somehow
+            if len(group_events) != group["num_nmis"] and \
+                    gi >= p.desync_start_group:
+                missed = (wait_cycle-group["ex_wait_cycle"])/p.f_cyc*100
+                print("whoops, group {} desynced (missed expected time by "
+                    "{:.2f}%).".format(gi, missed), end=" ")
+                if wait_cycle >= group["ex_wait_cycle"]:
+                    print("faster!")
+                else:
+                    print("slower!")
+                desynced = True
+                break
+
+            closeness = 50-abs(busy-50)
+            if closeness < p.nmi_close and \
+                    group["apu_accesses"] >= p.min_apu_accesses:
+                print("group {} got within {:.2f}% of boundary & accessed APU "
+                    "{} times.".format(gi, closeness, group["apu_accesses"]),
+                    end=" ")
+                if busy > 50:
+                    print("faster!")
+                else:
+                    print("slower!")
+
+        runner.stop_events()
+        if not desynced: # we finished naturally, make sure the rest works
+            print("made it through! finishing TAS...")
+            try:
+                runner.wait_streaming()
+            except KeyboardInterrupt:
+                raise
+            except Exception:
+                if not p.ignore_finish_errors:
+                    raise
+            # wait for the ending to be sure it worked
+            time.sleep(p.finish_wait)
+        runner.stop()
+
+        print("measurement run complete")
+
+    # do one whole iteration and return how long each part took
+    def iterate(self):
+        t0 = time.monotonic()
+        # fix any problems from the last run (or what we just loaded)
+        fix_problems(self.rundata, self.fix_settings)
+        t1 = time.monotonic()
+        # balance cycles and create the new TAS
+        self.balance_and_build()
+        t2 = time.monotonic()
+        # run it to measure what happens
+        self.measure()
+        t3 = time.monotonic()
+        # save what we learned
+        print("updating rundata...")
+        self.rundata.save()
+        if self.mlf is not None:
+            self.mlf.flush()
+        t4 = time.monotonic()
+
+        times = IterTimes(t1-t0, t2-t1, t3-t2, t4-t3)
+        self.times.append(times)
+        print("iteration {}: fix {:.2f}s, balance {:.2f}s, measure {:.1f}s, "
+            "save {:.2f}s".format(len(self.times), *times))
+        return times
+
+    def run(self):
+        if self.cf is None:
+            self.connect()
+        while True:
+            self.iterate()
+
+# load the profile for the game with the given directory name in
+# chrono_figure/game
+def load_profile(game):
+    module = importlib.import_module("chrono_figure.game.{}.profile".format(
+        game))
+    return module.PROFILE
+
+def main(profile=None):
+    args = sys.argv[1:]
+    if profile is None:
+        if len(args) != 5:
+            print("args: game rundata_in rundata_out r16m tasha_port")
+            exit(1)
+        profile = load_profile(args.pop(0))
+    elif len(args) != 4:
+        print("args: rundata_in rundata_out r16m tasha_port")
+        exit(1)
+
+    Autosync(profile, *args).run()
+
+if __name__ == "__main__":
+    main()
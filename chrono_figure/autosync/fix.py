@@ -0,0 +1,236 @@
+# decide new APU frequencies for groups which had problems during the last
+# measurement run.
+
+# for each problem group, we fit a line through the frequencies we've tried
+# against how far off the group ended up, then use it to pick the frequency
+# that should put the group where we want it. all the groups are fit at once
+# with closed-form least squares over the concatenated measurements, so the
+# cost hardly depends on how many groups had problems.
+
+from collections import namedtuple
+
+import numpy as np
+
+# fewer measurements than this and we don't bother predicting
+MIN_FIT_POINTS = 3
+# fits with an R^2 lower than this are too bad to predict with
+MIN_FIT_R2 = 0.5
+# fits flatter than this mean the frequency didn't change, so the R^2 is junk
+MIN_FIT_SLOPE = 1e-12
+# most a wild guess will change the frequency by (in MHz)
+MAX_GUESS_DELTA = 0.1
+
+# whether all the values in each segment are the same (empty ones are)
+def _seg_constant(v, lengths):
+    constant = np.ones(len(lengths), dtype=bool)
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        starts = (np.cumsum(lengths) - lengths)[nonempty]
+        constant[nonempty] = \
+            np.maximum.reduceat(v, starts) == np.minimum.reduceat(v, starts)
+    return constant
+
+# fit y = slope*x + intercept separately for each segment of the (flat) x and y
+# arrays. segment i is lengths[i] long and they come one after the other.
+# returns (slope, intercept, r2) with one entry per segment. segments with
+# fewer than two points or where x doesn't change get nan for all three, and
+# ones where y doesn't change get nan for r2.
+def fit_segments(x, y, lengths):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_segs = len(lengths)
+    if len(x) != len(y) or len(x) != np.sum(lengths):
+        raise ValueError("segment lengths don't match data")
+
+    seg = np.repeat(np.arange(num_segs), lengths)
+    def seg_sum(v):
+        return np.bincount(seg, weights=v, minlength=num_segs)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # center each segment first so big x values (cycle counts) don't eat
+        # all the precision
+        x_mean = seg_sum(x)/lengths
+        y_mean = seg_sum(y)/lengths
+        dx = x - x_mean[seg]
+        dy = y - y_mean[seg]
+        sxx = seg_sum(dx*dx)
+        syy = seg_sum(dy*dy)
+        sxy = seg_sum(dx*dy)
+
+        # rounding in the mean means sxx might not come out exactly 0 when all
+        # the x values are the same, so check for that directly
+        good = (lengths >= 2) & ~_seg_constant(x, lengths)
+        slope = np.where(good, sxy/sxx, np.nan)
+        intercept = np.where(good, y_mean - slope*x_mean, np.nan)
+        r2 = np.where(good & ~_seg_constant(y, lengths), (sxy*sxy)/(sxx*syy), np.nan)
+
+    return slope, intercept, r2
+
+# pick the next frequency for each problem group.
+# deviations, freqs: each group's measurements (how far off each run was, in
+#   cycles) and the frequency used for them, concatenated
+# lengths: how many measurements each group has
+# targets: deviation each group should have next time
+# last_freqs: frequency used for each group's last measurement
+# slow_down: whether each group should go slower if we have to guess
+# rng: numpy Generator used for guessing
+# returns (new_freqs, predicted, slope, intercept, r2). predicted says whether
+# each frequency came from the fit or was guessed wildly. new frequencies are
+# not bounded.
+def predict_freqs(deviations, freqs, lengths, targets, last_freqs, slow_down,
+        rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    lengths = np.asarray(lengths, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.float64)
+    last_freqs = np.asarray(last_freqs, dtype=np.float64)
+    slow_down = np.asarray(slow_down, dtype=bool)
+
+    slope, intercept, r2 = fit_segments(deviations, freqs, lengths)
+    # avoid trying to predict on bad data. comparisons with nan are False, so
+    # the groups we couldn't fit drop out here too.
+    with np.errstate(invalid="ignore"):
+        predicted = (lengths >= MIN_FIT_POINTS) & \
+            (np.abs(slope) > MIN_FIT_SLOPE) & (r2 >= MIN_FIT_R2)
+
+    new_freqs = np.empty(len(lengths), dtype=np.float64)
+    new_freqs[predicted] = slope[predicted]*targets[predicted] + \
+        intercept[predicted]
+
+    # otherwise nudge the frequency a random amount in the right direction
+    guessed = ~predicted
+    delta = rng.random(np.count_nonzero(guessed))*MAX_GUESS_DELTA
+    delta[slow_down[guessed]] *= -1
+    new_freqs[guessed] = last_freqs[guessed] + delta
+
+    return new_freqs, predicted, slope, intercept, r2
+
+# settings for fix_problems
+FixSettings = namedtuple("FixSettings", [
+    "f_cyc", # number of master clock cycles per frame
+    # number of APU register accesses needed to consider a group as accessing
+    # the APU (and so worth fixing)
+    "min_apu_accesses",
+    # how close (in percent of frame time) an NMI can get to a frame boundary
+    # before we try to fix it
+    "nmi_close",
+    "nmi_close_target", # how far away we aim to move a close NMI
+    "min_freq", "max_freq", # range of APU frequencies (in MHz) to use
+    "default_freq", # frequency to try on groups we know nothing about
+])
+
+# how many groups of each kind fix_problems found
+FixStats = namedtuple("FixStats",
+    ["desynced", "too_close", "predicted", "guessed"])
+
+# pick the frequency each group of the rundata will use for its next
+# measurement, based on what went wrong last time. settings is a FixSettings and
+# rng is passed to predict_freqs. if verbose, the problems and the new
+# frequencies are printed. returns a FixStats.
+def fix_problems(rundata, settings, rng=None, verbose=True):
+    s = settings
+    log = print if verbose else lambda *args, **kwargs: None
+    log("fixing problems")
+    groups = rundata.groups
+    # if a group's frequency is overridden, we have to use it
+    overridden = np.flatnonzero(~np.isnan(groups["override"]))
+    rundata.set_next_freqs(overridden,
+        np.clip(groups["override"][overridden], s.min_freq, s.max_freq))
+
+    # if a group already has a frequency, we can't do anything. this will only
+    # happen if the user sets one in the file (or overrode it)
+    need_freq = rundata.num_freqs == rundata.num_meas
+    # do we have any information on potential problems? if not, try out the
+    # default frequency
+    unmeasured = np.flatnonzero(need_freq & (rundata.num_meas == 0))
+    rundata.set_next_freqs(unmeasured, s.default_freq)
+
+    # is there a problem with the rest?
+    gis = np.flatnonzero(need_freq & (rundata.num_meas > 0))
+    last = rundata.last_meas[gis]
+    end_cycle, wait_cycle = last["end_cycle"], last["wait_cycle"]
+    ex_end_cycle = groups["ex_end_cycle"][gis]
+    ex_wait_cycle = groups["ex_wait_cycle"][gis]
+    accesses_apu = groups["apu_accesses"][gis] >= s.min_apu_accesses
+    busy = (s.f_cyc-end_cycle+wait_cycle)/s.f_cyc*100
+    closeness = 50-np.abs(busy-50)
+
+    desync = groups["num_nmis"][gis] != last["num_nmis"]
+    too_close = ~desync & (closeness < s.nmi_close) & accesses_apu
+
+    for pi in np.flatnonzero((desync | too_close) if verbose else []):
+        m = " GROUP {} ".format(gis[pi])
+        log(m)
+        log("-"*len(m))
+        log("problem: ", end="")
+
+        if desync[pi]:
+            missed = (wait_cycle[pi]-ex_wait_cycle[pi])/s.f_cyc*100
+            log("desync (missed expected time by {:.2f}%)".format(missed))
+            if not accesses_apu[pi]:
+                log("but this group does not access the APU. can't help ya "
+                    "there, bud")
+                log()
+                continue
+        else:
+            log("got within {:.2f}% of a frame boundary".format(
+                closeness[pi]))
+
+        log("curr APU freq: {:.6f}MHz".format(rundata.last_freq[gis[pi]]))
+        log()
+
+    # no problem (or one we can't help with), so just reuse the last frequency
+    fixable = (desync & accesses_apu) | too_close
+    rundata.set_next_freqs(gis[~fixable], rundata.last_freq[gis[~fixable]])
+    if not np.any(fixable):
+        return FixStats(int(np.count_nonzero(desync)),
+            int(np.count_nonzero(too_close)), 0, 0)
+    gis = gis[fixable]
+    desync_all = desync
+    desync = desync[fixable]
+    busy, wait_cycle = busy[fixable], wait_cycle[fixable]
+    ex_end_cycle = ex_end_cycle[fixable]
+    ex_wait_cycle = ex_wait_cycle[fixable]
+
+    # calculate expected business if we had a desync as the business above
+    # will be nonsense
+    busy = np.where(desync,
+        (s.f_cyc-ex_end_cycle+ex_wait_cycle)/s.f_cyc*100, busy)
+    # if it ends sooner than we expect then we need to slow down. once we get it
+    # resynced, the other code will handle keeping it away from frame
+    # boundaries. otherwise, slow down if it's just not busy enough!
+    slow_down = np.where(desync, wait_cycle < ex_wait_cycle, busy < 50)
+    # how far from the expected end we want the group to be
+    target = np.where(busy < 50, -s.f_cyc*(1-(s.nmi_close_target)/100),
+        -s.f_cyc*(s.nmi_close_target/100))
+
+    # fit all the problem groups at once. each group's deviations line up with
+    # the frequencies that produced them.
+    freqs, lengths = rundata.freq_history(gis)
+    meas, _ = rundata.meas_history(gis)
+    deviations = meas["wait_cycle"] - np.repeat(ex_end_cycle, lengths)
+    new_freqs, predicted, slope, intercept, r2 = predict_freqs(
+        deviations, freqs, lengths, target, rundata.last_freq[gis], slow_down,
+        rng)
+    new_freqs = np.clip(new_freqs, s.min_freq, s.max_freq)
+
+    log("new frequencies:")
+    for pi, gi in enumerate(gis if verbose else []):
+        if predicted[pi]:
+            how = "linear fit with R^2={:.3f}, m={}, b={}".format(
+                r2[pi], slope[pi], intercept[pi])
+        elif lengths[pi] < MIN_FIT_POINTS:
+            how = "not enough data to predict, guessed wildly"
+        else:
+            how = "prediction failed, guessed wildly"
+        log("group {}: {:.6f}MHz ({})".format(gi, new_freqs[pi], how))
+    log()
+
+    # will be tried next time
+    rundata.set_next_freqs(gis, new_freqs)
+
+    num_predicted = int(np.count_nonzero(predicted))
+    return FixStats(int(np.count_nonzero(desync_all)),
+        int(np.count_nonzero(too_close)), num_predicted,
+        len(gis)-num_predicted)
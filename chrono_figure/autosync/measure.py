@@ -0,0 +1,175 @@
+# run a measurement pass: stream the TAS to TASHA while collecting Chrono
+# Figure's events and sorting them into NMI groups.
+
+# the two devices want very different treatment. TASHA needs to be serviced
+# constantly or it will run out of latches during dense sections, while the
+# usb2snes gets overwhelmed if Chrono Figure's event FIFO is read too often.
+# so each gets its own thread: the streamer thread calls
+# LatchStreamer.communicate() as fast as it's useful, Chrono Figure's event
+# acquisition thread reads events only as often as they need to be, and the
+# caller consumes the events at its leisure.
+
+import time
+import threading
+
+import numpy as np
+
+from chrono_figure.host.interface import ACQUIRED_DTYPE
+
+class MeasureError(Exception): pass
+
+# lets game-specific hacks move the events after the ones they edit, e.g. to
+# pretend a frame never happened
+class EventClock:
+    def __init__(self):
+        # how many cycles to add to every event from here on
+        self.offset_cycles = 0
+
+class MeasurementRunner:
+    # latch_streamer: a LatchStreamer, already connected with the TAS queued
+    # cf: a connected ChronoFigureInterface
+    # poll_period: most seconds between reads of Chrono Figure's event FIFO
+    # stream_period: seconds between calls to LatchStreamer.communicate()
+    def __init__(self, latch_streamer, cf, poll_period=0.1,
+            stream_period=0.002):
+        self.ls = latch_streamer
+        self.cf = cf
+        self.poll_period = poll_period
+        self.stream_period = stream_period
+
+        self.stream_thread = None
+        self.stream_stop = threading.Event()
+        self.stream_error = None
+
+        self.acquisition = None
+        # events after a missed one, to raise an exception about next time
+        self.held_events = None
+
+    # start servicing the latch streamer. don't touch it until stop() is called
+    # or wait_streaming() returns.
+    def start_streaming(self):
+        if self.stream_thread is not None:
+            raise MeasureError("already streaming")
+        self.stream_stop.clear()
+        self.stream_error = None
+        self.stream_thread = threading.Thread(
+            target=self._stream_thread, daemon=True)
+        self.stream_thread.start()
+
+    # start collecting Chrono Figure's events. call this once the measurement
+    # has been started. don't touch Chrono Figure until stop_events() or stop()
+    # is called.
+    def start_events(self):
+        if self.acquisition is not None and self.acquisition.running:
+            raise MeasureError("already collecting events")
+        self.held_events = None
+        self.acquisition = self.cf.start_acquisition(
+            max_period=self.poll_period)
+
+    # sort the events into groups as they come in. yields (group index,
+    # ACQUIRED_DTYPE array of events) for each group in turn. a group is any
+    # number of 100% busy NMIs (where the end cycle is the wait cycle) followed
+    # by one that isn't. stops after num_groups groups or once the events stop.
+
+    # fixup(gi, group_events, clock) is called on each group's events before it
+    # is yielded so that game-specific hacks can edit the EventClock. it returns
+    # the events to yield, which it may have changed.
+    def groups(self, num_groups, fixup=None):
+        clock = EventClock()
+        # events we've received but haven't put in a group yet
+        pending = np.zeros(0, dtype=ACQUIRED_DTYPE)
+        gi = 0
+        while gi < num_groups:
+            events = self._next_events()
+            if events is None:
+                return # no more events and so no more groups
+            pending = np.concatenate((pending, events))
+
+            # every event that's not 100% busy ends a group
+            ends = np.flatnonzero(pending["end_cycle"] != pending["wait_cycle"])
+            start = 0
+            for end in ends[:num_groups-gi]:
+                group_events = pending[start:end+1].copy()
+                group_events["end_cycle"] += clock.offset_cycles
+                group_events["wait_cycle"] += clock.offset_cycles
+                start = end+1
+
+                if fixup is not None:
+                    group_events = fixup(gi, group_events, clock)
+                yield gi, group_events
+                gi += 1
+            pending = pending[start:]
+
+    # wait for the latch streamer to finish sending the TAS (i.e. disconnect)
+    def wait_streaming(self):
+        if self.stream_thread is None:
+            return
+        self.stream_thread.join()
+        self.stream_thread = None
+        self._check_stream_error()
+
+    # stop collecting events. raises the acquisition's error if it failed and
+    # nobody has read the error yet.
+    def stop_events(self):
+        # even if the acquisition has already died, Chrono Figure still
+        # thinks it's running until it's stopped
+        self.cf.stop_acquisition()
+        acquisition = self.acquisition
+        if acquisition is not None and acquisition.error is not None:
+            error = acquisition.error
+            acquisition.error = None
+            raise MeasureError("event acquisition failed") from error
+
+    # stop everything, whether or not it's done
+    def stop(self):
+        try:
+            self.stop_events()
+        finally:
+            if self.stream_thread is not None:
+                self.stream_stop.set()
+                self.stream_thread.join()
+                self.stream_thread = None
+        self._check_stream_error()
+
+    # get the next batch of events, or None if there won't be any more
+    def _next_events(self):
+        if self.held_events is not None:
+            events, self.held_events = self.held_events, None
+        else:
+            acquisition = self.acquisition
+            while True:
+                events = acquisition.read()
+                if len(events) > 0:
+                    break
+                if not acquisition.running:
+                    self._check_stream_error()
+                    return None
+                if not acquisition.wait(0.5):
+                    # don't wait forever on a console that has run out of
+                    # latches
+                    self._check_stream_error()
+
+        # the groups can't be sorted out past a missed event. return the events
+        # before it first, then raise the exception next time.
+        missed = np.flatnonzero(events["missed"])
+        if len(missed) > 0:
+            if missed[0] == 0:
+                raise MeasureError("missed an event")
+            self.held_events = events[missed[0]:]
+            events = events[:missed[0]]
+        return events
+
+    def _check_stream_error(self):
+        if self.stream_error is not None:
+            error = self.stream_error
+            self.stream_error = None
+            raise MeasureError("latch streamer failed") from error
+
+    def _stream_thread(self):
+        try:
+            while not self.stream_stop.is_set():
+                if not self.ls.communicate():
+                    break # done streaming
+                time.sleep(self.stream_period)
+        except Exception as e:
+            self.stream_error = e
@@ -0,0 +1,390 @@
+# storage for autosync run data: what we know about each NMI group, which APU
+# frequencies we've tried on it, and what happened when we did.
+
+# a rundata store is a directory containing:
+#   groups.npy: a structured array (GROUP_DTYPE) with one row per group of the
+#       things that don't change between runs
+#   extra.json: everything else from the original JSON, i.e. top-level keys
+#       other than "groups" and unknown per-group keys (like door info). these
+#       are only read by humans, so they just get carried along.
+#   log.bin: an append-only log of frequencies and measurements. each record
+#       (LOG_DTYPE) sets one entry of one group's apu_freqs or measurements
+#       list. it's flushed after every update, so a crash loses at most the
+#       update that was being made.
+
+# the JSON format the create_rundata.py scripts used to write can be converted
+# to and from a store, e.g. for humans to look at:
+#   python3 -m chrono_figure.autosync.rundata import rundata.json rundata_dir
+#   python3 -m chrono_figure.autosync.rundata export rundata_dir rundata.json
+
+import os
+import sys
+import copy
+import json
+
+import numpy as np
+
+class RunDataError(Exception): pass
+
+# static per-group fields. a group is zero or more 100% busy NMIs followed by a
+# not busy one, all controlled by the same frequency.
+GROUP_DTYPE = np.dtype([
+    # number of this group (for humans browsing the file). not actually read
+    ("gid", "<i8"),
+    # index of the starting NMI in this group
+    ("nmi_start", "<i8"),
+    # number of NMIs in this group
+    ("num_nmis", "<i8"),
+    # latch for the first NMI in this group
+    ("latch_start", "<i8"),
+    # number of latches in this group
+    ("num_latches", "<i8"),
+    # how many times this group accesses the APU
+    ("apu_accesses", "<i8"),
+    # expected end of group from emulator
+    ("ex_end_cycle", "<i8"),
+    # expected start of waiting from emulator
+    ("ex_wait_cycle", "<i8"),
+    # how many master clock cycles this group's latches took
+    ("latch_clocks", "<i8"),
+    # optional keys. override is nan if not set, balance is -1 if not set or
+    # 0/1 for false/true.
+    # override: if set, always use this APU frequency
+    ("override", "<f8"),
+    # balance: force inclusion if true (or exclusion if false) in balancing.
+    #   if included, then the balancer may edit the frequency.
+    ("balance", "i1"),
+])
+
+# a measurement of a group: actual end cycle, actual start of waiting, and
+# actual number of NMIs
+MEAS_DTYPE = np.dtype([
+    ("end_cycle", "<i8"),
+    ("wait_cycle", "<i8"),
+    ("num_nmis", "<i8"),
+])
+
+LOG_FREQ = 0 # set apu_freqs[index] of group to freq
+LOG_MEAS = 1 # set measurements[index] of group to the measurement fields
+LOG_DTYPE = np.dtype([
+    ("kind", "u1"),
+    ("group", "<u4"),
+    ("index", "<u4"),
+    ("freq", "<f8"),
+    ("end_cycle", "<i8"),
+    ("wait_cycle", "<i8"),
+    ("num_nmis", "<i8"),
+])
+
+_LOG_MAGIC = b"CFRUNLOG\x01\x00\x00\x00"
+
+# keys of the JSON group dicts that we understand
+_JSON_KEYS = set(GROUP_DTYPE.names) | {"apu_freqs", "measurements"}
+
+class RunData:
+    # make a new set of run data from a GROUP_DTYPE array. it isn't stored
+    # anywhere until save() is called.
+    def __init__(self, groups, extra=None, group_extra=None):
+        self.groups = np.asarray(groups, dtype=GROUP_DTYPE)
+        num_groups = len(self.groups)
+        # top-level keys and per-group keys (dict of group index -> dict)
+        self.extra = {} if extra is None else extra
+        self.group_extra = {} if group_extra is None else group_extra
+
+        # current state of each group, kept up to date as the log grows
+        self.num_freqs = np.zeros(num_groups, dtype=np.int64)
+        self.last_freq = np.full(num_groups, np.nan)
+        self.num_meas = np.zeros(num_groups, dtype=np.int64)
+        self.last_meas = np.zeros(num_groups, dtype=MEAS_DTYPE)
+
+        self._path = None
+        self._log_file = None
+        self._log_chunks = [] # the log in memory
+        self._log_cache = None # the chunks, concatenated
+
+    # load a store from the given directory
+    @classmethod
+    def load(cls, path):
+        groups = np.load(os.path.join(path, "groups.npy"))
+        if groups.dtype != GROUP_DTYPE:
+            raise RunDataError("groups.npy has the wrong format")
+        extra = json.load(open(os.path.join(path, "extra.json"), "r"))
+        group_extra = {int(k): v for k, v in extra.pop("group_extra").items()}
+        rundata = cls(groups, extra, group_extra)
+
+        log_path = os.path.join(path, "log.bin")
+        with open(log_path, "rb") as f:
+            if f.read(len(_LOG_MAGIC)) != _LOG_MAGIC:
+                raise RunDataError("log.bin has the wrong format")
+            log = np.frombuffer(f.read(), dtype=np.uint8)
+        # a crash in the middle of writing a record might leave part of it at
+        # the end. throw that away.
+        whole = len(log) - (len(log) % LOG_DTYPE.itemsize)
+        log = log[:whole].view(LOG_DTYPE).copy()
+        if np.any(log["group"] >= len(groups)):
+            raise RunDataError("log.bin is corrupt")
+        rundata._replay(log)
+        rundata._log_chunks.append(log)
+
+        rundata._path = path
+        rundata._open_log(truncate_to=len(_LOG_MAGIC)+whole)
+        return rundata
+
+    # convert from the JSON format
+    @classmethod
+    def from_json(cls, data):
+        data = dict(data)
+        json_groups = data.pop("groups")
+        groups = np.zeros(len(json_groups), dtype=GROUP_DTYPE)
+        for name in GROUP_DTYPE.names:
+            if name == "override":
+                groups[name] = [np.nan if g.get("override") is None
+                    else g["override"] for g in json_groups]
+            elif name == "balance":
+                groups[name] = [-1 if g.get("balance") is None
+                    else bool(g["balance"]) for g in json_groups]
+            elif name == "gid":
+                groups[name] = [g.get("gid", gi)
+                    for gi, g in enumerate(json_groups)]
+            else:
+                groups[name] = [g[name] for g in json_groups]
+
+        freq_log = []
+        meas_log = []
+        group_extra = {}
+        for gi, group in enumerate(json_groups):
+            for i, freq in enumerate(group["apu_freqs"]):
+                freq_log.append((LOG_FREQ, gi, i, freq, 0, 0, 0))
+            for i, meas in enumerate(group["measurements"]):
+                meas_log.append((LOG_MEAS, gi, i, 0, *meas))
+
+            unknown = {k: v for k, v in group.items() if k not in _JSON_KEYS}
+            if len(unknown) > 0:
+                group_extra[gi] = unknown
+
+        rundata = cls(groups, data, group_extra)
+        rundata._append_log(np.array(freq_log+meas_log, dtype=LOG_DTYPE))
+        return rundata
+
+    # convert to the JSON format
+    def to_json(self):
+        freqs, freq_lens = self.freq_history()
+        meas, meas_lens = self.meas_history()
+        freq_starts = np.cumsum(freq_lens) - freq_lens
+        meas_starts = np.cumsum(meas_lens) - meas_lens
+        freqs = freqs.tolist()
+        meas = meas.tolist()
+
+        json_groups = []
+        for gi, row in enumerate(self.groups.tolist()):
+            group = dict(zip(GROUP_DTYPE.names, row))
+            if np.isnan(group["override"]):
+                del group["override"]
+            if group["balance"] < 0:
+                del group["balance"]
+            else:
+                group["balance"] = bool(group["balance"])
+            fs = freq_starts[gi]
+            group["apu_freqs"] = freqs[fs:fs+freq_lens[gi]]
+            ms = meas_starts[gi]
+            group["measurements"] = \
+                [list(m) for m in meas[ms:ms+meas_lens[gi]]]
+            group.update(self.group_extra.get(gi, {}))
+            json_groups.append(group)
+
+        data = dict(self.extra)
+        data["groups"] = json_groups
+        return data
+
+    # write everything out to the store at the given path (or the one we were
+    # loaded from/last saved to). once saved, updates are logged to it.
+    def save(self, path=None):
+        if path is None:
+            path = self._path
+        if path is None:
+            raise RunDataError("no path to save to")
+        os.makedirs(path, exist_ok=True)
+
+        # write to temporary files and rename them over the old ones so we never
+        # leave half a file behind
+        tmp = os.path.join(path, "groups.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, self.groups)
+        os.replace(tmp, os.path.join(path, "groups.npy"))
+
+        extra = dict(self.extra)
+        extra["group_extra"] = {str(k): v for k, v in self.group_extra.items()}
+        tmp = os.path.join(path, "extra.json.tmp")
+        with open(tmp, "w") as f:
+            json.dump(extra, f, indent=" ")
+        os.replace(tmp, os.path.join(path, "extra.json"))
+
+        if path != self._path:
+            # the log isn't there yet, so write all of it
+            tmp = os.path.join(path, "log.bin.tmp")
+            with open(tmp, "wb") as f:
+                f.write(_LOG_MAGIC)
+                f.write(self._log().tobytes())
+            os.replace(tmp, os.path.join(path, "log.bin"))
+            self._path = path
+            self._open_log()
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+    # set the frequency each of the given groups will use for its next
+    # measurement. this replaces the frequency if it already has one.
+    def set_next_freqs(self, gis, freqs):
+        gis, freqs = np.broadcast_arrays(np.asarray(gis, dtype=np.int64),
+            np.asarray(freqs, dtype=np.float64))
+        gis = gis.ravel()
+        freqs = freqs.ravel()
+        if len(np.unique(gis)) != len(gis):
+            raise RunDataError("groups set more than once")
+
+        has_next = self.num_freqs[gis] == self.num_meas[gis] + 1
+        # don't bother logging anything that didn't change
+        changed = ~has_next | (self.last_freq[gis] != freqs)
+        gis = gis[changed]
+        log = np.zeros(len(gis), dtype=LOG_DTYPE)
+        log["kind"] = LOG_FREQ
+        log["group"] = gis
+        log["index"] = self.num_meas[gis]
+        log["freq"] = freqs[changed]
+        self._append_log(log)
+
+    def set_next_freq(self, gi, freq):
+        self.set_next_freqs([gi], [freq])
+
+    # record measurements of the given groups made with their next frequencies
+    def add_measurements(self, gis, end_cycles, wait_cycles, num_nmis):
+        gis = np.asarray(gis, dtype=np.int64).ravel()
+        if len(np.unique(gis)) != len(gis):
+            raise RunDataError("groups measured more than once")
+        no_freq = self.num_freqs[gis] != self.num_meas[gis] + 1
+        if np.any(no_freq):
+            raise RunDataError("group {} has no frequency to measure".format(
+                gis[np.argmax(no_freq)]))
+        log = np.zeros(len(gis), dtype=LOG_DTYPE)
+        log["kind"] = LOG_MEAS
+        log["group"] = gis
+        log["index"] = self.num_meas[gis]
+        log["end_cycle"] = end_cycles
+        log["wait_cycle"] = wait_cycles
+        log["num_nmis"] = num_nmis
+        self._append_log(log)
+
+    def add_measurement(self, gi, end_cycle, wait_cycle, num_nmis):
+        self.add_measurements([gi], [end_cycle], [wait_cycle], [num_nmis])
+
+    # make an independent copy in memory. it isn't stored anywhere until save()
+    # is called.
+    def copy(self):
+        rundata = RunData(self.groups.copy(), copy.deepcopy(self.extra),
+            copy.deepcopy(self.group_extra))
+        rundata._append_log(self._log().copy())
+        return rundata
+
+    # get every frequency of the given groups (default all), concatenated, and
+    # how many each group has
+    def freq_history(self, gis=None):
+        log, lens = self._history(LOG_FREQ, gis)
+        return log["freq"].copy(), lens
+
+    # same, but for measurements. returns a MEAS_DTYPE array.
+    def meas_history(self, gis=None):
+        log, lens = self._history(LOG_MEAS, gis)
+        meas = np.empty(len(log), dtype=MEAS_DTYPE)
+        for name in MEAS_DTYPE.names:
+            meas[name] = log[name]
+        return meas, lens
+
+    def _history(self, kind, gis):
+        if gis is None:
+            gis = np.arange(len(self.groups))
+        gis = np.asarray(gis, dtype=np.int64)
+        log = self._log()
+        # find the records we want and give each the position of its group in
+        # gis so we can sort them in that order
+        log = log[log["kind"] == kind]
+        pos = np.full(len(self.groups), -1, dtype=np.int64)
+        pos[gis] = np.arange(len(gis))
+        log_pos = pos[log["group"]]
+        keep = log_pos >= 0
+        log = log[keep]
+        log_pos = log_pos[keep]
+        # sort by group, then index, then age. the newest record of each entry
+        # is the one that counts.
+        order = np.lexsort((np.arange(len(log)), log["index"], log_pos))
+        log = log[order]
+        log_pos = log_pos[order]
+        last = np.ones(len(log), dtype=bool)
+        last[:-1] = (log_pos[1:] != log_pos[:-1]) | \
+            (log["index"][1:] != log["index"][:-1])
+        log = log[last]
+        lens = np.bincount(log_pos[last], minlength=len(gis))
+        return log, lens
+
+    # update the current state from new log records
+    def _replay(self, log):
+        # records for each group are only ever appended or replace the last
+        # entry, so the newest record of each group has the last entry
+        for kind in (LOG_FREQ, LOG_MEAS):
+            rec = log[log["kind"] == kind][::-1]
+            gis, newest = np.unique(rec["group"], return_index=True)
+            rec = rec[newest]
+            if kind == LOG_FREQ:
+                self.num_freqs[gis] = rec["index"].astype(np.int64) + 1
+                self.last_freq[gis] = rec["freq"]
+            else:
+                self.num_meas[gis] = rec["index"].astype(np.int64) + 1
+                for name in MEAS_DTYPE.names:
+                    self.last_meas[name][gis] = rec[name]
+
+    def _append_log(self, log):
+        if len(log) == 0:
+            return
+        self._replay(log)
+        self._log_chunks.append(log)
+        self._log_cache = None
+        if self._log_file is not None:
+            self._log_file.write(log.tobytes())
+            self._log_file.flush()
+
+    def _log(self):
+        if self._log_cache is None:
+            if len(self._log_chunks) == 0:
+                self._log_cache = np.zeros(0, dtype=LOG_DTYPE)
+            else:
+                self._log_cache = np.concatenate(self._log_chunks)
+            self._log_chunks = [self._log_cache]
+        return self._log_cache
+
+    def _open_log(self, truncate_to=None):
+        self.close()
+        self._log_file = open(os.path.join(self._path, "log.bin"), "r+b")
+        if truncate_to is not None:
+            self._log_file.truncate(truncate_to)
+        self._log_file.seek(0, os.SEEK_END)
+
+# load run data from either a store directory or a JSON file
+def load_rundata(path):
+    if os.path.isdir(path):
+        return RunData.load(path)
+    return RunData.from_json(json.load(open(path, "r")))
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] not in ("import", "export"):
+        print("args: import rundata_json rundata_dir")
+        print("      export rundata_dir rundata_json")
+        exit(1)
+
+    if sys.argv[1] == "import":
+        rundata = RunData.from_json(json.load(open(sys.argv[2], "r")))
+        rundata.save(sys.argv[3])
+    else:
+        rundata = RunData.load(sys.argv[2])
+        json.dump(rundata.to_json(), open(sys.argv[3], "w"), indent=" ")
+    rundata.close()
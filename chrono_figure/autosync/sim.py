@@ -0,0 +1,309 @@
+# simulate autosync offline so strategies and settings can be tried out without
+# spending hours playing the TAS on a console for each iteration.
+
+# the simulator fits a model of each group from recorded measurements: how the
+# end cycle and wait cycle (relative to the emulator's expected end cycle) move
+# with the APU frequency. each virtual iteration then runs the real fix and
+# balance code, "measures" the groups with the model, and records the result
+# like a console run would, stopping at the first desync.
+
+# the model is deliberately simple. each group is a straight line plus some
+# noise and doesn't affect the groups after it. a group desyncs when its last
+# NMI becomes 100% busy (it gains an NMI) or stops being busy at all (it loses
+# one). it's meant for comparing strategies, not for predicting the future.
+
+# usage: python3 -m chrono_figure.autosync.sim rundata [options]
+# where rundata is a store or JSON file with some measurements in it. see
+# --help for the options.
+
+import time
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+from tasha.gateware.apu_calc import calculate_advanced
+from .rundata import RunData, load_rundata
+from .fix import fit_segments, FixSettings, fix_problems
+from .balance import group_columns, balance_cycles
+
+class SimError(Exception): pass
+
+# read the mlf.log written by the autosync scripts. each line is
+# "gi, busy, ex_busy, end_cycle, wait_cycle, ex_end_cycle, ex_wait_cycle" and
+# each measurement run starts over from group 0. returns (group, end_cycle,
+# wait_cycle) arrays.
+def load_mlf(path):
+    data = np.loadtxt(path, delimiter=",", usecols=(0, 3, 4), ndmin=2)
+    # the cycle counts are well within float64's exact range
+    data = data.astype(np.int64)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+# get (group, freq, end_cycle, wait_cycle, num_nmis) samples from the
+# rundata's measurements, pairing each with the frequency that produced it
+def rundata_samples(rundata):
+    freqs, freq_lens = rundata.freq_history()
+    meas, meas_lens = rundata.meas_history()
+    # groups may have a next frequency that hasn't been measured yet
+    freq_idx = _ragged_index(freq_lens, meas_lens)
+    gis = np.repeat(np.arange(len(meas_lens)), meas_lens)
+    return (gis, freqs[freq_idx], meas["end_cycle"], meas["wait_cycle"],
+        meas["num_nmis"])
+
+# get samples from an mlf.log instead. the log must come from the session
+# which produced the last measurements in the rundata: if a group shows up k
+# times in the log, those are taken to be its last k measurements, and the
+# frequencies and NMI counts come from the rundata. groups with more entries in
+# the log than measurements in the rundata can't be matched and are dropped.
+def mlf_samples(mlf, rundata):
+    gis, end_cycle, wait_cycle = mlf
+    num_groups = len(rundata.groups)
+    if np.any((gis < 0) | (gis >= num_groups)):
+        raise SimError("mlf.log has groups the rundata doesn't")
+
+    # number the entries of each group in the order they were logged
+    order = np.argsort(gis, kind="stable")
+    counts = np.bincount(gis, minlength=num_groups)
+    entry = np.empty(len(gis), dtype=np.int64)
+    entry[order] = np.arange(len(gis)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+
+    # and match them to the last measurements
+    usable = counts <= rundata.num_meas
+    keep = usable[gis]
+    if not np.all(keep):
+        print("warning: dropping {} mlf.log entries which don't match the "
+            "rundata".format(np.count_nonzero(~keep)))
+    gis, end_cycle, wait_cycle = gis[keep], end_cycle[keep], wait_cycle[keep]
+    index = rundata.num_meas[gis] - counts[gis] + entry[keep]
+
+    freqs, freq_lens = rundata.freq_history()
+    meas, meas_lens = rundata.meas_history()
+    freq_starts = np.cumsum(freq_lens) - freq_lens
+    meas_starts = np.cumsum(meas_lens) - meas_lens
+    return (gis, freqs[freq_starts[gis] + index], end_cycle, wait_cycle,
+        meas["num_nmis"][meas_starts[gis] + index])
+
+# index of the first take[i] of each group's lens[i] entries in a ragged array
+def _ragged_index(lens, take):
+    starts = np.cumsum(lens) - lens
+    take_starts = np.cumsum(take) - take
+    return np.repeat(starts - take_starts, take) + np.arange(np.sum(take))
+
+class GroupModel:
+    # fit the model to samples (see rundata_samples). groups is the rundata's
+    # group array and a_freq is the nominal APU frequency, which groups we know
+    # nothing about are assumed to have been measured at.
+    def __init__(self, groups, samples, f_cyc, a_freq):
+        self.groups = groups
+        self.f_cyc = f_cyc
+        num_groups = len(groups)
+
+        gis, freqs, end_cycle, wait_cycle, num_nmis = samples
+        # samples from a desynced group are nonsense
+        good = num_nmis == groups["num_nmis"][gis]
+        gis, freqs = gis[good], freqs[good]
+        ex_end_cycle = groups["ex_end_cycle"][gis]
+        end_dev = (end_cycle[good] - ex_end_cycle).astype(np.float64)
+        wait_dev = (wait_cycle[good] - ex_end_cycle).astype(np.float64)
+
+        order = np.argsort(gis, kind="stable")
+        gis, freqs = gis[order], freqs[order]
+        end_dev, wait_dev = end_dev[order], wait_dev[order]
+        lens = np.bincount(gis, minlength=num_groups)
+        self.num_samples = lens
+
+        # groups without any samples are where the emulator says they are
+        mean_freq = np.full(num_groups, float(a_freq))
+        mean_end = np.zeros(num_groups)
+        mean_wait = (groups["ex_wait_cycle"] -
+            groups["ex_end_cycle"]).astype(np.float64)
+        has = lens > 0
+        mean_freq[has] = np.bincount(gis, freqs, num_groups)[has]/lens[has]
+        mean_end[has] = np.bincount(gis, end_dev, num_groups)[has]/lens[has]
+        mean_wait[has] = np.bincount(gis, wait_dev, num_groups)[has]/lens[has]
+
+        # groups without enough different frequencies to fit get the typical
+        # slope of the others
+        self.end_slope = self._fit_slope(freqs, end_dev, lens)
+        self.wait_slope = self._fit_slope(freqs, wait_dev, lens)
+        self.end_icpt = mean_end - self.end_slope*mean_freq
+        self.wait_icpt = mean_wait - self.wait_slope*mean_freq
+
+        # noise is the typical residual of the groups with enough samples to
+        # have one
+        resid = wait_dev - (self.wait_slope[gis]*freqs + self.wait_icpt[gis])
+        has_resid = (lens >= 3)[gis]
+        if np.any(has_resid):
+            self.noise = float(np.sqrt(np.mean(resid[has_resid]**2)))
+        else:
+            self.noise = 0.0
+
+    def _fit_slope(self, x, y, lens):
+        slope, _, _ = fit_segments(x, y, lens)
+        fitted = ~np.isnan(slope)
+        typical = np.median(slope[fitted]) if np.any(fitted) else 0.0
+        return np.where(fitted, slope, typical)
+
+    # "measure" every group at the given frequencies. returns (end_cycle,
+    # wait_cycle, num_nmis) arrays.
+    def measure(self, freqs, rng):
+        noise = rng.normal(0, self.noise, (2, len(freqs)))
+        ex_end_cycle = self.groups["ex_end_cycle"]
+        end_cycle = ex_end_cycle + np.round(
+            self.end_slope*freqs + self.end_icpt + noise[0]).astype(np.int64)
+        wait_cycle = ex_end_cycle + np.round(
+            self.wait_slope*freqs + self.wait_icpt + noise[1]).astype(np.int64)
+        wait_cycle = np.minimum(wait_cycle, end_cycle)
+
+        num_nmis = self.groups["num_nmis"].copy()
+        idle = end_cycle - wait_cycle
+        num_nmis[idle <= 0] += 1 # got 100% busy and so needed another NMI
+        num_nmis[idle >= self.f_cyc] -= 1 # finished a whole NMI early
+        return end_cycle, wait_cycle, np.maximum(num_nmis, 1)
+
+# settings for the rest of the iteration, i.e. balancing
+SimSettings = namedtuple("SimSettings", ["m_freq", "a_freq"])
+
+# what happened in one virtual iteration
+IterStats = namedtuple("IterStats", [
+    "reached", # number of groups measured before (and including) a desync
+    "desynced", # whether the run desynced
+    "too_close", # groups that got too close to a frame boundary
+    "fixed", # groups that were given new frequencies before the run
+    "surplus", # cycles left over after balancing
+])
+
+class Simulator:
+    # rundata is the starting point. it's copied, so it isn't changed. if
+    # from_scratch, its history is thrown away and the simulation starts like
+    # a freshly created rundata.
+    def __init__(self, rundata, model, fix_settings, sim_settings,
+            from_scratch=True, seed=None):
+        if from_scratch:
+            self.rundata = RunData(rundata.groups.copy())
+        else:
+            self.rundata = rundata.copy()
+        self.model = model
+        self.fix_settings = fix_settings
+        self.sim_settings = sim_settings
+        self.rng = np.random.default_rng(seed)
+        self.group_cols = group_columns(self.rundata.groups,
+            fix_settings.min_apu_accesses)
+
+    def iterate(self):
+        rd = self.rundata
+        fs = self.fix_settings
+        fix = fix_problems(rd, fs, self.rng, verbose=False)
+
+        actual, _, _, surplus = balance_cycles(rd.last_freq,
+            self.group_cols.latch_clocks, self.group_cols.should_balance,
+            fs.min_freq, fs.max_freq,
+            self.sim_settings.m_freq, self.sim_settings.a_freq)
+        rd.set_next_freqs(np.arange(len(actual)), actual)
+
+        end_cycle, wait_cycle, num_nmis = self.model.measure(actual, self.rng)
+        desync = num_nmis != rd.groups["num_nmis"]
+        desynced = bool(np.any(desync))
+        reached = int(np.argmax(desync))+1 if desynced else len(desync)
+        rd.add_measurements(np.arange(reached), end_cycle[:reached],
+            wait_cycle[:reached], num_nmis[:reached])
+
+        busy = (fs.f_cyc-end_cycle[:reached]+wait_cycle[:reached])/fs.f_cyc*100
+        closeness = 50-np.abs(busy-50)
+        too_close = (closeness < fs.nmi_close) & ~desync[:reached] & \
+            (rd.groups["apu_accesses"][:reached] >= fs.min_apu_accesses)
+
+        return IterStats(reached, desynced, int(np.count_nonzero(too_close)),
+            fix.predicted+fix.guessed, surplus)
+
+    # iterate until a run makes it all the way through without any problems,
+    # or max_iterations pass. returns a list of IterStats.
+    def run(self, max_iterations):
+        history = []
+        for i in range(max_iterations):
+            stats = self.iterate()
+            history.append(stats)
+            if not stats.desynced and stats.too_close == 0:
+                break
+        return history
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate autosync offline.")
+    parser.add_argument("rundata", type=str,
+        help="rundata store or JSON file with measurements to model")
+    parser.add_argument("--mlf", type=str,
+        help="fit the model to this session's mlf.log instead of the whole "
+            "rundata history")
+    parser.add_argument("-t", "--trials", type=int, default=10,
+        help="number of simulated autosync sessions")
+    parser.add_argument("-i", "--iterations", type=int, default=100,
+        help="most iterations to try in each session")
+    parser.add_argument("-c", "--continue", dest="cont", action="store_true",
+        help="start from the rundata's history instead of from scratch")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+        help="random seed")
+
+    parser.add_argument("--f-cyc", type=int, default=357366,
+        help="master clock cycles per frame")
+    parser.add_argument("--m-freq", type=float, default=21.477272,
+        help="nominal master clock frequency (MHz)")
+    parser.add_argument("--a-freq", type=float, default=24.607104,
+        help="nominal APU clock frequency (MHz)")
+    parser.add_argument("--min-apu-accesses", type=int, default=12)
+    parser.add_argument("--nmi-close", type=float, default=10)
+    parser.add_argument("--nmi-close-target", type=float, default=20)
+    parser.add_argument("--min-freq", type=float, default=14)
+    parser.add_argument("--max-freq", type=float, default=24.75)
+
+    args = parser.parse_args()
+
+    rundata = load_rundata(args.rundata)
+    if args.mlf is not None:
+        samples = mlf_samples(load_mlf(args.mlf), rundata)
+    else:
+        samples = rundata_samples(rundata)
+    model = GroupModel(rundata.groups, samples, args.f_cyc, args.a_freq)
+    print("fit {} groups from {} samples, noise {:.1f} cycles".format(
+        np.count_nonzero(model.num_samples), len(samples[0]), model.noise))
+
+    fix_settings = FixSettings(f_cyc=args.f_cyc,
+        min_apu_accesses=args.min_apu_accesses,
+        nmi_close=args.nmi_close, nmi_close_target=args.nmi_close_target,
+        min_freq=args.min_freq, max_freq=args.max_freq,
+        default_freq=calculate_advanced(args.a_freq)[2])
+    sim_settings = SimSettings(m_freq=args.m_freq, a_freq=args.a_freq)
+
+    seeds = np.random.SeedSequence(args.seed).spawn(args.trials)
+    num_groups = len(rundata.groups)
+    converged_after = []
+    total_iterations = 0
+    start = time.monotonic()
+    for trial, seed in enumerate(seeds):
+        sim = Simulator(rundata, model, fix_settings, sim_settings,
+            from_scratch=not args.cont, seed=seed)
+        history = sim.run(args.iterations)
+        total_iterations += len(history)
+        last = history[-1]
+        if not last.desynced and last.too_close == 0:
+            converged_after.append(len(history))
+            result = "converged after {} iterations".format(len(history))
+        else:
+            furthest = max(h.reached for h in history)
+            result = "didn't converge, furthest {}/{} groups".format(
+                furthest, num_groups)
+        print("trial {}: {}".format(trial, result))
+    elapsed = time.monotonic() - start
+
+    print()
+    print("converged in {}/{} trials".format(
+        len(converged_after), args.trials))
+    if len(converged_after) > 0:
+        print("iterations to converge: mean {:.1f}, median {:.0f}, "
+            "max {}".format(np.mean(converged_after),
+                np.median(converged_after), max(converged_after)))
+    print("{} virtual iterations in {:.2f}s ({:.1f} per second)".format(
+        total_iterations, elapsed, total_iterations/elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+# test reading measure_emulator.lua logs
+
+from .build import LOG_GREETING, read_emulator_log
+
+import os
+import tempfile
+import unittest
+
+# a small log with a latch, an NMI with one extra field, and another latch
+LOG = LOG_GREETING + b"""c,21477272,21500000
+l,0,10,20
+n,0,230,40,1,5,100,3,4,5,6,7
+l,1,12,340
+"""
+
+class TestBuild(unittest.TestCase):
+    def read_log(self, data, chunk_size):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            return read_emulator_log(path, extra_fields=("extra",),
+                chunk_size=chunk_size)
+        finally:
+            os.remove(path)
+
+    # the log should come out the same no matter where the chunks split it,
+    # including when a line is longer than a whole chunk
+    def check_chunk_sizes(self, data):
+        freqs, latches, nmis = self.read_log(data, 1024)
+        self.assertEqual(freqs, [21477272, 21500000])
+        self.assertEqual(len(latches), 2)
+        self.assertEqual(len(nmis), 1)
+        self.assertEqual(nmis["extra"].tolist(), [7])
+
+        body_len = len(data) - data.index(b"\n", len(LOG_GREETING)) - 1
+        for chunk_size in [*range(1, 16), body_len-2, body_len-1]:
+            with self.subTest(chunk_size=chunk_size):
+                got_freqs, got_latches, got_nmis = \
+                    self.read_log(data, chunk_size)
+                self.assertEqual(got_freqs, freqs)
+                self.assertEqual(got_latches.tolist(), latches.tolist())
+                self.assertEqual(got_nmis.tolist(), nmis.tolist())
+
+    def test_chunk_sizes(self):
+        self.check_chunk_sizes(LOG)
+
+    def test_chunk_sizes_no_final_newline(self):
+        self.check_chunk_sizes(LOG.rstrip(b"\n"))
+
+if __name__ == "__main__":
+    unittest.main()
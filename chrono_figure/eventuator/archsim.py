@@ -0,0 +1,425 @@
+# instruction level simulator of the eventuator. it executes assembled programs
+# with the same results as the gateware, but runs against a whole stream of
+# matches in the time the gateware simulation takes for a few of them, so
+# programs for entire games can be developed and profiled quickly.
+
+# it models the architecture, not the timing: each match's handler runs to
+# completion before the next match is taken, as if the match FIFO never
+# overflows, and the event FIFO never fills up. the match timers only depend
+# on the matches' cycle counts so they work as they do in the gateware,
+# including that reading any of them gives timer 0's value.
+# special register addresses which aren't in the special map read as 0 and
+# ignore writes (the gateware aliases some of them to other registers).
+
+# usage: python3 -m chrono_figure.eventuator.archsim [-h] ...
+#   benchmark the simulator by running the fixed function measurement program
+#   against synthetic or recorded matches.
+
+import time
+
+import numpy as np
+
+from .isa import *
+from ..gateware.match_info import *
+
+class ArchSimError(Exception): pass
+
+# one match from the match engine, as fed to ArchSim.run_matches()
+MATCH_DTYPE = np.dtype([
+    ("match_type", np.uint8),
+    ("cycle_count", np.uint32),
+    ("addr", np.uint32),
+    ("data", np.uint8),
+])
+
+_M = 2**DATA_WIDTH-1
+NUM_TIMERS = 3
+
+# the special registers that just hold a value live in one list, indexed by
+# these. the match info and timer values are kept there too since reading them
+# is the same, and so are the possible ALU B inputs.
+_S_TMPA, _S_TMPB, _S_B0, _S_B1, _S_IMM = range(5)
+_S_MATCH = 5 # type, cycle count, address, data
+_S_MTIM = 9 # timer values
+_S_ZERO, _S_ONE = 12, 13
+_NUM_S = 14
+
+_READ_SLOTS = {
+    int(SplR.TMPA): _S_TMPA, int(SplR.TMPB): _S_TMPB,
+    int(SplR.IMM_VAL): _S_IMM,
+    int(SplR.MATCH_TYPE): _S_MATCH+0, int(SplR.MATCH_CYCLE_COUNT): _S_MATCH+1,
+    int(SplR.MATCH_ADDR): _S_MATCH+2, int(SplR.MATCH_DATA): _S_MATCH+3,
+    # the match timer unit decodes its read address combinatorially on the
+    # cycle after the read, when the core's read address is always 0 (the
+    # instruction it fetched from address 0), so every timer reads as timer 0
+    int(SplR.MTIM0_VAL): _S_MTIM+0, int(SplR.MTIM1_VAL): _S_MTIM+0,
+    int(SplR.MTIM2_VAL): _S_MTIM+0,
+}
+_WRITE_SLOTS = {
+    int(SplW.TMPA): _S_TMPA, int(SplW.TMPB): _S_TMPB,
+    int(SplW.ALU_B0): _S_B0, int(SplW.ALU_B1): _S_B1,
+}
+_IMM_BYTES = {int(SplW.IMM_B0): 0, int(SplW.IMM_B1): 1, int(SplW.IMM_B2): 2,
+    int(SplW.IMM_B3): 3}
+_MOD_OFFSETS = {int(SplW.MOFF_RD_TEMP): (0, False),
+    int(SplW.MOFF_WR_TEMP): (1, False), int(SplW.MOFF_RD_HOLD): (0, True),
+    int(SplW.MOFF_WR_HOLD): (1, True)}
+_TIMER_CTLS = {int(SplW.MTIM0_CTL): 0, int(SplW.MTIM1_CTL): 1,
+    int(SplW.MTIM2_CTL): 2}
+
+# decoded instruction kinds, roughly in order of how common they are
+(_K_ALU, _K_BRANCH, _K_READ, _K_WRITE, _K_POKE, _K_WRITE_OTHER,
+    _K_POKE_OTHER, _K_POKE_IMM, _K_READ_FLAGS, _K_READ_CONST,
+    _K_MOVE) = range(11)
+
+# ALU operations, from the low bits of the mod code. the undefined operations
+# pass A through like the gateware does.
+_ALU_AND, _ALU_OR, _ALU_XOR, _ALU_ADD, _ALU_SUB, _ALU_SHIFT = 0, 1, 2, 4, 5, 6
+_B_SLOTS = (_S_ZERO, _S_ONE, _S_B0, _S_B1)
+
+# for each condition, whether the branch is taken for each of the 16 possible
+# flag values
+def _cond_table(cond):
+    table = []
+    for flags in range(16):
+        z, s, c, v = (flags >> bit & 1 for bit in range(4))
+        taken = (1, (c ^ 1) | z, s ^ v, (s ^ v) | z, z, s, c, v)[cond >> 1]
+        table.append(bool(taken ^ (cond & 1)))
+    return tuple(table)
+_COND_TABLES = {cond: _cond_table(cond) for cond in range(2**COND_WIDTH)}
+del _cond_table
+
+# calculate the flags (in alu.Flags order) the ALU would from an operation's X
+# and Y inputs, their sum (with carry in), and the output
+def _alu_flags(x, y, t, o):
+    return ((o == 0) | ((o >> 31) << 1) | ((t >> 32 & 1) << 2) |
+        ((((x ^ o) & (y ^ o)) >> 31) << 3))
+
+class ArchSim:
+    def __init__(self, prg_d=1024, reg_d=256):
+        if prg_d & (prg_d-1) or reg_d & (reg_d-1):
+            raise ValueError("memory depths must be powers of 2")
+        self.prg_mem = [0]*prg_d
+        self.reg_mask = reg_d-1
+        self._code = None # decoded program memory, None if it changed
+
+        self.regs = [0]*reg_d
+        self.events = [] # words written to the event FIFO
+        self.match_config = bytearray(4*NUM_MATCHERS)
+        self.match_config_addr = 0
+        self.match_enable = False
+
+        self._spl = [0]*_NUM_S
+        self._spl[_S_ONE] = 1
+        # flags are calculated only when needed from the last ALU operation
+        self._flags = 0
+        self._alu = (0, 0, 0, 0)
+        self._branch_ind = None # pending indirect branch target
+        self._mod_offsets = (0, 0, True) # read offset, write offset, hold
+        self._timer_running = [False]*NUM_TIMERS
+        self._timer_oneshot = [False]*NUM_TIMERS
+        self._last_match = 0
+
+        self.insns = 0 # total instructions executed
+        self.dropped_matches = 0 # matches that came when they weren't enabled
+
+    # write words to program memory starting at the given address. like the
+    # gateware, address 0 can't be written and stays BRANCH(0).
+    def load(self, words, start_pc=1):
+        prg_d = len(self.prg_mem)
+        for addr, word in enumerate(words, start_pc):
+            if addr % prg_d != 0:
+                self.prg_mem[addr % prg_d] = int(word)
+        self._code = None
+
+    @property
+    def flags(self):
+        if self._flags < 0:
+            self._flags = _alu_flags(*self._alu)
+        return self._flags
+
+    # stop execution, which disables matches until a program enables them again
+    def stop(self):
+        self.match_enable = False
+
+    # run the program at the given pc until it stops. returns how many
+    # instructions it executed.
+    def start(self, pc, max_insns=2**24):
+        self._mod_offsets = (0, 0, True)
+        return self._execute(pc, max_insns)
+
+    # run the handler for each match (an array of MATCH_DTYPE or an iterable of
+    # (match_type, cycle_count, addr, data) tuples) in order. returns the words
+    # the handlers wrote to the event FIFO and how many instructions each
+    # handler executed (0 for dropped matches) as numpy arrays.
+    def run_matches(self, matches, max_insns=2**24):
+        if isinstance(matches, np.ndarray):
+            matches = matches.tolist()
+        first_event = len(self.events)
+        spl = self._spl
+        running = self._timer_running
+        oneshot = self._timer_oneshot
+        handler_insns = []
+        for match_type, cycle_count, addr, data in matches:
+            if not self.match_enable:
+                self.dropped_matches += 1
+                handler_insns.append(0)
+                continue
+            # update the timers with the cycles since the last match
+            passed = (cycle_count - self._last_match) & _M
+            self._last_match = cycle_count
+            for timer in range(NUM_TIMERS):
+                if running[timer] or oneshot[timer]:
+                    spl[_S_MTIM+timer] = (spl[_S_MTIM+timer] + passed) & _M
+                    oneshot[timer] = False
+            spl[_S_MATCH:_S_MATCH+4] = match_type, cycle_count, addr, data
+            self._mod_offsets = (0, 0, True)
+            handler_insns.append(
+                self._execute((match_type << 3) | 4, max_insns))
+
+        events = np.array(self.events[first_event:], dtype=np.uint32)
+        return events, np.array(handler_insns, dtype=np.uint32)
+
+    # decode program memory into a tuple per pc, which is much faster to
+    # execute than picking apart the words every time
+    def _decode(self):
+        prg_d = len(self.prg_mem)
+        decoded = {}
+        code = []
+        for pc in range(2**PC_WIDTH):
+            word = self.prg_mem[pc % prg_d]
+            insn = decoded.get(word)
+            if insn is None:
+                insn = self._decode_insn(word, pc)
+                if insn[0] != _K_READ_CONST: # CURR_PC reads differ per pc
+                    decoded[word] = insn
+            code.append(insn)
+        # the pc wraps around after the end. address 0 always holds BRANCH(0)
+        # so it won't go any further.
+        code.append(code[0])
+        return code
+
+    def _decode_insn(self, word, pc):
+        code = word >> 16
+        if code == InsnCode.BRANCH:
+            cond = (word >> PC_WIDTH) & (2**COND_WIDTH-1)
+            table = None if cond == Cond.ALWAYS else _COND_TABLES[cond]
+            return (_K_BRANCH, table, word & (2**PC_WIDTH-1))
+
+        flag = (word >> 15) & 1
+        special = (word >> 8) & (2**SPL_WIDTH-1)
+        reg = word & 0xFF
+        if code == InsnCode.MODIFY:
+            reg &= self.reg_mask
+            mod = (flag << 7) | special
+            if mod & 0xC0 != 0xC0: # not an ALU operation, write data back
+                return (_K_MOVE, reg)
+            return (_K_ALU, reg, mod & 7, _B_SLOTS[(mod >> 3) & 3],
+                (mod >> 3) & 3, bool(mod & 0x20))
+
+        if code == InsnCode.COPY and not flag: # special -> register
+            reg &= self.reg_mask
+            if special == SplR.ALU_FLAGS:
+                return (_K_READ_FLAGS, reg)
+            elif special == SplR.CURR_PC:
+                return (_K_READ_CONST, reg, pc)
+            return (_K_READ, reg, _READ_SLOTS.get(special, _S_ZERO))
+
+        if code == InsnCode.COPY: # register -> special
+            reg &= self.reg_mask
+            if special in _WRITE_SLOTS:
+                return (_K_WRITE, reg, _WRITE_SLOTS[special])
+            return (_K_WRITE_OTHER, reg, special)
+
+        # POKE: sign extend the 9 bit value
+        val = (reg | (0xFFFFFF00 if flag else 0)) & _M
+        if special in _WRITE_SLOTS:
+            return (_K_POKE, val, _WRITE_SLOTS[special])
+        elif special in _IMM_BYTES: # precalculate the immediate update
+            shift = 8*_IMM_BYTES[special]
+            return (_K_POKE_IMM, (1 << shift)-1, (val << shift) & _M)
+        return (_K_POKE_OTHER, val, special)
+
+    def _execute(self, pc, max_insns):
+        if self._code is None:
+            self._code = self._decode()
+        code = self._code
+        regs = self.regs
+        reg_mask = self.reg_mask
+        spl = self._spl
+        events = self.events
+        flags = self._flags
+        alu_x, alu_y, alu_t, alu_o = self._alu
+        branch_ind = self._branch_ind
+        moff_rd, moff_wr, moff_hold = self._mod_offsets
+        moff = bool(moff_rd or moff_wr)
+
+        stopped = False
+        for insns in range(1, max_insns+1):
+            insn = code[pc]
+            kind = insn[0]
+            pc += 1
+            if kind == _K_ALU:
+                _, reg, op, b_slot, shift, store = insn
+                if moff:
+                    rd_reg = (reg + moff_rd) & reg_mask
+                    wr_reg = (reg + moff_wr) & reg_mask
+                    if not moff_hold:
+                        moff_rd, moff_wr, moff_hold, moff = 0, 0, True, False
+                else:
+                    rd_reg = wr_reg = reg
+                alu_x = a = regs[rd_reg]
+                if op == _ALU_SHIFT: # output is the shifted value
+                    if shift & 1: # right
+                        alu_o = (a >> 1) | ((a & (shift >> 1)) << 31)
+                    else: # left
+                        alu_o = ((a << 1) & _M) | ((a >> 31) & (shift >> 1))
+                    alu_y = alu_o
+                    alu_t = a + alu_o
+                else:
+                    b = spl[b_slot]
+                    alu_y = 0
+                    if op == _ALU_ADD:
+                        alu_y = b
+                        alu_t = a + b
+                    elif op == _ALU_SUB: # A + ~B + 1
+                        alu_y = b ^ _M
+                        alu_t = a + alu_y + 1
+                    elif op == _ALU_AND:
+                        alu_x = alu_t = a & b
+                    elif op == _ALU_OR:
+                        alu_x = alu_t = a | b
+                    elif op == _ALU_XOR:
+                        alu_x = alu_t = a ^ b
+                    else:
+                        alu_t = a
+                    alu_o = alu_t & _M
+                flags = -1
+                if store:
+                    regs[wr_reg] = alu_o
+            elif kind == _K_BRANCH:
+                _, table, dest = insn
+                if branch_ind is not None:
+                    dest, branch_ind = branch_ind, None
+                if table is not None:
+                    if flags < 0:
+                        flags = _alu_flags(alu_x, alu_y, alu_t, alu_o)
+                    if not table[flags]:
+                        continue
+                if dest == 0:
+                    stopped = True
+                    break
+                pc = dest
+            elif kind == _K_READ:
+                regs[insn[1]] = spl[insn[2]]
+            elif kind == _K_WRITE:
+                spl[insn[2]] = regs[insn[1]]
+            elif kind == _K_POKE:
+                spl[insn[2]] = insn[1]
+            elif kind == _K_POKE_IMM:
+                spl[_S_IMM] = (spl[_S_IMM] & insn[1]) | insn[2]
+            elif kind == _K_WRITE_OTHER or kind == _K_POKE_OTHER:
+                special = insn[2]
+                val = regs[insn[1]] if kind == _K_WRITE_OTHER else insn[1]
+                if special == SplW.EVENT_FIFO:
+                    events.append(val)
+                elif special in _IMM_BYTES:
+                    shift = 8*_IMM_BYTES[special]
+                    ext = val & 0xFF | (0xFFFFFF00 if val & 0x100 else 0)
+                    spl[_S_IMM] = (spl[_S_IMM] & ((1 << shift)-1)) | \
+                        ((ext << shift) & _M)
+                elif special == SplW.ALU_FLAGS: # set takes precedence
+                    if flags < 0:
+                        flags = _alu_flags(alu_x, alu_y, alu_t, alu_o)
+                    flags = (flags & (val >> 4)) & 0xF | (val & 0xF)
+                elif special in _MOD_OFFSETS:
+                    which, moff_hold = _MOD_OFFSETS[special]
+                    if which == 0:
+                        moff_rd = val & 0xFF
+                    else:
+                        moff_wr = val & 0xFF
+                    moff = bool(moff_rd or moff_wr)
+                elif special == SplW.BRANCH_IND_TARGET:
+                    branch_ind = val & (2**PC_WIDTH-1)
+                elif special == SplW.MATCH_CONFIG_ADDR:
+                    self.match_config_addr = val & 0x3FF
+                elif special == SplW.MATCH_CONFIG_DATA:
+                    addr = self.match_config_addr
+                    if addr < len(self.match_config):
+                        self.match_config[addr] = val & 0xFF
+                    self.match_config_addr = (addr + 1) & 0x3FF
+                elif special == SplW.MATCH_ENABLE:
+                    self.match_enable = True
+                elif special in _TIMER_CTLS:
+                    timer = _TIMER_CTLS[special]
+                    if val & 1:
+                        spl[_S_MTIM+timer] = 0
+                    self._timer_running[timer] = bool(val & 2)
+                    self._timer_oneshot[timer] = bool(val & 4)
+            elif kind == _K_READ_FLAGS:
+                if flags < 0:
+                    flags = _alu_flags(alu_x, alu_y, alu_t, alu_o)
+                regs[insn[1]] = flags
+            elif kind == _K_READ_CONST:
+                regs[insn[1]] = insn[2]
+            elif moff: # _K_MOVE, which only does anything with offsets
+                reg = insn[1]
+                regs[(reg + moff_wr) & reg_mask] = \
+                    regs[(reg + moff_rd) & reg_mask]
+                if not moff_hold:
+                    moff_rd, moff_wr, moff_hold, moff = 0, 0, True, False
+
+        self._flags = flags
+        self._alu = (alu_x, alu_y, alu_t, alu_o)
+        self._branch_ind = branch_ind
+        self._mod_offsets = (moff_rd, moff_wr, moff_hold)
+        self.insns += insns
+        if not stopped:
+            raise ArchSimError("program did not stop after {} "
+                "instructions".format(max_insns))
+        return insns
+
+# generate synthetic matches like the fixed function program expects: a reset,
+# then for each frame an NMI, the end of its wait, and the start of the next
+# one after busy (0 to 1) of the frame has passed
+def synthetic_matches(num_frames, f_cyc=357366, busy=0.5):
+    matches = np.zeros(1+3*num_frames, dtype=MATCH_DTYPE)
+    matches[0]["match_type"] = MATCH_TYPE_RESET
+    nmi_cycles = np.arange(num_frames, dtype=np.uint32)*f_cyc + 1000
+    for offset, match_type, cycles in ((1, MATCH_TYPE_NMI, nmi_cycles),
+            (2, MATCH_TYPE_WAIT_END, nmi_cycles+50),
+            (3, MATCH_TYPE_WAIT_START, nmi_cycles+int(busy*f_cyc))):
+        matches[offset::3]["match_type"] = match_type
+        matches[offset::3]["cycle_count"] = cycles
+    return matches
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the eventuator instruction level simulator.")
+    parser.add_argument('--frames', type=int, default=100000,
+        help="Number of synthetic frames to run.")
+    parser.add_argument('--matches', type=str, default=None,
+        help="Run the matches recorded in this .npy file of MATCH_DTYPE "
+            "instead of synthetic ones.")
+    args = parser.parse_args()
+
+    if args.matches is not None:
+        matches = np.load(args.matches)
+    else:
+        matches = synthetic_matches(args.frames)
+
+    # the program the host measures with by default
+    from ..host.interface import FIXED_FUNCTION_PROGRAM
+    sim = ArchSim()
+    sim.load(FIXED_FUNCTION_PROGRAM)
+    sim.start(1)
+
+    start = time.monotonic()
+    events, handler_insns = sim.run_matches(matches)
+    elapsed = time.monotonic() - start
+    print("{} matches -> {} event words in {:.2f}s".format(
+        len(matches), len(events), elapsed))
+    print("{:.2f} million instructions/s, at most {} per handler".format(
+        handler_insns.sum()/elapsed/1e6, handler_insns.max()))
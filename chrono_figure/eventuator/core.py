@@ -12,6 +12,8 @@ class ProgramControl(Elaboratable):
         self.o_ctl_run = Signal() # currently running
         self.i_ctl_stop = Signal() # stop execution now
         self.i_ctl_pause = Signal() # stop advancing the PC
+        self.o_ctl_pending = Signal() # waiting to start once stopped
+        self.o_ctl_started = Signal() # starting at the new PC this cycle
 
         self.i_branch = Signal() # execute branch this cycle
         self.i_branch_target = Signal(PC_WIDTH)
@@ -66,27 +68,38 @@ class ProgramControl(Elaboratable):
         m.d.comb += self.o_ctl_run.eq(~(stopping | stopped))
         m.d.sync += stopped.eq(stopping | stopped)
 
-        was_start = Signal()
-        start_pc = Signal(PC_WIDTH)
+        # we can only start once the processor stops, so remember a start
+        # request (and where to) until then. this lets a new program be started
+        # while the current one is finishing up.
+        pending_start = Signal()
+        pending_pc = Signal(PC_WIDTH)
         was_stop = Signal()
-        m.d.sync += [
-            was_start.eq(self.i_ctl_start),
-            was_stop.eq(self.i_ctl_stop),
-            start_pc.eq(self.i_ctl_pc),
-        ]
+        m.d.sync += was_stop.eq(self.i_ctl_stop)
         do_start = Signal()
         do_stop = Signal()
         m.d.comb += [
-            do_start.eq(self.i_ctl_start | was_start),
+            do_start.eq(self.i_ctl_start | pending_start),
             do_stop.eq(self.i_ctl_stop | was_stop),
+            self.o_ctl_pending.eq(pending_start),
+            self.o_ctl_started.eq(cyc_wr & stopping & do_start),
         ]
+        with m.If(self.o_ctl_started):
+            m.d.sync += pending_start.eq(0) # starting now (see below)
+        with m.Elif(do_stop):
+            m.d.sync += pending_start.eq(0) # stopping cancels the start
+        with m.Elif(self.i_ctl_start):
+            m.d.sync += [
+                pending_start.eq(1),
+                pending_pc.eq(self.i_ctl_pc),
+            ]
 
         # figure out where to fetch them from
         with m.If(cyc_wr):
             # are we being asked to start?
             with m.If(stopping & do_start):
                 # yes, set the PC to the new value and start again
-                m.d.comb += next_pc.eq(Mux(was_start, start_pc, self.i_ctl_pc))
+                m.d.comb += next_pc.eq(
+                    Mux(self.i_ctl_start, self.i_ctl_pc, pending_pc))
                 m.d.sync += stopped.eq(0)
             with m.Elif(do_stop): # do we want to stop?
                 # yes, go to the stop address
@@ -109,6 +122,8 @@ class EventuatorCore(Elaboratable):
         self.o_ctl_run = Signal() # currently running
         self.i_ctl_stop = Signal() # stop execution now
         self.i_ctl_pause = Signal() # stop advancing the PC
+        self.o_ctl_pending = Signal() # waiting to start once stopped
+        self.o_ctl_started = Signal() # starting at the new PC this cycle
         
         # program memory access signals
         # (read is always enabled, even when stopped)
@@ -161,6 +176,8 @@ class EventuatorCore(Elaboratable):
             self.o_ctl_run.eq(prg_ctl.o_ctl_run),
             prg_ctl.i_ctl_stop.eq(self.i_ctl_stop),
             prg_ctl.i_ctl_pause.eq(self.i_ctl_pause),
+            self.o_ctl_pending.eq(prg_ctl.o_ctl_pending),
+            self.o_ctl_started.eq(prg_ctl.o_ctl_started),
 
             self.o_prg_addr.eq(prg_ctl.o_prg_addr),
             prg_ctl.i_prg_data.eq(self.i_prg_data),
@@ -84,7 +84,10 @@ class Eventuator(Elaboratable):
             core.i_ctl_start.eq(self.i_ctl_start | ctl_start),
             core.i_ctl_pc.eq(Mux(self.i_ctl_start, self.i_ctl_pc, ctl_pc)),
 
-            ctl_start.eq(~core.o_ctl_run & self.i_match_valid & ~did_start),
+            # an external start (e.g. switching programs) goes first. the match
+            # stays in the FIFO until the started program stops.
+            ctl_start.eq(~core.o_ctl_run & self.i_match_valid & ~did_start
+                & ~self.i_ctl_start & ~core.o_ctl_pending),
             ctl_pc.eq((self.i_match_info.match_type << 3) | 4),
             self.o_match_re.eq(ctl_start),
         ]
@@ -141,7 +144,7 @@ class Eventuator(Elaboratable):
             core.i_mod_offset_rd.eq(self.spl_mod_offset.o_mod_offset_rd),
             core.i_mod_offset_wr.eq(self.spl_mod_offset.o_mod_offset_wr),
             self.spl_mod_offset.i_mod.eq(core.o_mod),
-            self.spl_mod_offset.i_ctl_start.eq(core.i_ctl_start),
+            self.spl_mod_offset.i_ctl_start.eq(core.o_ctl_started),
             # branch indirect
             core.i_branch_ind.eq(self.spl_branch_ind.o_branch_ind),
             core.i_branch_ind_target.eq(self.spl_branch_ind.o_branch_ind_target),
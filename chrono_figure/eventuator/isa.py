@@ -240,10 +240,14 @@ class L(Insn):
         else:
             return "L({!r}, org={})".format(self.label, self.location)
 
-def ev_assemble(program_in, start_pc=1, return_labels=False):
+def ev_assemble(program_in, start_pc=1, return_labels=False, optimize=False):
     if start_pc < 1 or start_pc >= 2**PC_WIDTH:
         raise ValueError("start PC {} is out of range".format(start_pc))
 
+    if optimize: # run it through the peephole optimizer first
+        from .optimize import ev_optimize
+        program_in = ev_optimize(program_in)
+
     pc = start_pc
     last_nonlocal = ""
     labels = {}
@@ -258,7 +262,9 @@ def ev_assemble(program_in, start_pc=1, return_labels=False):
         if isinstance(instruction, BRANCH):
             b = BRANCH(instruction.dest, instruction.cond)
             # delocalize local labels by appending the last non-local label
-            if isinstance(b.dest, str) and b.dest[0] == "_":
+            # (unless that's already been done, e.g. by ev_optimize)
+            if isinstance(b.dest, str) and b.dest[0] == "_" and \
+                    "@" not in b.dest:
                 b.dest = "{}@{}".format(b.dest, last_nonlocal)
             program.append(b)
         elif isinstance(instruction, COPY):
@@ -274,7 +280,7 @@ def ev_assemble(program_in, start_pc=1, return_labels=False):
             l = L(instruction.label, org=instruction.location)
             if not l.local:
                 last_nonlocal = l.label
-            else: # delocalize the local label
+            elif "@" not in l.label: # delocalize the local label
                 l.label = "{}@{}".format(l.label, last_nonlocal)
             if l.location is None: # set its location if not already given
                 l.location = pc
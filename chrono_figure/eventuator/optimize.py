@@ -0,0 +1,440 @@
+# peephole optimizer for eventuator programs. it works on the list of Insns and
+# labels before assembly, so use it through ev_assemble(prg, optimize=True) or
+# call ev_optimize() directly to see what it saved.
+
+# the passes are run until none of them can do any more:
+# * branch threading: branches to unconditional branches (or to branches with
+#   the same condition) go straight to the final destination. branches that
+#   would go to the next instruction anyway and NEVER branches are removed.
+# * dead code removal: instructions after an unconditional branch that no
+#   label leads to are removed.
+# * redundant copy elimination: COPYs and POKEs which store the value their
+#   destination already has are removed, as are ones whose value is always
+#   overwritten before being read.
+# * constant materialization reuse: runs of IMM_Bn POKEs are replaced with the
+#   fewest POKEs that build the same constant from what the immediate unit
+#   already holds.
+
+# chains of MODIFYs (e.g. the ROTATE_RIGHTs in FIXED_FUNCTION_PROGRAM) are left
+# alone. each shift or rotate moves one bit, so there is no shorter chain that
+# doesn't need a constant in a B register. FIXED_FUNCTION_PROGRAM is already as
+# short as these passes can make it, so it gains nothing from them.
+
+# instructions are only ever removed or have their destinations changed, so
+# labels with an org stay put. programs that care where their instructions are
+# (they read CURR_PC, branch indirectly, or branch to numbered addresses other
+# than 0) are returned unchanged. non-local labels and labels with an org might
+# be entry points, so nothing is assumed about the state there.
+
+import itertools
+
+from .isa import *
+
+# special registers which just hold what's written to them
+_HOLDERS = {int(SplW.TMPA), int(SplW.TMPB), int(SplW.ALU_B0), int(SplW.ALU_B1)}
+# special registers which don't change while a program runs
+_STABLE = {int(SplR.MATCH_TYPE), int(SplR.MATCH_CYCLE_COUNT),
+    int(SplR.MATCH_ADDR), int(SplR.MATCH_DATA)}
+# the match timer values, which change when any timer's control register is
+# written. on the gateware, reading any of them gives timer 0's value, so they
+# are all one location.
+_TIMER_VALS = {int(SplR.MTIM0_VAL), int(SplR.MTIM1_VAL), int(SplR.MTIM2_VAL)}
+_TIMER_CTLS = {int(SplW.MTIM0_CTL), int(SplW.MTIM1_CTL), int(SplW.MTIM2_CTL)}
+# which byte each of the immediate unit's registers writes
+_IMM_BYTES = {int(SplW.IMM_B0): 0, int(SplW.IMM_B1): 1, int(SplW.IMM_B2): 2,
+    int(SplW.IMM_B3): 3}
+_IMM_REGS = {byte: reg for reg, byte in _IMM_BYTES.items()}
+_MOD_OFFSETS = {int(SplW.MOFF_RD_TEMP), int(SplW.MOFF_WR_TEMP),
+    int(SplW.MOFF_RD_HOLD), int(SplW.MOFF_WR_HOLD)}
+
+# optimize the program and return the optimized version, which has the same
+# effects but (hopefully) fewer instructions. if return_saved, also return a
+# dict of how many instructions were saved in each handler, i.e. under each
+# non-local label ("" for any instructions before the first one).
+def ev_optimize(program_in, return_saved=False):
+    # copy the program, noting which handler each instruction is part of, and
+    # delocalize the local labels like ev_assemble does so branches can be
+    # threaded between handlers
+    program = []
+    section = ""
+    position_dependent = False
+    uses_mod_offsets = False
+    for instruction in program_in:
+        if not isinstance(instruction, Insn):
+            raise ValueError("{!r} is not an Insn".format(instruction))
+        if isinstance(instruction, L):
+            l = L(instruction.label, org=instruction.location)
+            if not l.local:
+                section = l.label
+            elif "@" not in l.label:
+                l.label = "{}@{}".format(l.label, section)
+            program.append((section, l))
+            continue
+
+        if isinstance(instruction, BRANCH):
+            dest = instruction.dest
+            if isinstance(dest, str) and dest[0] == "_" and "@" not in dest:
+                dest = "{}@{}".format(dest, section)
+            elif not isinstance(dest, str) and dest != 0:
+                position_dependent = True
+            instruction = BRANCH(dest, instruction.cond)
+        elif isinstance(instruction, COPY):
+            if instruction.dest_special:
+                instruction = COPY(instruction.special, instruction.reg)
+            else:
+                instruction = COPY(instruction.reg, instruction.special)
+        elif isinstance(instruction, POKE):
+            instruction = POKE(instruction.special, instruction.val)
+        elif isinstance(instruction, MODIFY):
+            instruction = MODIFY(instruction.reg, instruction.mod)
+
+        if isinstance(instruction, COPY) and not instruction.dest_special:
+            if instruction.special == SplR.CURR_PC:
+                position_dependent = True
+        elif isinstance(instruction, (COPY, POKE)):
+            if instruction.special == SplW.BRANCH_IND_TARGET:
+                position_dependent = True
+            elif instruction.special in _MOD_OFFSETS:
+                uses_mod_offsets = True
+        program.append((section, instruction))
+
+    if not position_dependent:
+        changed = True
+        while changed:
+            program, changed = _thread_branches(program)
+            program, c = _remove_dead_code(program)
+            changed |= c
+            program, c = _propagate_values(program, uses_mod_offsets)
+            changed |= c
+            program, c = _remove_dead_stores(program, uses_mod_offsets)
+            changed |= c
+
+    if not return_saved:
+        return [instruction for section, instruction in program]
+
+    saved = {}
+    for section, instruction in _sections(program_in):
+        if not isinstance(instruction, L):
+            saved[section] = saved.get(section, 0) + 1
+    for section, instruction in program:
+        if not isinstance(instruction, L):
+            saved[section] -= 1
+    return [instruction for section, instruction in program], saved
+
+def _sections(program):
+    section = ""
+    for instruction in program:
+        if isinstance(instruction, L) and not instruction.local:
+            section = instruction.label
+        yield section, instruction
+
+# index of the first instruction at or after the given index, or None if
+# there isn't one
+def _next_insn(program, index):
+    for index in range(index, len(program)):
+        if not isinstance(program[index][1], L):
+            return index
+    return None
+
+def _label_indices(program):
+    return {instruction.label: index
+        for index, (section, instruction) in enumerate(program)
+        if isinstance(instruction, L)}
+
+def _thread_branches(program):
+    labels = _label_indices(program)
+    out = []
+    changed = False
+    for index, (section, instruction) in enumerate(program):
+        if not isinstance(instruction, BRANCH):
+            out.append((section, instruction))
+            continue
+        if instruction.cond == Cond.NEVER:
+            changed = True
+            continue
+
+        # follow the chain of branches that will be taken after this one
+        dest = instruction.dest
+        seen = set()
+        while dest in labels and dest not in seen:
+            seen.add(dest)
+            target = _next_insn(program, labels[dest])
+            if target is None:
+                break
+            target = program[target][1]
+            if not isinstance(target, BRANCH) or \
+                    target.cond not in (Cond.ALWAYS, instruction.cond):
+                break
+            dest = target.dest
+
+        # don't bother branching to where we'd go anyway. that's not the case
+        # if there's a label with an org in between, since the padding before
+        # it would stop the program.
+        if dest in labels and _next_insn(program, labels[dest]) == \
+                _next_insn(program, index+1) and \
+                not any(isinstance(insn, L) and insn.location is not None
+                    for section, insn in program[index+1:labels[dest]+1]):
+            changed = True
+            continue
+
+        if dest != instruction.dest:
+            instruction = BRANCH(dest, instruction.cond)
+            changed = True
+        out.append((section, instruction))
+
+    return out, changed
+
+def _remove_dead_code(program):
+    referenced = {instruction.dest for section, instruction in program
+        if isinstance(instruction, BRANCH)}
+    out = []
+    changed = False
+    reachable = True
+    for section, instruction in program:
+        if isinstance(instruction, L):
+            # local labels without an org can only be reached by branching
+            if instruction.local and instruction.location is None and \
+                    instruction.label not in referenced:
+                changed = True
+                continue
+            reachable = True
+        elif not reachable:
+            changed = True
+            continue
+        elif isinstance(instruction, BRANCH) and \
+                instruction.cond == Cond.ALWAYS:
+            reachable = False
+        out.append((section, instruction))
+
+    return out, changed
+
+# what's known about the values in the registers at some point in the program.
+# values are ("const", value) tuples or unique objects standing in for values
+# we don't know.
+class _Values:
+    def __init__(self):
+        # value in each location: regular registers by number and special
+        # registers by ("spl", address)
+        self.locs = {}
+        # bytes in the immediate unit (None if unknown)
+        self.imm = [None]*4
+        # value in the immediate unit if any of its bytes are unknown
+        self.imm_value = None
+
+    def copy(self):
+        values = _Values()
+        values.locs = dict(self.locs)
+        values.imm = list(self.imm)
+        values.imm_value = self.imm_value
+        return values
+
+    # only keep what is the same in both
+    def join(self, other):
+        values = _Values()
+        values.locs = {loc: value for loc, value in self.locs.items()
+            if other.locs.get(loc) == value}
+        values.imm = [a if a == b else None
+            for a, b in zip(self.imm, other.imm)]
+        if self.imm_value is other.imm_value:
+            values.imm_value = self.imm_value
+        return values
+
+    def get(self, loc):
+        try:
+            return self.locs[loc]
+        except KeyError:
+            value = self.locs[loc] = object()
+            return value
+
+    def read_special(self, special):
+        special = int(special)
+        if special in _HOLDERS or special in _STABLE:
+            return self.get(("spl", special))
+        elif special in _TIMER_VALS:
+            return self.get(("spl", int(SplR.MTIM0_VAL)))
+        elif special == SplR.IMM_VAL:
+            if None not in self.imm:
+                return ("const", int.from_bytes(bytes(self.imm), "little"))
+            if self.imm_value is None:
+                self.imm_value = object()
+            return self.imm_value
+        return object() # changes on its own
+
+def _poke_value(val):
+    val &= 0x1FF
+    if val & 0x100:
+        val |= 0xFFFFFE00
+    return ("const", val)
+
+# set the immediate unit's bytes starting at byte to the given 9 bit value
+def _write_imm(imm, byte, val):
+    imm = list(imm)
+    imm[byte] = val & 0xFF
+    imm[byte+1:] = [0xFF if val & 0x100 else 0]*(3-byte)
+    return imm
+
+# find the fewest POKEs that turn the immediate unit's start bytes into the end
+# bytes. bytes unknown at the end must have been left alone.
+def _build_imm(start, end):
+    for num_pokes in range(5):
+        for bytes_ in itertools.combinations(range(4), num_pokes):
+            for fills in itertools.product((0, 0x100), repeat=num_pokes):
+                imm = start
+                for byte, fill in zip(bytes_, fills):
+                    imm = _write_imm(imm, byte, (end[byte] or 0) | fill)
+                if imm == end:
+                    return [POKE(SplW(_IMM_REGS[byte]), (end[byte]) | fill)
+                        for byte, fill in zip(bytes_, fills)]
+
+def _propagate_values(program, uses_mod_offsets):
+    # labels which are branched to from later in the program, so we can't know
+    # everything that leads there when we get to them
+    labels = _label_indices(program)
+    looped = set()
+    for index, (section, instruction) in enumerate(program):
+        if isinstance(instruction, BRANCH) and \
+                labels.get(instruction.dest, len(program)) <= index:
+            looped.add(instruction.dest)
+
+    out = []
+    changed = False
+    values = _Values()
+    branched = {} # values at branches to labels we haven't gotten to yet
+    index = 0
+    while index < len(program):
+        section, instruction = program[index]
+        index += 1
+
+        if isinstance(instruction, L):
+            preds = branched.pop(instruction.label, [])
+            if values is not None:
+                preds.append(values)
+            if not instruction.local or instruction.location is not None or \
+                    instruction.label in looped or len(preds) == 0:
+                values = _Values()
+            else:
+                values = preds[0]
+                for pred in preds[1:]:
+                    values = values.join(pred)
+            out.append((section, instruction))
+            continue
+        if values is None: # unreachable
+            out.append((section, instruction))
+            continue
+
+        if isinstance(instruction, BRANCH):
+            if isinstance(instruction.dest, str):
+                branched.setdefault(instruction.dest, []).append(values.copy())
+            if instruction.cond == Cond.ALWAYS:
+                values = None
+            out.append((section, instruction))
+            continue
+
+        if isinstance(instruction, POKE) and instruction.special in _IMM_BYTES:
+            # rebuild the whole run of immediate POKEs at once
+            end = index
+            while end < len(program) and \
+                    isinstance(program[end][1], POKE) and \
+                    program[end][1].special in _IMM_BYTES:
+                end += 1
+            run = [instruction] + [insn for s, insn in program[index:end]]
+            index = end
+            imm = values.imm
+            for poke in run:
+                imm = _write_imm(imm, _IMM_BYTES[poke.special], poke.val)
+            pokes = _build_imm(values.imm, imm)
+            if len(pokes) < len(run):
+                run = pokes
+                changed = True
+            out.extend((section, poke) for poke in run)
+            if imm != values.imm:
+                values.imm = imm
+                values.imm_value = None
+            continue
+
+        redundant = False
+        if isinstance(instruction, MODIFY):
+            if uses_mod_offsets: # it could be any register
+                values.locs = {loc: value for loc, value in values.locs.items()
+                    if not isinstance(loc, int)}
+            elif (instruction.mod & 0xE0) != 0xC0: # writes the result back
+                values.locs[instruction.reg] = object()
+        elif isinstance(instruction, COPY) and not instruction.dest_special:
+            value = values.read_special(instruction.special)
+            redundant = values.locs.get(instruction.reg) == value
+            values.locs[instruction.reg] = value
+        else: # POKE or COPY to a special register
+            if isinstance(instruction, POKE):
+                value = _poke_value(instruction.val)
+            else:
+                value = values.get(instruction.reg)
+            special = int(instruction.special)
+            if special in _HOLDERS:
+                redundant = values.locs.get(("spl", special)) == value
+                values.locs[("spl", special)] = value
+            elif special in _IMM_BYTES:
+                if isinstance(value, tuple): # constant
+                    imm = _write_imm(values.imm, _IMM_BYTES[special], value[1])
+                else:
+                    imm = values.imm[:_IMM_BYTES[special]] + \
+                        [None]*(4-_IMM_BYTES[special])
+                redundant = imm == values.imm and None not in imm
+                values.imm = imm
+                values.imm_value = None
+            elif special in _TIMER_CTLS:
+                values.locs.pop(("spl", int(SplR.MTIM0_VAL)), None)
+
+        if redundant:
+            changed = True
+        else:
+            out.append((section, instruction))
+
+    return out, changed
+
+# remove COPYs and POKEs whose values are overwritten before anything could
+# read them
+def _remove_dead_stores(program, uses_mod_offsets):
+    out = []
+    changed = False
+    overwritten = set() # locations written to later without being read
+    imm_from = 4 # immediate unit bytes from this one up are overwritten later
+    for section, instruction in reversed(program):
+        dead = False
+        if isinstance(instruction, (L, BRANCH)):
+            # everything could be read wherever we go next
+            overwritten = set()
+            imm_from = 4
+        elif isinstance(instruction, MODIFY):
+            if uses_mod_offsets: # it could read any register
+                overwritten = {loc for loc in overwritten
+                    if not isinstance(loc, int)}
+            else:
+                overwritten.discard(instruction.reg)
+            if (instruction.mod & 0xC0) == 0xC0: # ALU ops might read B
+                overwritten.discard(("spl", int(SplW.ALU_B0)))
+                overwritten.discard(("spl", int(SplW.ALU_B1)))
+        elif isinstance(instruction, COPY) and not instruction.dest_special:
+            dead = instruction.reg in overwritten
+            overwritten.add(instruction.reg)
+            if not dead:
+                overwritten.discard(("spl", int(instruction.special)))
+                if instruction.special == SplR.IMM_VAL:
+                    imm_from = 4
+        else: # POKE or COPY to a special register
+            special = int(instruction.special)
+            if special in _HOLDERS:
+                dead = ("spl", special) in overwritten
+                overwritten.add(("spl", special))
+            elif special in _IMM_BYTES:
+                dead = _IMM_BYTES[special] >= imm_from
+                imm_from = min(imm_from, _IMM_BYTES[special])
+            if not dead and isinstance(instruction, COPY):
+                overwritten.discard(instruction.reg)
+
+        if dead:
+            changed = True
+        else:
+            out.append((section, instruction))
+
+    out.reverse()
+    return out, changed
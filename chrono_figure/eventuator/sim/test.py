@@ -100,6 +100,38 @@ class SimTest(BaseSimTest):
             yield self.ev.i_ctl_start.eq(0)
         return proc
 
+    # run the program, then feed it each of the given matches (tuples of
+    # match_type, cycle_count, addr, and data), waiting the given number of
+    # cycles for it after each. returns the final contents of the register
+    # memory and the events it sent. the program can be as big as 128 words.
+    def run_prg(self, name, prg, matches=[], cycles=400):
+        self.tb = SimTop(match_d=4, event_d=4, prg_d=128, reg_d=32)
+        self.ev = self.tb.ev
+        self.core = self.tb.ev.core
+
+        regs = []
+        events = []
+        def proc():
+            yield from self.proc_start_prg(prg)()
+            yield self.tb.i_event_re.eq(1)
+            for match in [None, *matches]:
+                if match is not None:
+                    for field, value in zip(self.tb.i_match_info, match):
+                        yield field.eq(value)
+                    yield self.tb.i_match_we.eq(1)
+                    yield
+                    yield self.tb.i_match_we.eq(0)
+                for cycle in range(cycles):
+                    yield Settle()
+                    if (yield self.tb.o_event_valid):
+                        events.append((yield self.tb.o_event))
+                    yield
+            for reg in range(32):
+                regs.append((yield self.tb.reg_mem[reg]))
+
+        self.simulate(name, [proc])
+        return regs, events
+
 if __name__ == "__main__":
     import unittest
     # import and run all the tests
@@ -108,5 +140,7 @@ if __name__ == "__main__":
     from .test_exec import TestExecution
     from .test_spl import TestSpecial
     from .test_alu import TestALU
+    from .test_optimize import TestOptimize
+    from .test_archsim import TestArchSim
 
     unittest.main()
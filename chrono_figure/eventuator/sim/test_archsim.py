@@ -0,0 +1,131 @@
+# test that the instruction level simulator gets the same results as the
+# gateware
+
+from nmigen import *
+
+from .test import SimTest
+from ..isa import *
+from ..archsim import ArchSim
+
+import unittest
+
+# load a 32 bit value into a special register using the given temporary reg
+def load_value(special, value, reg):
+    return [
+        POKE(SplW.IMM_B0, value & 0xFF),
+        POKE(SplW.IMM_B1, (value >> 8) & 0xFF),
+        POKE(SplW.IMM_B2, (value >> 16) & 0xFF),
+        POKE(SplW.IMM_B3, (value >> 24) & 0xFF),
+        COPY(reg, SplR.IMM_VAL),
+        COPY(special, reg),
+    ]
+
+class TestArchSim(SimTest, unittest.TestCase):
+    # run the program and matches on both the gateware and the simulator and
+    # make sure they end up the same
+    def check_conformance(self, name, prg, matches=[], cycles=400):
+        regs, events = self.run_prg(name, prg, matches, cycles)
+
+        sim = ArchSim(prg_d=128, reg_d=32)
+        sim.load(ev_assemble(prg))
+        sim.start(1)
+        sim.run_matches(matches)
+        self.assertEqual(sim.regs, regs)
+        self.assertEqual(sim.events, events)
+
+    def test_archsim_alu(self):
+        # values for A, B0, and B1 that hit all the flags
+        values = [
+            (0x80000001, 0x80000000, 0x7FFFFFFF),
+            (0x7FFFFFFF, 0xFFFFFFFF, 0x80000000),
+            (0x00000000, 0x00000001, 0xFFFFFFFF),
+        ]
+        mods = list(Mod)
+        for vi, (a, b0, b1) in enumerate(values):
+            # split the mods up so the program fits in memory
+            for mi in range(0, len(mods), 15):
+                prg = [
+                    *load_value(SplW.TMPA, a, 3),
+                    *load_value(SplW.ALU_B0, b0, 3),
+                    *load_value(SplW.ALU_B1, b1, 3),
+                    POKE(SplW.ALU_FLAGS, 0b0000_1010),
+                ]
+                for mod in mods[mi:mi+15]:
+                    prg.extend([
+                        COPY(3, SplR.TMPA),
+                        MODIFY(3, mod),
+                        COPY(SplW.EVENT_FIFO, 3),
+                        COPY(4, SplR.ALU_FLAGS),
+                        COPY(SplW.EVENT_FIFO, 4),
+                    ])
+                prg.append(BRANCH(0))
+
+                self.check_conformance(
+                    "test_archsim_alu_{}_{}".format(vi, mi), prg)
+
+    def test_archsim_matches(self):
+        prg = [
+            L("start"),
+            POKE(SplW.MTIM0_CTL, 3), # reset and run
+            POKE(SplW.MTIM1_CTL, 4), # one shot
+            POKE(SplW.ALU_B0, 5),
+            POKE(SplW.MATCH_ENABLE, 1),
+            BRANCH(0),
+
+            L("handler1", org=12),
+            BRANCH("match_info"),
+            L("handler2", org=20),
+            BRANCH("timers"),
+            L("handler3", org=28),
+            BRANCH("offsets"),
+
+            L("match_info"),
+            COPY(3, SplR.MATCH_TYPE),
+            COPY(4, SplR.MATCH_CYCLE_COUNT),
+            COPY(5, SplR.MATCH_ADDR),
+            COPY(6, SplR.MATCH_DATA),
+            COPY(7, SplR.CURR_PC),
+            COPY(SplW.EVENT_FIFO, 3),
+            COPY(SplW.EVENT_FIFO, 4),
+            COPY(SplW.EVENT_FIFO, 5),
+            COPY(SplW.EVENT_FIFO, 6),
+            COPY(SplW.EVENT_FIFO, 7),
+            BRANCH(0),
+
+            L("timers"), # all of these read timer 0 on the gateware
+            COPY(8, SplR.MTIM0_VAL),
+            COPY(9, SplR.MTIM1_VAL),
+            COPY(10, SplR.MTIM2_VAL),
+            COPY(SplW.EVENT_FIFO, 8),
+            COPY(SplW.EVENT_FIFO, 9),
+            COPY(SplW.EVENT_FIFO, 10),
+            POKE(SplW.MTIM2_CTL, 2), # start running without reset
+            BRANCH(0),
+
+            L("offsets"),
+            POKE(SplW.MOFF_WR_TEMP, 9), # r12 = r3 + 1
+            MODIFY(3, Mod.INC),
+            MODIFY(3, Mod.INC), # back to normal
+            POKE(SplW.MOFF_RD_HOLD, 1), # r13 = r4 + B0, r14 = r5 + B0
+            POKE(SplW.MOFF_WR_HOLD, 10),
+            MODIFY(3, Mod.ADD_B0),
+            MODIFY(4, Mod.ADD_B0),
+            POKE(SplW.MOFF_RD_TEMP, 3), # r11 = r6
+            POKE(SplW.MOFF_WR_TEMP, 8),
+            MODIFY(3, Mod.COPY),
+            COPY(15, SplR.CURR_PC), # branch indirectly over an event
+            MODIFY(15, Mod.ADD_B0),
+            COPY(SplW.BRANCH_IND_TARGET, 15),
+            BRANCH(0),
+            POKE(SplW.EVENT_FIFO, 1),
+            POKE(SplW.EVENT_FIFO, 2),
+            BRANCH(0),
+        ]
+        matches = [
+            (1, 100, 0x123456, 0x78),
+            (2, 350, 0, 0),
+            (3, 1000, 0xABCDEF, 0xFF),
+            (2, 5000, 0, 0),
+        ]
+
+        self.check_conformance("test_archsim_matches", prg, matches, 150)
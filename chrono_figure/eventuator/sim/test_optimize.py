@@ -0,0 +1,98 @@
+# test that optimized programs do the same thing as the originals when run on
+# the actual eventuator
+
+from nmigen import *
+
+from .test import SimTest
+from ..isa import *
+from ..optimize import ev_optimize
+
+import unittest
+
+class TestOptimize(SimTest, unittest.TestCase):
+    # make sure the optimized program saved what we expect and has the same
+    # result as the original
+    def check_optimize(self, name, prg, saved, matches=[]):
+        opt, got_saved = ev_optimize(prg, return_saved=True)
+        self.assertEqual(got_saved, saved)
+
+        regs, events = self.run_prg(name+"_orig", prg, matches)
+        opt_regs, opt_events = self.run_prg(name+"_opt", opt, matches)
+        self.assertEqual(opt_regs, regs)
+        self.assertEqual(opt_events, events)
+
+    def test_optimize_copies(self):
+        prg = [
+            L("start"),
+            POKE(SplW.IMM_B0, 0x34), # build 0x1234
+            POKE(SplW.IMM_B1, 0x12),
+            COPY(3, SplR.IMM_VAL),
+            POKE(SplW.IMM_B0, 0x34), # build it again, which needs no pokes
+            POKE(SplW.IMM_B1, 0x12),
+            COPY(6, SplR.IMM_VAL),
+            POKE(SplW.IMM_B1, 0x56), # poking byte 0 clears the bytes above,
+            POKE(SplW.IMM_B0, 0xFF), #  so this only needs the last poke
+            COPY(4, SplR.IMM_VAL),
+            POKE(SplW.TMPA, 5), # overwritten before it's read
+            POKE(SplW.TMPA, 6),
+            COPY(5, SplR.TMPA),
+            COPY(5, SplR.TMPA), # already has that value
+            COPY(SplW.TMPA, 5), # so does TMPA
+            COPY(SplW.EVENT_FIFO, 3),
+            COPY(SplW.EVENT_FIFO, 4),
+            COPY(SplW.EVENT_FIFO, 5),
+            COPY(SplW.EVENT_FIFO, 6),
+            BRANCH(0),
+        ]
+
+        self.check_optimize("test_optimize_copies", prg, {"start": 6})
+
+    def test_optimize_branches(self):
+        prg = [
+            L("start"),
+            POKE(SplW.TMPA, 3),
+            COPY(3, SplR.TMPA),
+            MODIFY(3, Mod.TEST_LSB),
+            BRANCH("_odd", Cond.Z0), # goes through the unconditional branch
+            BRANCH("_next"), # to the next instruction
+            L("_next"),
+            POKE(SplW.EVENT_FIFO, 1),
+            BRANCH("_done"),
+            POKE(SplW.EVENT_FIFO, 2), # can't ever run
+            L("_odd"),
+            BRANCH("_really_odd"),
+            L("_really_odd"),
+            POKE(SplW.EVENT_FIFO, 3),
+            MODIFY(3, Mod.DEC),
+            BRANCH("_odd", Cond.Z0),
+            BRANCH("_never", Cond.NEVER),
+            L("_done"),
+            POKE(SplW.EVENT_FIFO, 4),
+            BRANCH(0),
+            L("_never"),
+            BRANCH(0),
+        ]
+
+        self.check_optimize("test_optimize_branches", prg, {"start": 5})
+
+    def test_optimize_timers(self):
+        prg = [
+            L("start"),
+            POKE(SplW.MTIM0_CTL, 3), # reset and run
+            POKE(SplW.MATCH_ENABLE, 1),
+            BRANCH(0),
+
+            L("handler", org=12),
+            COPY(3, SplR.MTIM1_VAL), # reads timer 0 on the gateware
+            POKE(SplW.MTIM0_CTL, 11), # which this resets
+            COPY(3, SplR.MTIM1_VAL), # so this is not the same value
+            COPY(SplW.EVENT_FIFO, 3),
+            BRANCH(0),
+        ]
+        matches = [
+            (1, 100, 0, 0),
+            (1, 350, 0, 0),
+        ]
+
+        self.check_optimize("test_optimize_timers", prg,
+            {"start": 0, "handler": 1}, matches)
@@ -199,9 +199,53 @@ class TestProgramControl(SimCoreTest, unittest.TestCase):
             ({},                            {"pc": 2, "ctl_run": 1}),
             # try to restart the program right before it stops
             ({"ctl_start": 1},              {"pc": 2, "ctl_run": 1}),
-            # it should be ignored and the program will stop anyway
+            # it should be remembered while the program finishes
             ({"ctl_start": 0},              {"pc": 3, "ctl_run": 1}),
+            # then started once it stops
             ({},                            {"pc": 3, "ctl_run": 0}),
+            ({},                            {"pc": 1, "ctl_run": 1}),
+            ({},                            {"pc": 1, "ctl_run": 1}),
+            ({},                            {"pc": 2, "ctl_run": 1}),
+        ]
+
+        return sets, chks, vals, self.proc_load_prg(prg)
+
+    @cycle_test
+    def test_start_pending_stop(self):
+        prg = [
+            POKE(SplW.TMPA, 1),
+            POKE(SplW.TMPA, 2),
+            POKE(SplW.TMPA, 3),
+            BRANCH(0),
+        ]
+        sets = {"ctl_start": self.core.i_ctl_start,
+                "ctl_pc": self.core.i_ctl_pc,
+                "ctl_stop": self.core.i_ctl_stop}
+        chks = {"pc": self.core.prg_ctl.o_fetch_addr,
+                "ctl_run": self.core.o_ctl_run,
+                "pending": self.core.o_ctl_pending}
+        vals = [
+            ({},                            {"pc": 0, "ctl_run": 0}),
+            ({},                            {"pc": 0, "ctl_run": 0}),
+            ({"ctl_start": 1, "ctl_pc": 1}, {"pc": 0, "ctl_run": 0}),
+            # starting right away doesn't leave one pending
+            ({"ctl_start": 0},              {"pc": 1, "ctl_run": 1,
+                                                "pending": 0}),
+            ({},                            {"pc": 1, "ctl_run": 1}),
+            ({},                            {"pc": 2, "ctl_run": 1}),
+            # ask to start again while running
+            ({"ctl_start": 1},              {"pc": 2, "ctl_run": 1}),
+            ({"ctl_start": 0},              {"pc": 3, "ctl_run": 1,
+                                                "pending": 1}),
+            # but stop before the program does
+            ({"ctl_stop": 1},               {"pc": 3, "ctl_run": 1,
+                                                "pending": 1}),
+            ({"ctl_stop": 0},               {"pc": 0, "ctl_run": 0,
+                                                "pending": 0}),
+            # which cancels the start
+            ({},                            {"pc": 0, "ctl_run": 0}),
+            ({},                            {"pc": 0, "ctl_run": 0}),
+            ({},                            {"pc": 0, "ctl_run": 0}),
         ]
 
         return sets, chks, vals, self.proc_load_prg(prg)
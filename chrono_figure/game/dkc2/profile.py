@@ -0,0 +1,28 @@
+# how to autosync DKC2 US v1.1
+
+from chrono_figure.autosync.engine import GameProfile
+
+class DKC2Profile(GameProfile):
+    name = "DKC2 US v1.1"
+    matcher_config = [(0xf3bd, 2), (0x83f7, 1), (0x808652, 3), (0x808c9b, 3),
+        (0x8097ca, 3), (0x809c96, 3), (0x80ab78, 3), (0x80b106, 3),
+        (0x80b54a, 3), (0x80b6be, 3), (0xb5d00e, 3), (0xb5d23c, 3),
+        (0xb5d447, 3)
+    ]
+
+    nmi_close = 8
+    min_freq = 23
+    max_freq = 24.75
+
+    # the console gets reset partway through the credits, so don't worry if
+    # the end of the TAS doesn't finish streaming
+    ignore_finish_errors = True
+
+    def fixup_latches(self, latches):
+        # there are a lot of useless latches at the end of the tas. we chop off
+        # enough that it gets through the first couple seconds of the end
+        # credits to confirm that the exploit worked before resetting the
+        # console
+        return latches[:21880]
+
+PROFILE = DKC2Profile()
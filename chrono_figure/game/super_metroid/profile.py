@@ -0,0 +1,45 @@
+# how to autosync Super Metroid
+
+import numpy as np
+
+from chrono_figure.autosync.engine import GameProfile
+
+class SuperMetroidProfile(GameProfile):
+    name = "Super Metroid"
+    matcher_config = [(0x9583, 2), (0x841c, 1),
+        (0x808343, 3), (0x82e526, 3), (0x85813c, 3), (0x82e06b, 3),
+        (0x808348, 4), (0x82e52b, 4), (0x858141, 4), (0x82e070, 4)
+    ]
+
+    nmi_close = 10
+    min_freq = 14
+    max_freq = 24.75
+
+    # differing NMI counts before this group don't count as desyncing
+    desync_start_group = 21609
+    wait_for_reset = True
+    # wait for the planet to explode to be sure it worked
+    finish_wait = 20
+    mlf_path = "mlf.log"
+
+    def fixup_latches(self, latches):
+        return np.insert(latches, 35167, [0, 0, 0, 0, 0, 0], axis=0)
+
+    def fixup_group_columns(self, group_cols):
+        # groups after 30330 start a latch later (but still end in the same
+        # place)
+        group_cols.latch_start[30331:] += 1
+        group_cols.num_latches[30331:] -= 1
+        # and 30330 itself lasts an extra frame
+        group_cols.latch_clocks[30330] += self.f_cyc
+
+    # group 30330 sometimes gets an extra NMI. drop it and pretend the frame it
+    # took never happened so the groups after line up.
+    def fixup_group(self, gi, group, group_events, clock):
+        if gi == 30330 and len(group_events) > group["num_nmis"]:
+            print("hacking too long")
+            group_events = group_events[:-1]
+            clock.offset_cycles -= self.f_cyc
+        return group_events
+
+PROFILE = SuperMetroidProfile()
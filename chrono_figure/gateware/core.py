@@ -11,7 +11,7 @@ from chrono_figure.eventuator import isa
 
 # will probably always be manually incremented because it's related to the
 # modules in the sd2snes and its firmware as well
-GATEWARE_VERSION = 5
+GATEWARE_VERSION = 7
 
 class ChronoFigureCore(Elaboratable):
     def __init__(self, cart_signals):
@@ -19,6 +19,12 @@ class ChronoFigureCore(Elaboratable):
         self.i_prg_addr = Signal(isa.PC_WIDTH) # what address to write to
         self.i_prg_we = Signal() # write instruction to the address
 
+        # direct writes to the matcher table. each word is one matcher's
+        # configuration: address in the low 24 bits and match type above.
+        self.i_match_table_data = Signal(32)
+        self.i_match_table_addr = Signal(MATCHER_BITS) # which matcher
+        self.i_match_table_we = Signal()
+
         # connection to the event FIFO
         self.o_event = Signal(32)
         self.o_event_valid = Signal()
@@ -56,6 +62,10 @@ class ChronoFigureCore(Elaboratable):
             match_engine.i_config_addr.eq(eventuator.o_match_config_addr),
             match_engine.i_config_we.eq(eventuator.o_match_config_we),
 
+            match_engine.i_table_data.eq(self.i_match_table_data),
+            match_engine.i_table_addr.eq(self.i_match_table_addr),
+            match_engine.i_table_we.eq(self.i_match_table_we),
+
             match_engine.i_bus_valid.eq(bus.o_valid),
             match_engine.i_bus_addr.eq(bus.o_addr),
             match_engine.i_bus_data.eq(bus.o_data),
@@ -118,7 +128,8 @@ class ChronoFigureCore(Elaboratable):
             m.d.comb += eventuator.i_ctl_stop.eq(1)
 
         # writing to address 0 controls execution: zero stops execution and
-        # non-zero starts execution (if stopped) at the written address
+        # non-zero starts execution at the written address. if a program is
+        # running, it finishes first. queued matches are kept either way.
         m.d.sync += [
             eventuator.i_ctl_pc.eq(self.i_prg_insn[:isa.PC_WIDTH]),
             eventuator.i_ctl_start.eq(0),
@@ -2,6 +2,7 @@ from nmigen import *
 from nmigen.back import verilog
 
 from .core import ChronoFigureCore
+from .match_info import MATCHER_BITS
 from .snes_bus import make_cart_signals
 from ..eventuator import isa
 
@@ -15,6 +16,11 @@ class Top(Elaboratable):
         self.i_prg_addr = Signal(isa.PC_WIDTH) # what address to write to
         self.i_prg_we = Signal() # write instruction to the address
 
+        # direct writes to the matcher table
+        self.i_match_table_data = Signal(32)
+        self.i_match_table_addr = Signal(MATCHER_BITS) # which matcher
+        self.i_match_table_we = Signal()
+
         # connection to the event FIFO
         self.o_event = Signal(32)
         self.o_event_valid = Signal()
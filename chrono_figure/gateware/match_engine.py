@@ -37,6 +37,12 @@ class MatchEngine(Elaboratable):
         self.i_config_addr = Signal(10)
         self.i_config_we = Signal()
 
+        # matcher table signals. writes a whole matcher's configuration at once
+        # and takes priority over the config bus.
+        self.i_table_data = Signal(32)
+        self.i_table_addr = Signal(MATCHER_BITS)
+        self.i_table_we = Signal()
+
         self.o_match_info = make_match_info()
         self.o_match_valid = Signal()
         self.i_match_re = Signal()
@@ -50,18 +56,31 @@ class MatchEngine(Elaboratable):
         m.submodules.match_fifo = match_fifo = \
             ResetInserter(self.i_reset_match_fifo)(self.match_fifo)
 
-        # wire up config byte and generate byte selects
-        mb_config_data = Signal(8)
+        # wire up config data and generate byte selects
+        mb_config_data = Signal(32)
         mb_config_addr = Signal(MATCHER_BITS)
         mb_config_we = Signal(4) # one line per byte
-        m.d.sync += [
-            mb_config_data.eq(self.i_config),
-            mb_config_addr.eq(self.i_config_addr[2:]),
-            mb_config_we[0].eq(self.i_config_we & (self.i_config_addr[:2] == 0)),
-            mb_config_we[1].eq(self.i_config_we & (self.i_config_addr[:2] == 1)),
-            mb_config_we[2].eq(self.i_config_we & (self.i_config_addr[:2] == 2)),
-            mb_config_we[3].eq(self.i_config_we & (self.i_config_addr[:2] == 3)),
-        ]
+        with m.If(self.i_table_we):
+            # write the whole word
+            m.d.sync += [
+                mb_config_data.eq(self.i_table_data),
+                mb_config_addr.eq(self.i_table_addr),
+                mb_config_we.eq(0b1111),
+            ]
+        with m.Else():
+            # put the config byte on every byte and select the right one
+            m.d.sync += [
+                mb_config_data.eq(Repl(self.i_config, 4)),
+                mb_config_addr.eq(self.i_config_addr[2:]),
+                mb_config_we[0].eq(
+                    self.i_config_we & (self.i_config_addr[:2] == 0)),
+                mb_config_we[1].eq(
+                    self.i_config_we & (self.i_config_addr[:2] == 1)),
+                mb_config_we[2].eq(
+                    self.i_config_we & (self.i_config_addr[:2] == 2)),
+                mb_config_we[3].eq(
+                    self.i_config_we & (self.i_config_addr[:2] == 3)),
+            ]
 
         # buffer the matcher input signals to ensure the best timing
         mb_addr = Signal(24)
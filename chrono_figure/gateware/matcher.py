@@ -8,8 +8,9 @@ class Matcher(Elaboratable):
         self.i_snes_addr = Signal(24) # address the snes is accessing
         self.i_snes_rd = Signal() # 1 the cycle the snes starts reading
 
-        # configuration input to set type and address
-        self.i_config_data = Signal(8)
+        # configuration input to set type and address. each byte of the data
+        # is written to the matching byte of the configuration.
+        self.i_config_data = Signal(32)
         self.i_config_we = Signal(4) # one per byte
 
         self.o_match_type = Signal(MATCH_TYPE_BITS)
@@ -21,13 +22,14 @@ class Matcher(Elaboratable):
         match_type = Signal(MATCH_TYPE_BITS)
 
         with m.If(self.i_config_we[0]):
-            m.d.sync += match_addr[0:8].eq(self.i_config_data)
+            m.d.sync += match_addr[0:8].eq(self.i_config_data[0:8])
         with m.If(self.i_config_we[1]):
-            m.d.sync += match_addr[8:16].eq(self.i_config_data)
+            m.d.sync += match_addr[8:16].eq(self.i_config_data[8:16])
         with m.If(self.i_config_we[2]):
-            m.d.sync += match_addr[16:24].eq(self.i_config_data)
+            m.d.sync += match_addr[16:24].eq(self.i_config_data[16:24])
         with m.If(self.i_config_we[3]):
-            m.d.sync += match_type.eq(self.i_config_data[0:MATCH_TYPE_BITS])
+            m.d.sync += match_type.eq(
+                self.i_config_data[24:24+MATCH_TYPE_BITS])
 
         with m.If(self.i_snes_rd):
             with m.If(self.i_snes_addr == match_addr):
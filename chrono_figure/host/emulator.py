@@ -0,0 +1,641 @@
+# a stand-in for a USB2SNES running Chrono Figure, for testing and benchmarking
+# the host side code without a real console
+
+# the emulator makes a pseudo-terminal and speaks the USB2SNES protocol on it,
+# so anything that takes a serial port (USB2SNES.connect(),
+# ChronoFigureInterface.connect()) can use it by passing emulator.port. it
+# implements file access on an in-memory SD card, SNES memory as plain memory,
+# and the Chrono Figure address space. the eventuator is not really emulated:
+# straight-line programs of POKEs (like one that configures the matchers) are
+# run, and anything else is assumed to be a measurement program.
+# while one is running and the console is not in reset, the emulator produces
+# events from a script at a chosen rate.
+
+# usage: python3 -m chrono_figure.host.emulator [-h] ...
+#   serve the emulator (and print its port) until interrupted, or benchmark
+#   file transfers and event draining against it.
+
+import os
+import pty
+import tty
+import time
+import select
+import struct
+import threading
+from collections import deque
+
+from . import usb2snes
+from ..eventuator.isa import InsnCode, SplW, PC_WIDTH
+from ..gateware.match_info import NUM_MATCHERS
+
+class EmulatorError(Exception): pass
+
+# chrono figure address space addresses. matches chrono_figure.host.interface
+ADDR_GATEWARE_VERSION = 0x00000000
+ADDR_LOOPBACK = 0x00000004
+ADDR_RESET = 0x00000008
+ADDR_SAVE_INHIBIT = 0x0000000C
+ADDR_CLEAR_SAVE_RAM = 0x00000010
+CLEAR_SAVE_RAM_KEY = 0x05C1EA12
+ADDR_MATCHER_CONFIG = 0x10000000
+ADDR_MATCHER_TABLE = 0x10001000
+ADDR_EVENT_FIFO = 0x80000000
+# first firmware versions with newer features. matches
+# chrono_figure.host.interface
+FIRMWARE_VERSION_MATCHER_TABLE = 0xC10A0303
+FIRMWARE_VERSION_FIFO_BLOCKS = 0xC10A0304
+
+# usb2snes's response opcode
+OP_RESPONSE = 15
+
+# how many words the event FIFO holds
+EVENT_FIFO_DEPTH = 512
+# how many instructions the eventuator's program memory holds
+PROGRAM_SIZE = 1024
+
+# nominal SNES frame rate, in frames (and so NMI events) per second
+NTSC_FRAME_RATE = 21477272/357366
+
+# generate synthetic (end_cycle, wait_cycle) NMI events, one per frame, for
+# num_events frames (or forever if None). busy is how much of each frame (0 to
+# 1) the game spends before it waits for the next NMI, and jitter is how many
+# cycles that randomly varies by. rng is a numpy Generator or None to not
+# vary it.
+def synthetic_events(num_events=None, f_cyc=357366, busy=0.5, jitter=0,
+        rng=None):
+    frame = 0
+    while num_events is None or frame < num_events:
+        end_cycle = frame*f_cyc + 1000
+        idle = int((1-busy)*f_cyc)
+        if jitter > 0 and rng is not None:
+            idle += int(rng.integers(-jitter, jitter+1))
+        idle = min(max(idle, 0), f_cyc-1)
+        yield end_cycle, end_cycle-idle
+        frame += 1
+
+class USB2SNESEmulator:
+    # fw_version and gateware_version are what the emulator claims to be.
+    # they default to the newest versions chrono_figure.host.interface works
+    # with (which requires nmigen to find out). features newer firmware has
+    # are only emulated if fw_version says so.
+    def __init__(self, fw_version=None, gateware_version=None):
+        if fw_version is None or gateware_version is None:
+            from . import interface
+            if fw_version is None:
+                fw_version = interface.FIRMWARE_VERSIONS[-1]
+            if gateware_version is None:
+                gateware_version = interface.gateware.GATEWARE_VERSION
+        self.fw_version = fw_version
+        self.gateware_version = gateware_version
+
+        # SD card contents: dicts are directories and bytes are files
+        self.sd = {}
+        # SNES memory, in 24 bit address space
+        self.snes = bytearray(1 << 24)
+        self.current_rom = "/sd2snes/menu.bin"
+        # (opcode, space, path or address) of the most recent commands received
+        self.commands = deque(maxlen=10000)
+
+        # chrono figure state
+        self.loopback = 0
+        self.in_reset = False
+        self.save_inhibit = False
+        self.save_ram_clears = 0
+        self.program = [0]*PROGRAM_SIZE
+        self.matcher_config = bytearray(4*NUM_MATCHERS)
+        self._config_addr = 0
+        self.measuring = False # a measurement program is running
+        self.event_fifo = deque()
+        self.next_event_counter = 0
+        self.dropped_events = 0 # events lost because the FIFO was full
+
+        # scripted events to produce while measuring
+        self.event_source = iter(())
+        self.event_rate = NTSC_FRAME_RATE
+        self.event_clock = None # when the next event is due
+        # (source, rate) to switch to when the next measurement starts
+        self._next_script = None
+
+        self.lock = threading.RLock()
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._in = bytearray()
+        self._out = bytearray()
+        # (space, address, size, padded size, opcode) of data we are receiving
+        self._pending_put = None
+
+    # make the pseudo-terminal and start serving it
+    def start(self):
+        if self._thread is not None:
+            raise EmulatorError("already started")
+        self._master, self._slave = pty.openpty()
+        # no echo or line editing, just bytes
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        os.close(self._master)
+        os.close(self._slave)
+        self._master = self._slave = None
+        self.port = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    # produce events from the given iterable of (end_cycle, wait_cycle) pairs
+    # while measuring. rate is events per second, or None to produce them as
+    # fast as the FIFO has room. like a TAS played from reset, the events start
+    # with the next measurement; one already running keeps its old events.
+    def script_events(self, events, rate=NTSC_FRAME_RATE):
+        with self.lock:
+            self._next_script = (iter(events), rate)
+
+    # the configured matchers as a list of (address, match_type) tuples
+    def matchers(self):
+        with self.lock:
+            config = struct.unpack("<{}I".format(NUM_MATCHERS),
+                self.matcher_config)
+        return [(c & 0xFFFFFF, c >> 24) for c in config]
+
+    ### SD card
+
+    # put the contents of a local directory onto the SD card at the given path
+    def load_sd_dir(self, local_dir, path=""):
+        with self.lock:
+            directory = self._sd_dir(path, create=True)
+            for name in sorted(os.listdir(local_dir)):
+                local = os.path.join(local_dir, name)
+                if os.path.isdir(local):
+                    self.load_sd_dir(local, path+"/"+name)
+                else:
+                    with open(local, "rb") as f:
+                        directory[name] = f.read()
+
+    def _split(self, path):
+        return [p for p in path.split("/") if p != ""]
+
+    def _sd_dir(self, path, create=False):
+        directory = self.sd
+        for part in self._split(path):
+            if part not in directory and create:
+                directory[part] = {}
+            directory = directory.get(part)
+            if not isinstance(directory, dict):
+                return None
+        return directory
+
+    # return (parent directory dict or None, name) for the given path
+    def _sd_parent(self, path):
+        parts = self._split(path)
+        if len(parts) == 0:
+            return None, ""
+        return self._sd_dir("/".join(parts[:-1])), parts[-1]
+
+    ### serving
+
+    def _serve(self):
+        while not self._stop.is_set():
+            with self.lock:
+                self._produce_events()
+                want_write = len(self._out) > 0
+            timeout = 0.1
+            if self.measuring and self.event_clock is not None:
+                timeout = 0.001
+            r, w, x = select.select([self._master],
+                [self._master] if want_write else [], [], timeout)
+            if r:
+                try:
+                    data = os.read(self._master, 65536)
+                except (BlockingIOError, OSError):
+                    data = b""
+                with self.lock:
+                    self._in += data
+                    self._process()
+            if w:
+                with self.lock:
+                    try:
+                        sent = os.write(self._master, self._out[:65536])
+                    except BlockingIOError:
+                        sent = 0
+                    del self._out[:sent]
+
+    def _process(self):
+        while True:
+            if self._pending_put is not None:
+                space, address, size, padded, opcode = self._pending_put
+                if len(self._in) < padded:
+                    return
+                data = bytes(self._in[:size])
+                del self._in[:padded]
+                self._pending_put = None
+                self._finish_put(space, address, data, opcode)
+                continue
+
+            # find the start of a command
+            start = self._in.find(b"USBA")
+            if start < 0:
+                # keep anything that might be the start of one
+                del self._in[:max(len(self._in)-3, 0)]
+                return
+            del self._in[:start]
+            if len(self._in) < 7:
+                return
+            opcode, space, flags = self._in[4:7]
+            # vectored commands with 64 byte data are 64 byte packets
+            if opcode in (usb2snes.OP_VGET, usb2snes.OP_VPUT) and \
+                    flags & usb2snes.FLAG_DATA64B:
+                cmd_len = 64
+            else:
+                cmd_len = 512
+            if len(self._in) < cmd_len:
+                return
+            cmd = bytes(self._in[:cmd_len])
+            del self._in[:cmd_len]
+            self._command(cmd)
+
+    def _respond(self, flags, error=False, size=0):
+        if flags & usb2snes.FLAG_NORESP:
+            return
+        resp = bytearray(512)
+        resp[0:6] = b"USBA" + bytes([OP_RESPONSE, 1 if error else 0])
+        resp[252:256] = struct.pack(">I", size)
+        self._out += resp
+
+    # send data padded to full blocks
+    def _send_blocks(self, data, block_size=512):
+        self._out += data
+        if len(data) % block_size > 0:
+            self._out += bytes(block_size - len(data) % block_size)
+
+    def _command(self, cmd):
+        opcode, space, flags = cmd[4:7]
+        if opcode in (usb2snes.OP_VGET, usb2snes.OP_VPUT):
+            # regions are a size byte and 24 bit address each
+            regions = []
+            for ri in range(8):
+                size = cmd[32+ri*4]
+                address = int.from_bytes(cmd[33+ri*4:36+ri*4], "big")
+                if size > 0:
+                    regions.append((address, size))
+            block = 64 if flags & usb2snes.FLAG_DATA64B else 512
+            self.commands.append((opcode, space, regions))
+            if opcode == usb2snes.OP_VGET:
+                data = b"".join(self._read_space(space, address, size)
+                    for address, size in regions)
+                self._send_blocks(data, block)
+            else:
+                total = sum(size for address, size in regions)
+                self._pending_put = (space, regions, total,
+                    (total+block-1)//block*block, opcode)
+            return
+
+        size = struct.unpack(">I", cmd[252:256])[0]
+        if space == usb2snes.SPACE_FILE or opcode not in (usb2snes.OP_GET,
+                usb2snes.OP_PUT):
+            arg = cmd[256:].split(b"\x00")[0].decode("ascii", "replace")
+        else:
+            arg = struct.unpack(">I", cmd[256:260])[0]
+        self.commands.append((opcode, space, arg))
+
+        if opcode == usb2snes.OP_GET:
+            if space == usb2snes.SPACE_FILE:
+                parent, name = self._sd_parent(arg)
+                data = None if parent is None else parent.get(name)
+                if not isinstance(data, bytes):
+                    # the real thing would probably crash here
+                    self._respond(flags, error=True)
+                    return
+                self._respond(flags, size=len(data))
+                self._send_blocks(data)
+            else:
+                self._respond(flags, size=size)
+                self._send_blocks(self._read_space(space, arg, size))
+        elif opcode == usb2snes.OP_PUT:
+            if space == usb2snes.SPACE_FILE:
+                parent, name = self._sd_parent(arg)
+                if parent is None or isinstance(parent.get(name), dict):
+                    self._respond(flags, error=True)
+                    return
+            self._respond(flags, size=size)
+            self._pending_put = (space, arg, size, (size+511) & ~511, opcode)
+        elif opcode == usb2snes.OP_LS:
+            directory = self._sd_dir(arg)
+            if directory is None:
+                self._respond(flags, error=True)
+                return
+            self._respond(flags)
+            self._send_listing(directory, root=len(self._split(arg)) == 0)
+        elif opcode == usb2snes.OP_MKDIR:
+            parent, name = self._sd_parent(arg)
+            if parent is None or name in parent:
+                self._respond(flags, error=True)
+                return
+            parent[name] = {}
+            self._respond(flags)
+        elif opcode == usb2snes.OP_RM:
+            parent, name = self._sd_parent(arg)
+            if parent is None or name not in parent:
+                self._respond(flags, error=True)
+                return
+            if isinstance(parent[name], dict) and len(parent[name]) > 0:
+                self._respond(flags, error=True) # directory isn't empty
+                return
+            del parent[name]
+            self._respond(flags)
+        elif opcode == usb2snes.OP_BOOT:
+            self.current_rom = "/" + "/".join(self._split(arg))
+            self._reset_chrono_figure()
+        elif opcode == usb2snes.OP_MENU_RESET:
+            self.current_rom = "/sd2snes/menu.bin"
+            self._reset_chrono_figure()
+        elif opcode == usb2snes.OP_INFO:
+            resp = bytearray(512)
+            resp[0:6] = b"USBA" + bytes([OP_RESPONSE, 0])
+            resp[16:256] = self.current_rom.encode("ascii")[:239].ljust(240,
+                b"\x00")
+            resp[256:260] = struct.pack(">I", self.fw_version)
+            resp[260:324] = b"chrono figure emulator".ljust(64, b"\x00")
+            resp[324:388] = b"sd2snes Mk.III".ljust(64, b"\x00")
+            self._out += resp
+        # OP_RESET and OP_POWER_CYCLE just get remembered
+
+    def _send_listing(self, directory, root):
+        entries = [] if root else [(".", True), ("..", True)]
+        entries.extend((name, isinstance(contents, dict))
+            for name, contents in directory.items())
+        packet = bytearray()
+        for name, is_dir in entries:
+            entry = bytes([0 if is_dir else 1]) + name.encode("ascii") + \
+                b"\x00"
+            # leave room for the end marker
+            if len(packet) + len(entry) > 511:
+                packet.append(0x02) # another packet is coming
+                self._send_blocks(packet)
+                packet = bytearray()
+            packet += entry
+        packet.append(0xFF) # no more entries
+        self._send_blocks(packet)
+
+    def _finish_put(self, space, address, data, opcode):
+        if opcode == usb2snes.OP_VPUT:
+            offset = 0
+            for region_address, size in address:
+                self._write_space(space, region_address,
+                    data[offset:offset+size])
+                offset += size
+        elif space == usb2snes.SPACE_FILE:
+            parent, name = self._sd_parent(address)
+            parent[name] = data
+        else:
+            self._write_space(space, address, data)
+
+    ### memory spaces
+
+    def _read_space(self, space, address, size):
+        if space == usb2snes.SPACE_SNES:
+            address &= 0xFFFFFF
+            return bytes(self.snes[address:address+size]).ljust(size, b"\x00")
+        elif space == usb2snes.SPACE_CHRONO_FIGURE:
+            return self._cf_read(address, size)
+        return bytes(size)
+
+    def _write_space(self, space, address, data):
+        if space == usb2snes.SPACE_SNES:
+            address &= 0xFFFFFF
+            data = data[:(1 << 24)-address]
+            self.snes[address:address+len(data)] = data
+        elif space == usb2snes.SPACE_CHRONO_FIGURE:
+            self._cf_write(address, data)
+
+    def _cf_read(self, address, size):
+        if address == ADDR_EVENT_FIFO:
+            # each 512 byte block is filled from the FIFO in turn, or only the
+            # first one on older firmware. the first word of a block is how
+            # many of the following words are valid.
+            data = bytearray()
+            for block in range((size+511)//512):
+                count = min(len(self.event_fifo), 127)
+                if block > 0 and \
+                        self.fw_version < FIRMWARE_VERSION_FIFO_BLOCKS:
+                    count = 0
+                words = [count] + [self.event_fifo.popleft()
+                    for _ in range(count)]
+                data += struct.pack("<{}I".format(len(words)), *words)
+                data += bytes(512 - 4*len(words))
+            return bytes(data[:size])
+
+        regs = {
+            ADDR_GATEWARE_VERSION: self.gateware_version,
+            ADDR_LOOPBACK: self.loopback,
+            ADDR_RESET: int(self.in_reset),
+            ADDR_SAVE_INHIBIT: int(self.save_inhibit),
+        }
+        data = b"".join(struct.pack("<I", regs.get(address+i, 0))
+            for i in range(0, (size+3) & ~3, 4))
+        return data[:size]
+
+    def _cf_write(self, address, data):
+        data = data + bytes(-len(data) % 4)
+        words = struct.unpack("<{}I".format(len(data)//4), data)
+        if address == ADDR_LOOPBACK:
+            self.loopback = words[0]
+        elif address == ADDR_RESET:
+            self.in_reset = bool(words[0] & 1)
+        elif address == ADDR_SAVE_INHIBIT:
+            self.save_inhibit = bool(words[0] & 1)
+        elif address == ADDR_CLEAR_SAVE_RAM:
+            if words[0] == CLEAR_SAVE_RAM_KEY:
+                self.save_ram_clears += 1
+        elif ADDR_MATCHER_CONFIG <= address < ADDR_MATCHER_CONFIG + \
+                4*PROGRAM_SIZE:
+            # word 0 controls execution and the rest is program memory
+            for wi, word in enumerate(words, (address-ADDR_MATCHER_CONFIG)//4):
+                if wi == 0:
+                    self._control(word & (2**PC_WIDTH-1))
+                elif wi < PROGRAM_SIZE:
+                    self.program[wi] = word & 0x3FFFF
+        elif ADDR_MATCHER_TABLE <= address < ADDR_MATCHER_TABLE + \
+                4*NUM_MATCHERS and \
+                self.fw_version >= FIRMWARE_VERSION_MATCHER_TABLE:
+            # one word per matcher
+            for mi, word in enumerate(words, (address-ADDR_MATCHER_TABLE)//4):
+                if mi < NUM_MATCHERS:
+                    self.matcher_config[4*mi:4*mi+4] = struct.pack("<I", word)
+
+    # zero stops the eventuator and non-zero starts it at that pc. starting
+    # another program while measuring runs it without disturbing the
+    # measurement, like the gateware running it between matches.
+    def _control(self, pc):
+        if pc == 0:
+            self.measuring = False
+            return
+        self._run(pc)
+
+    def _run(self, pc):
+        # run straight-line programs of POKEs
+        for step in range(PROGRAM_SIZE):
+            insn = self.program[pc % PROGRAM_SIZE]
+            code = insn >> 16
+            if code == InsnCode.POKE:
+                special = (insn >> 8) & 0x7F
+                val = insn & 0x1FF
+                if val & 0x100: # sign extend
+                    val -= 0x200
+                if special == SplW.MATCH_CONFIG_ADDR:
+                    self._config_addr = val & 0x3FF
+                elif special == SplW.MATCH_CONFIG_DATA:
+                    if self._config_addr < len(self.matcher_config):
+                        self.matcher_config[self._config_addr] = val & 0xFF
+                    self._config_addr = (self._config_addr + 1) & 0x3FF
+                elif special == SplW.EVENT_FIFO:
+                    self._push_words([val & 0xFFFFFFFF])
+                pc += 1
+            elif code == InsnCode.BRANCH and insn == 0:
+                return # BRANCH(0): stop
+            else:
+                break
+        # anything else must be measuring
+        if self.measuring:
+            return
+        self.measuring = True
+        self.next_event_counter = 0
+        self.event_clock = None
+        if self._next_script is not None:
+            self.event_source, self.event_rate = self._next_script
+            self._next_script = None
+
+    def _reset_chrono_figure(self):
+        self.in_reset = False
+        self.save_inhibit = False
+        self.measuring = False
+
+    ### events
+
+    def _push_words(self, words):
+        if len(self.event_fifo) + len(words) > EVENT_FIFO_DEPTH:
+            return False
+        self.event_fifo.extend(words)
+        return True
+
+    def _produce_events(self):
+        if not self.measuring or self.in_reset:
+            self.event_clock = None
+            return
+        now = time.monotonic()
+        if self.event_clock is None:
+            self.event_clock = now
+        while True:
+            if self.event_rate is None:
+                # as fast as possible, but don't overflow
+                if len(self.event_fifo) + 2 > EVENT_FIFO_DEPTH:
+                    return
+            elif self.event_clock > now:
+                return
+            event = next(self.event_source, None)
+            if event is None:
+                self.event_clock = None
+                return
+            if self.event_rate is not None:
+                self.event_clock += 1/self.event_rate
+
+            end_cycle, wait_cycle = event
+            counter = self.next_event_counter
+            self.next_event_counter = counter % 3 + 1
+            words = [
+                (1 << 30) | ((counter & 1) << 29) | (end_cycle & 0x1FFFFFFF),
+                ((counter >> 1) << 29) | (wait_cycle & 0x1FFFFFFF),
+            ]
+            if not self._push_words(words):
+                self.dropped_events += 1
+
+def _benchmark(emulator, args):
+    import io
+
+    device = usb2snes.USB2SNES()
+    device.connect(emulator.port)
+    device.get_info()
+
+    size = args.file_size*1024*1024
+    data = os.urandom(size)
+    start = time.monotonic()
+    device.write_file_from(io.BytesIO(data), "bench.bin", size)
+    device.list_dir("") # make sure it all arrived
+    elapsed = time.monotonic() - start
+    print("file write: {:.1f} MB/s".format(size/elapsed/1e6))
+
+    start = time.monotonic()
+    got = device.read_file("bench.bin")
+    elapsed = time.monotonic() - start
+    print("file read: {:.1f} MB/s".format(size/elapsed/1e6))
+    if got != data:
+        raise EmulatorError("file came back different")
+    device.disconnect()
+
+    from .interface import ChronoFigureInterface, EVENT_FIFO_BLOCKS
+    for fifo_blocks in sorted({1, EVENT_FIFO_BLOCKS}):
+        emulator.script_events(synthetic_events(args.events), rate=None)
+        cf = ChronoFigureInterface()
+        cf.connect(emulator.port)
+        cf.fifo_blocks = fifo_blocks
+        cf.start_measurement()
+        got = 0
+        start = time.monotonic()
+        while got < args.events:
+            got += len(cf.get_events())
+        elapsed = time.monotonic() - start
+        print("event draining, {} block reads: {:.0f} events/s".format(
+            fifo_blocks, got/elapsed))
+        cf.disconnect()
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Emulate a USB2SNES running Chrono Figure.")
+    parser.add_argument('--sd', type=str,
+        help="Local directory to use as the SD card's initial contents.")
+    parser.add_argument('--events', type=int, default=None,
+        help="Number of synthetic NMI events to produce while measuring "
+            "(default: forever when serving, 100000 when benchmarking).")
+    parser.add_argument('--busy', type=float, default=0.5,
+        help="Fraction of each synthetic frame spent busy.")
+    parser.add_argument('--bench', action="store_true",
+        help="Benchmark file transfer and event draining instead of "
+            "serving.")
+    parser.add_argument('--file-size', type=int, default=16,
+        help="Size of the benchmark file in MiB.")
+    args = parser.parse_args()
+
+    with USB2SNESEmulator() as emulator:
+        if args.sd is not None:
+            emulator.load_sd_dir(args.sd)
+        if args.bench:
+            if args.events is None:
+                args.events = 100000
+            _benchmark(emulator, args)
+        else:
+            emulator.script_events(synthetic_events(args.events,
+                busy=args.busy))
+            print("emulating USB2SNES on", emulator.port)
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
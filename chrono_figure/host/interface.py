@@ -2,6 +2,10 @@
 
 import struct
 import time
+import threading
+from collections import namedtuple, OrderedDict
+
+import numpy as np
 
 from . import usb2snes
 from ..gateware import core as gateware
@@ -9,6 +13,14 @@ from chrono_figure.eventuator.isa import *
 
 # usb2snes expected firmware version
 FIRMWARE_VERSION = 0xC10A0302
+# newer usb2snes firmware versions which also work, each with the features of
+# the ones before it
+# routes writes to ADDR_MATCHER_TABLE
+FIRMWARE_VERSION_MATCHER_TABLE = 0xC10A0303
+# fills every block of a multi-block read of ADDR_EVENT_FIFO
+FIRMWARE_VERSION_FIFO_BLOCKS = 0xC10A0304
+FIRMWARE_VERSIONS = (FIRMWARE_VERSION, FIRMWARE_VERSION_MATCHER_TABLE,
+    FIRMWARE_VERSION_FIFO_BLOCKS)
 
 # chrono figure address space addresses. matches usb2snes's src/chrono_figure.c
 ADDR_GATEWARE_VERSION = 0x00000000
@@ -20,10 +32,70 @@ ADDR_CLEAR_SAVE_RAM = 0x00000010
 CLEAR_SAVE_RAM_KEY = 0x05C1EA12
 
 ADDR_MATCHER_CONFIG = 0x10000000
+# one word per matcher with its configuration, just past program memory. only
+# firmware since FIRMWARE_VERSION_MATCHER_TABLE routes it.
+ADDR_MATCHER_TABLE = 0x10001000
 ADDR_EVENT_FIFO = 0x80000000
 
+# how many words of program memory the eventuator has. word 0 is the control
+# word, so programs can go anywhere after it.
+PROGRAM_MEMORY_SIZE = 1024
+# the firmware accepts at most this many words in one write to program memory
+PROGRAM_UPLOAD_INSNS = 250
+
+# reads from the event FIFO are made of 512 byte blocks, each holding a count
+# word followed by up to 127 event words. on firmware since
+# FIRMWARE_VERSION_FIFO_BLOCKS, every block of a multi-block read is filled
+# from the FIFO in turn, so reading this many at once drains the whole 512 word
+# FIFO in one round trip.
+EVENT_FIFO_BLOCKS = 5
+# how many words the event FIFO holds
+EVENT_FIFO_DEPTH = 512
+# how many events an EventAcquisition holds by default. about an hour of one
+# event per frame.
+EVENT_RING_SIZE = 2**18
+
+# what get_events returns for each event. the cycles are counted from the start
+# of the measurement and counter is the event's 2 bit counter value.
+EVENT_DTYPE = np.dtype([
+    ("end_cycle", np.int64),
+    ("wait_cycle", np.int64),
+    ("counter", np.uint8),
+])
+
+# what an EventAcquisition stores for each event: the event, when the host got
+# it (in time.monotonic() seconds), and whether any events were missed right
+# before it
+ACQUIRED_DTYPE = np.dtype(EVENT_DTYPE.descr + [
+    ("host_time", np.float64),
+    ("missed", np.bool_),
+])
+
 class CFInterfaceError(Exception): pass
 
+# a program resident in eventuator program memory: the address of its first
+# word and its assembled words
+ProgramSlot = namedtuple("ProgramSlot", ["start", "words"])
+
+# pair up raw event FIFO words into events. bit 30 is set on the first word of
+# each event and clear on the second, so an event starts at every first word
+# followed by a second word. any other words are skipped, which will probably
+# trip the missed event check. returns (events, starts): an EVENT_DTYPE array
+# with the raw 29 bit cycles, and the index of each event's first word.
+def decode_event_words(words):
+    first = (words & (1<<30)) != 0
+    starts = np.flatnonzero(first[:-1] & ~first[1:])
+    d0 = words[starts]
+    d1 = words[starts+1]
+
+    events = np.empty(len(starts), dtype=EVENT_DTYPE)
+    events["end_cycle"] = d0 & 0x1FFFFFFF
+    events["wait_cycle"] = d1 & 0x1FFFFFFF
+    # event counter is in the 29th bit of each word, and the first word is the
+    # low bit
+    events["counter"] = ((d0 >> 29) & 1) | (((d1 >> 29) & 1) << 1)
+    return events, starts
+
 # program that emulates the old fixed-function Chrono Fgure
 FIXED_FUNCTION_PROGRAM = ev_assemble([
     L("start", org=1),
@@ -102,11 +174,32 @@ class ChronoFigureInterface:
     def __init__(self):
         # the usb2snes device. we don't have one until we're connected.
         self.device = None
+        # its firmware version, which says what features it has
+        self.fw_version = None
         # what number we expect the next event to be. if it's not this, then we
         # must have missed one
         self.next_event_counter = None
-        # leftover event data that's not yet complete
-        self.last_data = []
+        # leftover event words that aren't yet a complete event
+        self.last_data = np.zeros(0, dtype=np.uint32)
+        # raw end cycle of the last event, to notice when the counter wraps
+        self.last_end_cycle = 0
+        # how much to add to the raw cycle counter values
+        self.wrap_cycles = 0
+        # how many blocks to read from the event FIFO at once. raised when we
+        # connect to firmware that can fill more than one block per read.
+        self.fifo_blocks = 1
+        # the EventAcquisition reading events in the background, if any
+        self.acquisition = None
+        # the matcher table we last wrote, or None if we don't know what's in
+        # it
+        self.matcher_table = None
+        # ProgramSlots resident in program memory by name, least recently used
+        # first
+        self.programs = OrderedDict()
+        # names of the programs started since the eventuator was last stopped.
+        # they might still be running or handling matches, so they can't be
+        # overwritten without stopping it.
+        self.started_programs = set()
 
     def _check_dev(self):
         if self.device is None:
@@ -115,6 +208,7 @@ class ChronoFigureInterface:
     # connect to the usb2snes, test communication, and validate versions. if
     # port is None, try to autodetect it. otherwise, use the given serial port.
     def connect(self, port=None):
+        self.stop_acquisition()
         if self.device is not None:
             self.device.disconnect()
             self.device = None
@@ -129,9 +223,10 @@ class ChronoFigureInterface:
         # make sure the usb2snes is responsive. if it is, validate the returned
         # firmware version
         info = device.get_info()
-        if info.fw_version != FIRMWARE_VERSION:
+        if info.fw_version not in FIRMWARE_VERSIONS:
             m = ("Incorrect usb2snes firmware version: received 0x{:08X} but "
-                "expected 0x{:08X}. ").format(info.fw_version, FIRMWARE_VERSION)
+                "expected one of {}. ").format(info.fw_version, ", ".join(
+                    "0x{:08X}".format(v) for v in FIRMWARE_VERSIONS))
             if (info.fw_version >> 30) != 3:
                 # top 2 bits are set for chrono-figure-enabled firmware versions
                 m += ("The installed firmware does not appear to be Chrono "
@@ -151,16 +246,37 @@ class ChronoFigureInterface:
 
         # everything checks out
         self.device = device
-        self.next_event_counter = None
-        self.last_data = []
+        self.fw_version = info.fw_version
+        if self.fw_version >= FIRMWARE_VERSION_FIFO_BLOCKS:
+            self.fifo_blocks = EVENT_FIFO_BLOCKS
+        else:
+            self.fifo_blocks = 1
+        self._forget_programs()
+        self._forget_events(None)
 
     def disconnect(self):
+        self.stop_acquisition()
         if self.device is not None:
             self.device.disconnect()
             self.device = None
+        self.fw_version = None
+        self.fifo_blocks = 1
 
-        self.next_event_counter = None
-        self.last_data = []
+        self._forget_programs()
+        self._forget_events(None)
+
+    # throw away what we know about the matchers and program memory
+    def _forget_programs(self):
+        self.matcher_table = None
+        self.programs.clear()
+        self.started_programs.clear()
+
+    # throw away event state. next_counter is what the next event should be.
+    def _forget_events(self, next_counter):
+        self.next_event_counter = next_counter
+        self.last_data = np.zeros(0, dtype=np.uint32)
+        self.last_end_cycle = 0
+        self.wrap_cycles = 0
 
     # assert console reset from the cart (cannot reset PPUs). the sd2snes does
     # not see the reset so e.g. save RAM will not be saved. automatically
@@ -186,48 +302,125 @@ class ChronoFigureInterface:
         self.device.write_space(usb2snes.SPACE_CHRONO_FIGURE,
             ADDR_CLEAR_SAVE_RAM, struct.pack("<I", CLEAR_SAVE_RAM_KEY))
 
+    # read everything in the event FIFO and return it as an array of words
     def _read_event_fifo(self):
+        buf = bytearray(512*self.fifo_blocks)
+        blocks = np.frombuffer(buf, dtype="<u4").reshape(-1, 128)
         event_data = []
         while True:
-            new_data = struct.unpack("<128I", self.device.read_space(
-                usb2snes.SPACE_CHRONO_FIGURE, ADDR_EVENT_FIFO, 512))
-            event_data.extend(new_data[1:new_data[0]+1])
-            if new_data[0] < 127:
+            self.device.read_space_into(usb2snes.SPACE_CHRONO_FIGURE,
+                ADDR_EVENT_FIFO, buf)
+            # pick out the valid words of each block
+            counts = np.minimum(blocks[:, 0], 127)
+            valid = np.arange(127) < counts[:, None]
+            event_data.append(blocks[:, 1:][valid])
+            if counts[-1] < 127:
                 break # FIFO can't have more data
-        return event_data
-
-    # run a program on the eventuator and optionally wait for it to complete
-    def _exec_program(self, prg, wait=False):
-        if len(prg) > 250:
-            raise Exception("program is too long at {} insns".format(len(prg)))
-
-        # add instructions so we know when the program ends
-        if wait:
-            prg = [
-                *prg,
-                int(POKE(SplW.EVENT_FIFO, 2)),
-                int(BRANCH(0)),
-            ]
-
-        # stop the eventuator (and clear match FIFO)
-        self.device.write_space(usb2snes.SPACE_CHRONO_FIGURE,
-            ADDR_MATCHER_CONFIG, (0).to_bytes(4, "little"))
-        # clear out any old events
-        self._read_event_fifo()
-        # transfer in the program
-        prg = struct.pack("<{}I".format(len(prg)), *(int(i) for i in prg))
+        return np.concatenate(event_data)
+
+    # put a program into eventuator program memory under the given name so it
+    # can be started by start_program(). prg is either a list of Insns (without
+    # any org labels), which is assembled wherever there's room, or a list of
+    # assembled words, which goes where it was assembled for: start_pc
+    # (default 1). nothing is uploaded if the same program is already resident.
+    # any other programs in the way are evicted, and the eventuator is stopped
+    # first if one of them has been started. returns the program's ProgramSlot.
+    def load_program(self, name, prg, start_pc=None):
+        self._check_dev()
+
+        is_insns = all(isinstance(insn, Insn) for insn in prg)
+        relocatable = start_pc is None and is_insns
+        old = self.programs.get(name)
+        if relocatable: # see if it can stay where it already is
+            start = 1 if old is None else old.start
+        else:
+            start = 1 if start_pc is None else start_pc
+        if is_insns:
+            words = ev_assemble(prg, start_pc=start)
+        else:
+            words = [int(insn) for insn in prg]
+
+        slot = ProgramSlot(start, words)
+        if slot == old: # already there, nothing to do
+            self.programs.move_to_end(name)
+            return slot
+        if old is not None:
+            self._evict_program(name)
+        if relocatable:
+            start = self._find_program_space(len(words))
+            words = ev_assemble(prg, start_pc=start)
+            slot = ProgramSlot(start, words)
+        if start < 1 or start+len(words) > PROGRAM_MEMORY_SIZE:
+            raise CFInterfaceError("program {!r} of {} insns at {} does not "
+                "fit in program memory".format(name, len(words), start))
+
+        # evict everything we are about to overwrite
+        end = start+len(words)
+        for other_name, other in list(self.programs.items()):
+            if other.start < end and start < other.start+len(other.words):
+                self._evict_program(other_name)
+
+        # transfer in the program as big pieces as the firmware can take
+        for offset in range(0, len(words), PROGRAM_UPLOAD_INSNS):
+            chunk = words[offset:offset+PROGRAM_UPLOAD_INSNS]
+            self.device.write_space(usb2snes.SPACE_CHRONO_FIGURE,
+                ADDR_MATCHER_CONFIG+4*(start+offset),
+                struct.pack("<{}I".format(len(chunk)), *chunk))
+        self.programs[name] = slot
+        return slot
+
+    # find where to put a relocatable program of size words. programs are
+    # placed from the top of program memory down, out of the way of the match
+    # vectors at the bottom. the least recently used programs are evicted if
+    # there isn't room.
+    def _find_program_space(self, size):
+        while True:
+            end = PROGRAM_MEMORY_SIZE
+            for slot in sorted(self.programs.values(),
+                    key=lambda slot: slot.start, reverse=True):
+                if end - (slot.start+len(slot.words)) >= size:
+                    return end-size
+                end = min(end, slot.start)
+            if end-1 >= size:
+                return end-size
+
+            for name in self.programs:
+                if name not in self.started_programs:
+                    self._evict_program(name)
+                    break
+            else:
+                raise CFInterfaceError("program of {} insns does not fit in "
+                    "program memory".format(size))
+
+    def _evict_program(self, name):
+        if name in self.started_programs:
+            # don't let it run while it's being overwritten
+            self.stop_program()
+        del self.programs[name]
+
+    # start the named resident program. this is a single write: if the
+    # eventuator is busy, the program starts once it's done, and matches
+    # waiting to be handled stay waiting.
+    def start_program(self, name):
+        self._check_dev()
+        try:
+            slot = self.programs[name]
+        except KeyError:
+            raise CFInterfaceError(
+                "program {!r} is not loaded".format(name)) from None
+
         self.device.write_space(usb2snes.SPACE_CHRONO_FIGURE,
-            ADDR_MATCHER_CONFIG+4, prg)
-        # start the eventuator at the start of the program
+            ADDR_MATCHER_CONFIG, struct.pack("<I", slot.start))
+        self.programs.move_to_end(name)
+        self.started_programs.add(name)
+
+    # stop the eventuator. this also clears out any matches waiting to be
+    # handled.
+    def stop_program(self):
+        self._check_dev()
         self.device.write_space(usb2snes.SPACE_CHRONO_FIGURE,
-            ADDR_MATCHER_CONFIG, (1).to_bytes(4, "little"))
-        # wait for it to finish (if asked)
-        if wait:
-            while True:
-                event_data = self._read_event_fifo()
-                if len(event_data) > 0 and event_data[0] == 2:
-                    break
-                time.sleep(0.01)
+            ADDR_MATCHER_CONFIG, struct.pack("<I", 0))
+        self.started_programs.clear()
 
     def _make_matcher_config(self, address, match_type):
         valid_address = int(address) & 0xFFFFFF
@@ -240,8 +433,15 @@ class ChronoFigureInterface:
 
     # configure the matchers with an iterable of (address, match_type) tuples.
     # if there are less matchers than the number of configurations, the
-    # remaining matchers are disabled.
-    def configure_matchers(self, configs):
+    # remaining matchers are disabled. if the firmware can, the matcher table
+    # is written directly, so this can be done while the eventuator is
+    # running. otherwise, the eventuator has to be stopped to run a program
+    # which configures them, and any events waiting to be read are lost.
+
+    # if only_changed, only the matchers which changed since the last time are
+    # written. this assumes nothing else (e.g. an eventuator program) has
+    # configured them since.
+    def configure_matchers(self, configs, only_changed=False):
         self._check_dev()
 
         # pack configuration into words
@@ -261,11 +461,45 @@ class ChronoFigureInterface:
         config_data.append(b'\x00'*(4*(num_matchers-len(config_data))))
         config_data = b''.join(config_data)
 
-        # build and run a program to configure the matchers
-        prg = [POKE(SplW.MATCH_CONFIG_ADDR, 0)]
-        for byte in config_data:
+        first, last = 0, num_matchers
+        if only_changed and self.matcher_table is not None:
+            changed = np.flatnonzero(
+                np.frombuffer(config_data, dtype="<u4") !=
+                np.frombuffer(self.matcher_table, dtype="<u4"))
+            if len(changed) == 0:
+                return
+            # write every matcher in between too so it's all one write
+            first, last = int(changed[0]), int(changed[-1])+1
+
+        if self.fw_version >= FIRMWARE_VERSION_MATCHER_TABLE:
+            self.device.write_space(usb2snes.SPACE_CHRONO_FIGURE,
+                ADDR_MATCHER_TABLE+4*first, config_data[4*first:4*last])
+        else:
+            self._run_matcher_program(config_data, first, last)
+        self.matcher_table = config_data
+
+    # configure matchers first through last-1 with a program on firmware which
+    # can't write the matcher table
+    def _run_matcher_program(self, config_data, first, last):
+        # build a program to configure the matchers, then say it's done
+        prg = [POKE(SplW.MATCH_CONFIG_ADDR, 4*first)]
+        for byte in config_data[4*first:4*last]:
             prg.append(POKE(SplW.MATCH_CONFIG_DATA, byte))
-        self._exec_program(prg, wait=True)
+        prg.append(POKE(SplW.EVENT_FIFO, 2))
+        prg.append(BRANCH(0))
+
+        # stop whatever was running so it can't produce events, clear out any
+        # old ones, then run the program
+        self.stop_program()
+        self._read_event_fifo()
+        self.load_program("configure_matchers", prg)
+        self.start_program("configure_matchers")
+        # wait for it to finish
+        while True:
+            event_data = self._read_event_fifo()
+            if len(event_data) > 0 and event_data[0] == 2:
+                break
+            time.sleep(0.01)
 
     # reset the console and start measurements
     def start_measurement(self):
@@ -273,62 +507,238 @@ class ChronoFigureInterface:
 
         # assert reset so the console won't interrupt us
         self.assert_reset(True)
-        # start the program running (and clear the event FIFO)
-        self._exec_program(FIXED_FUNCTION_PROGRAM)
-        self.last_data = [] # junk all the unparsed event pieces too
-        # the only event with number 0 is the first event after reset
-        self.next_event_counter = 0
+        # stop whatever was running (and clear the match FIFO) so the fixed
+        # function program starts fresh
+        self.stop_program()
+        # clear out any old events
+        self._read_event_fifo()
+        # start the program running, only transferring it in if it's not
+        # already there
+        self.load_program("fixed_function", FIXED_FUNCTION_PROGRAM)
+        self.start_program("fixed_function")
+        # junk all the unparsed event pieces too. the only event with number 0
+        # is the first event after reset.
+        self._forget_events(0)
         # now that we know there's nothing there, let the console start back up
         # and produce new events
         self.assert_reset(False)
 
-    # get new events and return them as an iterable of (end_cycle, wait_cycle)
-    # pairs. the exact meaning is not covered here. it's recommended to wait at
-    # least 100ms between calls because the usb2snes can get overwhelmed.
+    # get new events and return them as an EVENT_DTYPE array. the exact
+    # meaning is not covered here. it's recommended to wait at least 100ms
+    # between calls because the usb2snes can get overwhelmed.
     def get_events(self):
-        got_events = []
-
-        event_data = self.last_data # remember any half-received events
-        event_data.extend(self._read_event_fifo())
-
-        while len(event_data) > 1: # each event is 2 words
-            d0, d1 = event_data[:2]
-            d0 &= 0x7FFFFFFF
-            d1 &= 0x7FFFFFFF
-            # bit 30 is set on the first word of each event and clear on the
-            # second. skip words until we find a valid first and second. this
-            # will probably trip the "missed event" handler below.
-            if not (d0 & (1<<30)) and (d1 & (1<<30)):
-                event_data = event_data[1:]
-                continue
-
-            # event counter is in the 29th bit of each word, and the first word
-            # is the low bit
-            event_counter = (d0 & (1<<29)) >> 29
-            event_counter |= (d1 & (1<<29)) >> 28
-
-            if event_counter != self.next_event_counter:
-                # if we got some events, return them first. that way the caller
-                # will get all the events except this one. next time they call,
-                # there won't be any, so we will throw the exception.
-                if len(got_events) > 0:
-                    return got_events
+        if self.acquisition is not None:
+            raise CFInterfaceError("events are being acquired in the "
+                "background")
+        return self._read_events(stop_at_missed=True)[0]
+
+    # read and decode the event FIFO. returns (events, missed) where missed is
+    # True for events that came after one or more missed events. if
+    # stop_at_missed, no events after a missed one are returned, and an
+    # exception is raised if the first one is.
+    def _read_events(self, stop_at_missed):
+        if self.next_event_counter is None:
+            raise CFInterfaceError("measurement not started")
+
+        # remember any half-received events
+        words = np.concatenate((self.last_data, self._read_event_fifo()))
+        events, starts = decode_event_words(words)
+
+        # keep the last word if it might be the first half of an event
+        rest = len(words)
+        if rest > 0 and words[-1] & (1<<30):
+            rest -= 1
+
+        # the counter goes 0 for the first event after reset, then 1, 2, 3, 1,
+        # 2, 3, ... so each event's counter follows from the one before
+        counters = events["counter"]
+        expected = np.empty_like(counters)
+        expected[:1] = self.next_event_counter
+        expected[1:] = counters[:-1] % 3 + 1
+        missed = counters != expected
+        if stop_at_missed and np.any(missed):
+            first_missed = np.argmax(missed)
+            if first_missed == 0:
                 raise CFInterfaceError("missed event: got counter value {} but "
                     "expected value {}".format(
-                        event_counter, self.next_event_counter))
-
-            self.next_event_counter += 1
-            if self.next_event_counter == 4:
-                # 0 is reserved for the first event after reset
-                self.next_event_counter = 1
-
-            end_cycle = d0 & 0x1FFFFFFF
-            wait_cycle = d1 & 0x1FFFFFFF
-
-            got_events.append((end_cycle, wait_cycle))
-            event_data = event_data[2:]
-
-        # remember the leftovers for next time
-        self.last_data = event_data
+                        counters[0], self.next_event_counter))
+            # return the events before the missed one first. that way the
+            # caller will get all the events except this one. next time they
+            # call, it will be first, so we will throw the exception.
+            rest = starts[first_missed]
+            events = events[:first_missed]
+            missed = missed[:first_missed]
+
+        self.last_data = words[rest:]
+        if len(events) > 0:
+            self.next_event_counter = int(events["counter"][-1]) % 3 + 1
+            self._unwrap_cycles(events)
+
+        return events, missed
+
+    # the cycle counters are 29 bits and wrap around every 25 seconds or so.
+    # turn them back into cycles since the start of the measurement.
+    def _unwrap_cycles(self, events):
+        end_cycle = events["end_cycle"]
+        wait_cycle = events["wait_cycle"]
+        # the counter wrapped wherever the end cycle goes backwards
+        prev_end = np.concatenate(([self.last_end_cycle], end_cycle[:-1]))
+        wrap_cycles = self.wrap_cycles + \
+            np.cumsum(end_cycle < prev_end) * 2**29
+        self.last_end_cycle = int(end_cycle[-1])
+        self.wrap_cycles = int(wrap_cycles[-1])
+
+        end_cycle += wrap_cycles
+        wait_cycle += wrap_cycles
+        # the wait cycle might have been before the wrap
+        wait_cycle[end_cycle < wait_cycle] -= 2**29
+
+    # start reading events in the background (see EventAcquisition) and return
+    # the EventAcquisition. call this once the measurement has been started.
+    # don't touch Chrono Figure until stop_acquisition() is called.
+    def start_acquisition(self, capacity=EVENT_RING_SIZE, min_period=0.01,
+            max_period=0.1):
+        self._check_dev()
+        if self.acquisition is not None:
+            raise CFInterfaceError("already acquiring events")
+        if self.next_event_counter is None:
+            raise CFInterfaceError("measurement not started")
+
+        self.acquisition = EventAcquisition(self, capacity,
+            min_period, max_period)
+        return self.acquisition
+
+    # stop reading events in the background. events already acquired can still
+    # be read from the EventAcquisition.
+    def stop_acquisition(self):
+        if self.acquisition is None:
+            return
+        self.acquisition._stop()
+        self.acquisition = None
+
+# reads Chrono Figure's events on its own thread so they keep getting read no
+# matter what the caller is doing. the FIFO is read more often while events are
+# coming in quickly and less often while they aren't, to keep it from
+# overflowing without overwhelming the usb2snes. the events are stored in a
+# ring buffer of ACQUIRED_DTYPE which the caller reads from without waiting.
+
+# missed events don't stop acquisition; the event after them is marked missed.
+# so is the oldest event left if the ring buffer fills up and old events have
+# to be thrown away.
+class EventAcquisition:
+    # cf: the ChronoFigureInterface with a measurement running
+    # capacity: how many events the ring buffer can hold
+    # min_period, max_period: range of seconds between reads of the FIFO
+    def __init__(self, cf, capacity, min_period, max_period):
+        self.cf = cf
+        self.min_period = min_period
+        self.max_period = max_period
+        # start out fast because we don't know how fast events are coming
+        self.period = min_period
+
+        self.ring = np.zeros(capacity, dtype=ACQUIRED_DTYPE)
+        # total number of events ever written to and read from the ring. the
+        # ones in between are waiting to be read.
+        self.num_written = 0
+        self.num_read = 0
+        # events thrown away because the ring was full
+        self.num_overrun = 0
+        # exception that stopped the acquisition thread, if any
+        self.error = None
+
+        self.lock = threading.Lock()
+        self.new_events = threading.Condition(self.lock)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._acquire_thread,
+            daemon=True)
+        self.thread.start()
+
+    # is the acquisition thread still reading events?
+    @property
+    def running(self):
+        return self.thread.is_alive()
+
+    # return the events that have been acquired since the last read, up to
+    # max_events of them, as an ACQUIRED_DTYPE array. doesn't wait for events,
+    # so the array may be empty. if the acquisition thread crashed, its
+    # exception is raised once all the events before it have been read.
+    def read(self, max_events=None):
+        with self.lock:
+            available = self.num_written - self.num_read
+            if available == 0 and self.error is not None:
+                error = self.error
+                self.error = None
+                raise CFInterfaceError("event acquisition failed") from error
+            if max_events is not None:
+                available = min(available, max_events)
+
+            capacity = len(self.ring)
+            start = self.num_read % capacity
+            first = self.ring[start:start+available]
+            events = np.concatenate((first, self.ring[:available-len(first)]))
+            self.num_read += available
+        return events
+
+    # wait up to timeout seconds for events to be available to read. returns
+    # True if there are any (or if there is an error to read).
+    def wait(self, timeout=None):
+        with self.new_events:
+            self.new_events.wait_for(lambda: self._readable()
+                or not self.running, timeout)
+            return self._readable()
+
+    def _readable(self):
+        return self.num_written > self.num_read or self.error is not None
+
+    def _stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _acquire_thread(self):
+        try:
+            while not self.stopping.wait(self.period):
+                events, missed = self.cf._read_events(stop_at_missed=False)
+                self._store(events, missed, time.monotonic())
+
+                # read more often if the FIFO got a quarter full and less often
+                # if it was nearly empty
+                words = 2*len(events)
+                if words > EVENT_FIFO_DEPTH//4:
+                    self.period = max(self.period/2, self.min_period)
+                elif words < EVENT_FIFO_DEPTH//16:
+                    self.period = min(self.period*1.25, self.max_period)
+        except Exception as e:
+            with self.lock:
+                self.error = e
+        with self.new_events:
+            self.new_events.notify_all()
+
+    def _store(self, events, missed, host_time):
+        if len(events) == 0:
+            return
+        capacity = len(self.ring)
+        with self.lock:
+            # throw out the oldest events to make room if necessary
+            overrun = self.num_written + len(events) - self.num_read - capacity
+            if overrun > 0:
+                self.num_overrun += overrun
+                if overrun > self.num_written - self.num_read:
+                    # more events than fit in the whole ring
+                    skip = overrun - (self.num_written - self.num_read)
+                    events = events[skip:]
+                    missed = missed[skip:]
+                    self.num_written += skip
+                self.num_read += overrun
+
+            # write them in, wrapping around the end of the ring
+            start = self.num_written % capacity
+            indices = (start + np.arange(len(events))) % capacity
+            for name in EVENT_DTYPE.names:
+                self.ring[name][indices] = events[name]
+            self.ring["host_time"][indices] = host_time
+            self.ring["missed"][indices] = missed
+            self.num_written += len(events)
+            if overrun > 0:
+                self.ring["missed"][self.num_read % capacity] = True
+            self.new_events.notify_all()
 
-        return got_events
@@ -32,6 +32,9 @@
 #                       blob/master/chrono_figure/host/usb2snes.py"
 
 
+import os
+import json
+import time
 import struct
 from collections import namedtuple
 import pathlib
@@ -72,6 +75,8 @@ def detect_port():
 
 OP_GET = 0
 OP_PUT = 1
+OP_VGET = 2
+OP_VPUT = 3
 OP_LS = 4
 OP_MKDIR = 5
 OP_RM = 6
@@ -87,6 +92,12 @@ SPACE_CHRONO_FIGURE = 5
 
 FLAG_NONE = 0
 FLAG_NORESP = 64
+FLAG_DATA64B = 128
+
+# a VGET command reads up to this many regions of SNES memory at once, each up
+# to this many bytes long
+VGET_MAX_REGIONS = 8
+VGET_MAX_SIZE = 255
 
 class USB2SNESError(Exception): pass
 
@@ -113,24 +124,61 @@ class USB2SNES:
     def __init__(self):
         # we don't have a port until we're connected
         self.port = None
+        # directory listings we've already done, so safety checks don't need to
+        # keep asking. keyed by the directory's encoded path (without the
+        # leading slash). we assume nobody else changes the SD card while we
+        # are connected.
+        self.dir_cache = {}
 
     def _ser_read(self, length):
+        read = bytearray(length)
+        self._ser_readinto(read)
+        return bytes(read)
+
+    # fill the whole of buf (anything writable) with data from the port
+    def _ser_readinto(self, buf):
         if self.port is None:
             raise USB2SNESError("not connected")
 
-        read = b""
-        while length > 0:
-            new = self.port.read(length)
-            if len(new) == 0:
+        view = memoryview(buf).cast("B")
+        got = 0
+        while got < len(view):
+            new = self.port.readinto(view[got:])
+            if not new:
                 raise Timeout("read timeout")
-            read += new
-            length -= len(new)
-        return read
+            got += new
+
+    # receive size bytes of data sent in 512 byte blocks into the start of view
+    def _read_blocks_into(self, view, size):
+        # the whole blocks go straight into the buffer
+        whole = size & ~511
+        self._ser_readinto(view[:whole])
+        if size > whole:
+            # and the padded last block goes through a scratch buffer so we
+            # don't write past what was asked for
+            block = bytearray(512)
+            self._ser_readinto(block)
+            view[whole:size] = block[:size-whole]
+
+    # receive size bytes of data sent in 512 byte blocks, yielding it in chunks
+    # of chunk_size (rounded down to a multiple of 512) bytes as they arrive.
+    # each chunk is a memoryview into a reused buffer, so it's only valid until
+    # the next one is yielded.
+    def _iter_blocks(self, size, chunk_size):
+        chunk_size = max(chunk_size & ~511, 512)
+        view = memoryview(bytearray(min(chunk_size, (size+511) & ~511)))
+        remaining = size
+        while remaining > 0:
+            this_size = min(len(view), (remaining+511) & ~511)
+            self._ser_readinto(view[:this_size])
+            yield view[:min(this_size, remaining)]
+            remaining -= this_size
 
     def _ser_write(self, data):
         if self.port is None:
             raise USB2SNESError("not connected")
 
+        data = memoryview(data).cast("B")
         sent_len = 0
         while sent_len != len(data):
             sent_len += self.port.write(data[sent_len:])
@@ -143,6 +191,7 @@ class USB2SNES:
 
         port = serial.Serial(port=port, baudrate=9600, timeout=3)
         self.port = port
+        self.dir_cache = {}
 
     def disconnect(self):
         if self.port is None:
@@ -150,6 +199,7 @@ class USB2SNES:
 
         port = self.port
         self.port = None
+        self.dir_cache = {}
         try:
             port.close()
         except:
@@ -174,6 +224,19 @@ class USB2SNES:
         # and send everything on
         self._ser_write(cmd_buf)
 
+    # send out a vectored (VGET/VPUT) usb2snes command. regions is a list of up
+    # to VGET_MAX_REGIONS (address, size) tuples. the command is a single 64
+    # byte packet and the data is transferred in 64 byte blocks. this function
+    # DOES NOT transfer the data.
+    def _send_vcommand(self, opcode, space, regions):
+        cmd_buf = bytearray(64)
+        cmd_buf[0:7] = b'USBA' + bytes([opcode, space,
+            FLAG_DATA64B | FLAG_NORESP])
+        # each region is a size byte followed by a 24 bit address
+        for ri, (address, size) in enumerate(regions):
+            cmd_buf[32+ri*4:36+ri*4] = struct.pack(">I", (size << 24) | address)
+        self._ser_write(bytes(cmd_buf))
+
     # reset the currently running game (or the menu, if it's currently running)
     def reset_console(self):
         self._send_command(OP_RESET, SPACE_SNES)
@@ -194,8 +257,7 @@ class USB2SNES:
         encoded_path, parts = self.parse_path(path)
         # trying to boot a ROM that doesn't exist will do weird things and
         # require a menu reset, so we don't allow nonexistent ROMs to be booted
-        contents = self.list_dir('/'.join(parts[:-1]))
-        if parts[-1] not in contents:
+        if self.path_kind(path) is None:
             raise FileError(path, "ROM does not exist")
         if "." not in parts[-1]:
             # attempting to boot such names will crash the USB2SNES
@@ -229,25 +291,108 @@ class USB2SNES:
 
     # read some data from a given memory space
     def read_space(self, space, address, size):
+        data = bytearray(size)
+        self.read_space_into(space, address, data)
+        return bytes(data)
+
+    # read enough data from a given memory space to fill buf (which must be
+    # writable, e.g. a bytearray or a memoryview of one)
+    def read_space_into(self, space, address, buf):
+        view = memoryview(buf).cast("B")
         # ask to read the data
         self._send_command(OP_GET, space,
-            arg_size=size, arg_data=struct.pack('>I', address))
+            arg_size=len(view), arg_data=struct.pack('>I', address))
         # receive enough 512 byte blocks to get all of it
-        num_blocks = (size+511) >> 9
-        data = self._ser_read(num_blocks*512)
-        # return only what was asked for
-        return data[:size]
+        self._read_blocks_into(view, len(view))
+
+    # read some data from a given memory space and yield it in chunks as it
+    # arrives. the chunks are only valid until the next one is yielded (see
+    # _iter_blocks). the whole thing has to be read before talking to the
+    # USB2SNES again.
+    def iter_space(self, space, address, size, chunk_size=65536):
+        # ask to read the data
+        self._send_command(OP_GET, space,
+            arg_size=size, arg_data=struct.pack('>I', address))
+        yield from self._iter_blocks(size, chunk_size)
+
+    # read several regions of memory in as few round trips as possible. reads is
+    # a list of (space, address, size) tuples. the data from each is placed one
+    # after the other into buf, which must be writable and at least as big as
+    # all the reads together. if buf is None, a new bytearray is made. returns
+    # buf.
+
+    # small SNES reads are batched into VGET commands (if use_vget is True;
+    # older firmware doesn't support them) and everything else is read with
+    # GETs. all the commands are sent before any of the data is read so the
+    # round trips overlap.
+    def read_spaces(self, reads, buf=None, use_vget=True):
+        total_size = sum(size for space, address, size in reads)
+        if buf is None:
+            buf = bytearray(total_size)
+        view = memoryview(buf).cast("B")
+        if len(view) < total_size:
+            raise USB2SNESError("buffer is too small: need {} bytes, "
+                "got {}".format(total_size, len(view)))
+
+        # list of (vget regions or None, space, address, size, buffer
+        # positions) for each command
+        commands = []
+        vget_regions = []
+        vget_pos = []
+        pos = 0
+        for space, address, size in reads:
+            if size <= 0:
+                continue
+            if use_vget and space == SPACE_SNES and size <= VGET_MAX_SIZE \
+                    and address + size <= (1 << 24):
+                vget_regions.append((address, size))
+                vget_pos.append(pos)
+                if len(vget_regions) == VGET_MAX_REGIONS:
+                    commands.append((vget_regions, space, None, None, vget_pos))
+                    vget_regions, vget_pos = [], []
+            else:
+                commands.append((None, space, address, size, pos))
+            pos += size
+        if len(vget_regions) > 0:
+            commands.append((vget_regions, SPACE_SNES, None, None, vget_pos))
+
+        # send everything out
+        for regions, space, address, size, pos in commands:
+            if regions is not None:
+                self._send_vcommand(OP_VGET, space, regions)
+            else:
+                self._send_command(OP_GET, space,
+                    arg_size=size, arg_data=struct.pack('>I', address))
+
+        # then receive the data in the same order
+        for regions, space, address, size, pos in commands:
+            if regions is not None:
+                # the regions come back one after the other, padded out to a
+                # 64 byte block
+                region_size = sum(size for address, size in regions)
+                data = self._ser_read((region_size+63) & ~63)
+                offset = 0
+                for (address, size), p in zip(regions, pos):
+                    view[p:p+size] = data[offset:offset+size]
+                    offset += size
+            else:
+                self._read_blocks_into(view[pos:pos+size], size)
+
+        return buf
 
     # write some data to a given memory space
     def write_space(self, space, address, data):
         # say that we're writing some data
         self._send_command(OP_PUT, space,
             arg_size=len(data), arg_data=struct.pack('>I', address))
-        # pad it out to full 512 byte blocks
-        if len(data) % 512 > 0:
-            data += b'\x00'*(512-(len(data)%512))
-        # then send it along
+        # then send it along, padded out to full 512 byte blocks
+        self._write_blocks(data)
+
+    # send data out in 512 byte blocks, padding the last one with zeros
+    def _write_blocks(self, data):
         self._ser_write(data)
+        if len(data) % 512 > 0:
+            self._ser_write(bytes(512-(len(data)%512)))
 
 
     # parse a path and return the final encoded filename along with the list of
@@ -278,6 +423,9 @@ class USB2SNES:
         return encoded_path, parts
 
 
+    # list the contents of a directory. returns a dict of name -> "dir" or
+    # "file". always asks the USB2SNES, and remembers the result in the
+    # directory cache.
     def list_dir(self, path):
         encoded_path, parts = self.parse_path(path)
         self._send_command(OP_LS, SPACE_FILE, arg_data=encoded_path, resp=True)
@@ -307,11 +455,44 @@ class USB2SNES:
                 else:
                     list_result[filename] = "file"
 
+        self.dir_cache[encoded_path] = dict(list_result)
         return list_result
 
+    # like list_dir, but uses the directory cache if possible. the returned
+    # dict must not be modified.
+    def cached_list_dir(self, path):
+        encoded_path, parts = self.parse_path(path)
+        contents = self.dir_cache.get(encoded_path)
+        if contents is None:
+            self.list_dir(path)
+            contents = self.dir_cache[encoded_path]
+        return contents
+
+    # return "dir" or "file" depending on what's at the given path, or None if
+    # there is nothing there. uses the directory cache.
+    def path_kind(self, path):
+        encoded_path, parts = self.parse_path(path)
+        if len(parts) == 1:
+            return "dir" # the root directory
+        parent = '/'.join(parts[:-1])
+        if self.path_kind(parent) != "dir":
+            return None # no directory to be in
+        return self.cached_list_dir(parent).get(parts[-1])
+
+    # forget the cached listings of the given path's parent directory and, if
+    # it's a directory, everything in it
+    def _forget_dir(self, parts):
+        parent = "/".join(parts[1:-1]).encode("ascii")
+        encoded_path = "/".join(parts[1:]).encode("ascii")
+        self.dir_cache.pop(parent, None)
+        for cached in list(self.dir_cache.keys()):
+            if cached == encoded_path or cached.startswith(encoded_path+b"/"):
+                del self.dir_cache[cached]
+
     # create an empty directory
     def make_dir(self, path):
         encoded_path, parts = self.parse_path(path)
+        self._forget_dir(parts)
 
         self._send_command(OP_MKDIR, SPACE_FILE,
             arg_data=encoded_path, resp=True)
@@ -319,13 +500,13 @@ class USB2SNES:
         if resp[5]:
             raise FileError(path, "failed to create directory")
 
-    # read a file from the SD card and return its data as bytes
-    def read_file(self, path):
+    # start reading a file from the SD card. returns its size. the data then
+    # has to be received in 512 byte blocks before doing anything else.
+    def _start_read_file(self, path):
         encoded_path, parts = self.parse_path(path)
         # trying to read a file that does not exist will crash the USB2SNES, so
         # we ensure it's in the directory before we try
-        contents = self.list_dir('/'.join(parts[:-1]))
-        if parts[-1] not in contents:
+        if self.path_kind(path) != "file":
             raise FileError(path, "file does not exist")
 
         self._send_command(OP_GET, SPACE_FILE, arg_data=encoded_path, resp=True)
@@ -334,39 +515,117 @@ class USB2SNES:
             raise FileError(path, "failed to read file (this probably crashed "
                 "the USB2SNES)")
 
-        file_size = struct.unpack(">I", resp[252:256])[0]
-        num_blocks = (file_size+511) >> 9
-        data = []
-        for block in range(num_blocks):
-            data.append(self._ser_read(512))
-        data = b''.join(data)[:file_size]
+        return struct.unpack(">I", resp[252:256])[0]
 
-        return data
+    # read a file from the SD card and return its data as bytes
+    def read_file(self, path):
+        file_size = self._start_read_file(path)
+        data = bytearray(file_size)
+        self._read_blocks_into(memoryview(data), file_size)
+        return bytes(data)
+
+    # read a file from the SD card into the start of buf (which must be
+    # writable) and return the file's size
+    def read_file_into(self, path, buf):
+        view = memoryview(buf).cast("B")
+        file_size = self._start_read_file(path)
+        if file_size > len(view):
+            # we have to receive it anyway to keep in sync with the USB2SNES
+            for chunk in self._iter_blocks(file_size, 65536):
+                pass
+            raise FileError(path, "file is {} bytes but buffer only holds "
+                "{}".format(file_size, len(view)))
+        self._read_blocks_into(view, file_size)
+        return file_size
+
+    # read a file from the SD card and write it to fileobj (anything with a
+    # write method) in chunks of chunk_size bytes as it arrives. if given,
+    # progress(bytes_done, total_bytes) is called after every chunk. returns
+    # the file's size.
+    def read_file_to(self, path, fileobj, progress=None, chunk_size=65536):
+        file_size = self._start_read_file(path)
+        done = 0
+        if progress is not None:
+            progress(done, file_size)
+        for chunk in self._iter_blocks(file_size, chunk_size):
+            fileobj.write(chunk)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, file_size)
+        return file_size
+
+    # read a file from the SD card and yield its data in chunks as it arrives.
+    # the chunks are only valid until the next one is yielded (see
+    # _iter_blocks). the whole file has to be read before talking to the
+    # USB2SNES again.
+    def iter_file(self, path, chunk_size=65536):
+        file_size = self._start_read_file(path)
+        yield from self._iter_blocks(file_size, chunk_size)
 
     # fill some file with bytes on the SD card. if it exists, the file is
     # overwritten
     def write_file(self, data, path):
+        self._start_write_file(path, len(data))
+        # send the file data, padded out to full 512 byte blocks
+        self._write_blocks(data)
+
+    # start writing a file of size bytes to the SD card. the data then has to be
+    # sent in 512 byte blocks before doing anything else.
+    def _start_write_file(self, path, size):
         encoded_path, parts = self.parse_path(path)
 
         if parts == ["", "sd2snes", "config.yml"]:
             raise FileError(path, "failed to write file: writing to "
                 "sd2snes/config.yml would crash the USB2SNES")
+        self._forget_dir(parts)
 
         self._send_command(OP_PUT, SPACE_FILE,
-            arg_size=len(data), arg_data=encoded_path, resp=True)
+            arg_size=size, arg_data=encoded_path, resp=True)
         resp = self._ser_read(512)
         if resp[5]:
             raise FileError(path, "failed to write file")
 
-        # pad the file data out to full 512 byte blocks
-        if len(data) % 512 > 0:
-            data += b'\x00'*(512-(len(data)%512))
-        # then send it along
-        self._ser_write(data)
+    # fill some file on the SD card with size bytes read from fileobj (anything
+    # with a readinto method, like a file opened in binary mode). if it exists,
+    # the file is overwritten. the data is sent in chunks of chunk_size bytes
+    # (rounded down to a multiple of 512) through one reused buffer. if given,
+    # progress(bytes_done, total_bytes) is called after every chunk.
+    def write_file_from(self, fileobj, path, size, progress=None,
+            chunk_size=65536):
+        self._start_write_file(path, size)
+
+        chunk_size = max(chunk_size & ~511, 512)
+        view = memoryview(bytearray(min(chunk_size, (size+511) & ~511)))
+        done = 0
+        short = False
+        if progress is not None:
+            progress(done, size)
+        while done < size:
+            this_size = min(len(view), size-done)
+            got = 0
+            while got < this_size and not short:
+                new = fileobj.readinto(view[got:this_size])
+                if not new:
+                    short = True
+                else:
+                    got += new
+            # pad the chunk out to full 512 byte blocks (and make up for a short
+            # file; the USB2SNES is still expecting all the data)
+            padded = (this_size+511) & ~511
+            view[got:padded] = bytes(padded-got)
+            self._ser_write(view[:padded])
+            done += this_size
+            if progress is not None:
+                progress(done, size)
+
+        if short:
+            raise FileError(path, "source ended before {} bytes were "
+                "written".format(size))
 
     # remove a file (or empty directory) from the SD card
     def remove_file(self, path):
         encoded_path, parts = self.parse_path(path)
+        self._forget_dir(parts)
 
         self._send_command(OP_RM, SPACE_FILE,
             arg_data=encoded_path, resp=True)
@@ -375,6 +634,99 @@ class USB2SNES:
             raise FileError(path, "failed to remove")
 
 
+# name of the file sync_dir() uses to remember what it has sent
+SYNC_MANIFEST = ".usb2snes_sync.json"
+
+# make sure the given directory (and all its parents) exist on the SD card
+def make_dirs(usb2snes, path):
+    encoded_path, parts = usb2snes.parse_path(path)
+    for end in range(2, len(parts)+1):
+        sub_path = "/".join(parts[1:end])
+        kind = usb2snes.path_kind(sub_path)
+        if kind is None:
+            usb2snes.make_dir(sub_path)
+        elif kind != "dir":
+            raise FileError(sub_path, "not a directory")
+
+# mirror the local directory tree source into the directory dest on the SD card.
+# files are only sent if they're missing or if their size or modification time
+# has changed since they were last synced. the USB2SNES can't tell us file sizes
+# without reading the whole file, so those are remembered in a manifest file
+# (SYNC_MANIFEST) in dest. if dry_run, nothing is changed. log(message) is
+# called for each file sent and progress is passed to write_file_from. returns
+# (number of files sent, number of files already up to date).
+def sync_dir(usb2snes, source, dest, dry_run=False, log=print, progress=None):
+    source = pathlib.Path(source).resolve(strict=True)
+    if not source.is_dir():
+        raise FileError(str(source), "source is not a directory")
+    dest = usb2snes.parse_path(dest)[0].decode("ascii")
+    manifest_path = dest + "/" + SYNC_MANIFEST
+
+    if usb2snes.path_kind(dest) is None:
+        manifest = {}
+        if not dry_run:
+            make_dirs(usb2snes, dest)
+    elif usb2snes.path_kind(manifest_path) == "file":
+        manifest = json.loads(usb2snes.read_file(manifest_path))
+    else:
+        manifest = {}
+
+    sent, up_to_date = 0, 0
+    changed = False
+    try:
+        for dir_path, dir_names, file_names in os.walk(source):
+            dir_names.sort()
+            rel_dir = pathlib.Path(dir_path).relative_to(source).as_posix()
+            card_dir = dest if rel_dir == "." else dest + "/" + rel_dir
+
+            kind = usb2snes.path_kind(card_dir)
+            if kind is None:
+                if not dry_run:
+                    usb2snes.make_dir(card_dir)
+                contents = {}
+            elif kind == "dir":
+                contents = usb2snes.cached_list_dir(card_dir)
+            else:
+                raise FileError(card_dir, "not a directory")
+
+            for name in sorted(file_names):
+                local = pathlib.Path(dir_path)/name
+                card_path = card_dir + "/" + name
+                key = card_path[len(dest)+1:]
+                st = local.stat()
+                want = [st.st_size, st.st_mtime_ns]
+                if contents.get(name) == "file" and manifest.get(key) == want:
+                    up_to_date += 1
+                    continue
+                if contents.get(name) == "dir":
+                    raise FileError(card_path, "is a directory")
+
+                log("{} -> {}".format(local, card_path))
+                sent += 1
+                if dry_run:
+                    continue
+                with open(local, "rb") as f:
+                    usb2snes.write_file_from(f, card_path, st.st_size,
+                        progress=progress)
+                manifest[key] = want
+                changed = True
+    finally:
+        # remember what we did send even if something went wrong
+        if changed:
+            usb2snes.write_file(
+                json.dumps(manifest, sort_keys=True).encode("ascii"),
+                manifest_path)
+
+    return sent, up_to_date
+
+# show how far along a file transfer is
+def print_progress(done, total):
+    percent = 100 if total == 0 else done*100//total
+    print("\r{:3d}% ({}/{} bytes)".format(percent, done, total), end="",
+        flush=True)
+    if done == total:
+        print()
+
 def file_action(args, usb2snes):
     if args.action == "ls":
         contents = usb2snes.list_dir(args.path)
@@ -397,18 +749,22 @@ def file_action(args, usb2snes):
             dest = dest/parts[-1]
 
         print(encoded_path.decode("ascii"), "->", dest)
-        data = usb2snes.read_file(args.source_path)
-        dest.write_bytes(data)
+        with open(dest, "wb") as f:
+            try:
+                usb2snes.read_file_to(args.source_path, f,
+                    progress=print_progress)
+            except:
+                # don't leave half a file behind
+                f.close()
+                dest.unlink()
+                raise
     elif args.action == "put":
         source = pathlib.Path(args.source_path).resolve(strict=True)
         dest = args.dest_path
         encoded_path, parts = usb2snes.parse_path(dest)
 
         # if the destination is a directory, put a file in that directory
-        if len(parts) == 1:
-            kind = "dir" # the root directory
-        else:
-            kind = usb2snes.list_dir('/'.join(parts[:-1])).get(parts[-1])
+        kind = usb2snes.path_kind(dest)
         if dest.endswith("/") and kind == "file":
             raise FileError(dest, "destination is not a directory")
         if kind == "dir":
@@ -416,8 +772,14 @@ def file_action(args, usb2snes):
             encoded_path, _ = usb2snes.parse_path(dest)
 
         print(source, "->", encoded_path.decode("ascii"))
-        data = source.read_bytes()
-        usb2snes.write_file(data, dest)
+        with open(source, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            usb2snes.write_file_from(f, dest, size, progress=print_progress)
+    elif args.action == "sync":
+        sent, up_to_date = sync_dir(usb2snes, args.source_path, args.dest_path,
+            dry_run=args.dry_run, progress=print_progress)
+        print("{} {} file(s), {} already up to date".format(
+            "would send" if args.dry_run else "sent", sent, up_to_date))
     elif args.action == "rm":
         usb2snes.remove_file(args.path)
     elif args.action == "mkdir":
@@ -426,7 +788,6 @@ def file_action(args, usb2snes):
 
 if __name__ == "__main__":
     import argparse
-    import time
 
     parser = argparse.ArgumentParser(description="Command USB2SNES.")
     parser.add_argument('--port', type=str, help="Serial port USB2SNES is "
@@ -466,6 +827,16 @@ if __name__ == "__main__":
         help="Path to file on SD card.")
     p_put.set_defaults(action="put")
 
+    p_sync = sps.add_parser('sync', description="Copy a directory tree to SD "
+        "card, skipping files that haven't changed since the last sync.")
+    p_sync.add_argument('source_path', type=str,
+        help="Path to directory on computer.")
+    p_sync.add_argument('dest_path', type=str, default="", nargs='?',
+        help="Path to directory on SD card.")
+    p_sync.add_argument('-n', '--dry-run', action="store_true",
+        help="Only show what would be sent.")
+    p_sync.set_defaults(action="sync")
+
     p_rm = sps.add_parser('rm', description="Remove a file from SD card.")
     p_rm.add_argument('path', type=str,
         help="Path to file on SD card.")
@@ -6,6 +6,7 @@
 # ffmpeg -i F -hide_banner -v quiet -f s16le -ac 2 -ar 32000 -acodec pcm_s16le -
 
 # pipe it like: <ffmpeg command> | python3 smw_play_pcm.py <TASHA serial port>
+# or run "python3 smw_play_pcm.py --benchmark" to check the encoder speed.
 
 import sys
 import time
@@ -13,7 +14,7 @@ import time
 import numpy as np
 
 from tasha.host.latch_streamer import LatchStreamer
-from tasha.host.ls_utils import StatusPrinter, stream_loop
+from tasha.host.ls_utils import StatusPrinter, LatchProducer, stream_loop
 
 def bitswap(b):
     b = (b&0xF0) >> 4 | (b&0x0F) << 4
@@ -127,60 +128,114 @@ def twiddle(packed_pcm):
 
     return [(b0<<8)+b1, (b2<<8)+b3, (b4<<8)+b5, (b6<<8)+b7]
 
-# precompute all the bit shuffling that twiddle does above so we can emulate it
-# with a fancy index
-def calculate_twiddle_table():
-    twiddle_table = np.empty(64, dtype=np.uint8)
-    for bit in range(64):
-        # set the given bit in the input data
-        bits_in = np.zeros(64, dtype=np.bool)
-        bits_in[bit] = True
-        # pack the 64 bits into 8 bytes, then twiddle them into buttons
-        twiddled = twiddle(np.packbits(bits_in))
-        # convert the twiddled words back into bytes, then into their bits
-        twiddled_bytes = np.asarray(twiddled, dtype=np.uint16).view(np.uint8)
-        twiddled_bits = np.unpackbits(twiddled_bytes)
-        # the bit that got set in the output came from the bit we set in the
-        # input
-        twiddle_table[int(np.nonzero(twiddled_bits)[0])] = bit
-
-    return twiddle_table
-
-twiddle_table = calculate_twiddle_table()
-
-leftovers = None
-def read_latches(num_latches):
-    global leftovers
-    pcm_data = sys.stdin.buffer.read(num_latches*8)
+# samples are 16 bits, so we can precompute where twiddle scatters the bits of
+# every possible sample. each entry holds all four buttons words (word n in bits
+# 16n+15 to 16n) for a sample in the first position of the latch. the XOR to
+# prepare the sample for transmission is folded in too.
+def calculate_scatter_table():
+    samples = np.arange(65536, dtype=np.uint64) ^ 0xA804
+    scatter_table = np.zeros(65536, dtype=np.uint64)
+    for bit in range(16):
+        # see where this bit of the first sample ends up in the buttons
+        words = twiddle([(1<<bit) & 0xFF, (1<<bit) >> 8, 0, 0, 0, 0, 0, 0])
+        mask = sum(word << (16*wi) for wi, word in enumerate(words))
+        scatter_table |= ((samples >> bit) & 1) * np.uint64(mask)
+
+    return scatter_table
+
+scatter_table = calculate_scatter_table()
+
+# turn an (n, 4) array of samples into an (n, 4) array of button words. the
+# samples in the other three positions end up in the same places as the first
+# but 4, 8, and 12 bits lower in each word, so one table does it all.
+def encode_pcm(samples):
+    samples = samples.astype(np.uint16, copy=False)
+    buttons = scatter_table[samples[:, 0]]
+    buttons |= scatter_table[samples[:, 1]] >> np.uint64(4)
+    buttons |= scatter_table[samples[:, 2]] >> np.uint64(8)
+    buttons |= scatter_table[samples[:, 3]] >> np.uint64(12)
+    # pull the words back out (they're in little-endian order)
+    return buttons.astype("<u8").view("<u2").reshape(-1, 4).astype(np.uint16)
+
+# make sure the encoder matches twiddle and see how fast it goes
+def benchmark(seconds=60):
+    rng = np.random.default_rng(0)
+    # 32KHz stereo is 16000 latches of 4 samples per second
+    samples = rng.integers(0, 65536, size=(seconds*16000, 4), dtype=np.uint16)
+
+    check = samples[:2000]
+    start = time.perf_counter()
+    expected = [twiddle(s.tobytes()) for s in check ^ 0xA804]
+    twiddle_time = time.perf_counter()-start
+    if not np.array_equal(encode_pcm(check), np.asarray(expected)):
+        raise Exception("encoder does not match twiddle!")
+
+    start = time.perf_counter()
+    # encode in the same block size stream_loop asks for
+    for block_start in range(0, len(samples), 10000):
+        encode_pcm(samples[block_start:block_start+10000])
+    encode_time = time.perf_counter()-start
+
+    print("twiddle: {:.2f}x realtime".format(len(check)/16000/twiddle_time))
+    print("encoder: {:.2f}x realtime ({:.1f}ms for {}s of audio)".format(
+        seconds/encode_time, encode_time*1000, seconds))
+
+if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+    benchmark()
+    exit(0)
+
+# the PCM is read and encoded on its own thread so a slow pipe can't hold up
+# communication. it's read straight into this buffer, which holds one block.
+BLOCK_LATCHES = 2000 # 125ms of audio
+pcm_buf = bytearray(BLOCK_LATCHES*8)
+pcm_view = memoryview(pcm_buf)
+pcm_samples = np.frombuffer(pcm_buf, dtype="<u2").reshape(-1, 4)
+# number of bytes of an incomplete latch at the start of the buffer
+pcm_leftover = 0
+
+def fill_latches(block):
+    global pcm_leftover
+    got = pcm_leftover
+    while got < len(pcm_buf):
+        num_read = sys.stdin.buffer.readinto(pcm_view[got:])
+        if not num_read: # end of the stream
+            break
+        got += num_read
+
     # we can only process whole latches (4 samples) at a time
-    if leftovers is not None:
-        pcm_data = leftovers + pcm_data
-        leftovers = None
-    if len(pcm_data) % 8 != 0:
-        num_latches = len(pcm_data)//8
-        pcm_data, leftovers = pcm_data[:num_latches*8], pcm_data[num_latches*8:]
-
-    # split apart PCM data into bits
-    pcm_bits = np.frombuffer(pcm_data, dtype=np.uint16).reshape(-1, 4)
-    pcm_bits = pcm_bits ^ 0xA804 # XOR to prepare for transmission
-    pcm_bits = np.unpackbits(pcm_bits.view(np.uint8)).reshape(-1, 64)
-    # twiddle them according to the table we prepared earlier
-    twiddled_bits = pcm_bits[:, twiddle_table]
-    # convert the bits back to buttons
-    latch_data = np.packbits(twiddled_bits).view(np.uint16).reshape(-1, 4)
-    # and now it's ready for the console
-    return latch_data
+    num_latches = got//8
+    if num_latches == 0:
+        return 0 # the stream is over
+    block[:num_latches] = encode_pcm(pcm_samples[:num_latches])
+    # save the incomplete latch for next time
+    pcm_leftover = got - num_latches*8
+    pcm_buf[:pcm_leftover] = pcm_buf[num_latches*8:got]
+
+    return num_latches
+
+# 32KHz stereo is 16000 latches of 4 samples per second
+producer = LatchProducer(fill_latches, num_controllers=4,
+    block_latches=BLOCK_LATCHES, latch_rate=16000)
+producer.start()
 
 latch_streamer = LatchStreamer(controllers=["p1d0", "p1d1", "p2d0", "p2d1"])
 # enough priming latches to tide us over even at max latch speed
 num_priming_latches = 2500
 print("Loading priming latches...")
 while latch_streamer.latch_queue_len < num_priming_latches:
-    latch_streamer.add_latches(read_latches(
-        num_priming_latches-latch_streamer.latch_queue_len))
+    latches = producer.read_latches(
+        num_priming_latches-latch_streamer.latch_queue_len)
+    if latches is None: # the audio is over already
+        num_priming_latches = latch_streamer.latch_queue_len
+        break
+    elif len(latches) == 0: # wait for the producer
+        time.sleep(0.01)
+    else:
+        latch_streamer.add_latches(latches)
 
 printer = StatusPrinter()
+producer.status_cb = printer.status_cb
 latch_streamer.connect(sys.argv[1], status_cb=printer.status_cb,
     num_priming_latches=num_priming_latches)
 
-stream_loop(latch_streamer, read_latches)
+stream_loop(latch_streamer, producer.read_latches)
@@ -57,7 +57,8 @@
 # playback status packet format
 # first word: header (always 0x7A5A)
 # second word: result
-#   bits 7-0: number of parameters, always 3 for the playback system's responses
+#   bits 7-0: number of parameters, 3 for regular status packets and 8 for
+#             extended status packets
 #   bits 15-8: result code, always 0x10 for the playback system's responses
 # third word: last error:
 #              REGULAR ERRORS
@@ -67,7 +68,23 @@
 #              0x40=buffer underrun, 0x41=missed latch
 #  fourth word: stream position
 # fifth word: buffer space remaining
-#  sixth word: CRC of previous words (except first)
+# (extended status packets only) sixth through tenth words: the performance
+#   counters, in the order of PERF_COUNTERS below. consult gateware/perf.py for
+#   their meanings. they are reset once sent.
+#  last word: CRC of previous words (except first)
+
+# timestamp packet format (only sent if timestamp capture is enabled)
+# first word: header (always 0x7A5A)
+# second word: result
+#   bits 7-0: number of parameters, 2*N+1 where N is the number of timestamps
+#   bits 15-8: result code, always 0x11
+# third word: timestamp FIFO status, as read from the SNES peripheral. bit 15 is
+#             set if timestamps were dropped since the last timestamp packet.
+# next 2*N words: N latch timestamps, oldest first. each is a low word then a
+#                 high word. consult gateware/snes.py for their meaning.
+# last word: CRC of previous words (except first)
+# if there are timestamps waiting, a timestamp packet with up to
+# MAX_TIMESTAMPS_PER_PACKET of them is sent right after every status packet.
 
 # commands
 # command 0x10: send latches
@@ -87,6 +104,14 @@
 #   parameter 3: unused
 #   purpose: request a status packet be immediately sent.
 
+# command 0x12: request extended status
+#   parameter 1: unused
+#   parameter 2: unused
+#   parameter 3: unused
+#   purpose: request an extended status packet be immediately sent. if a status
+#            packet is being sent because of an error before the request is
+#            received, it will be an extended status packet instead.
+
 import random
 from enum import IntEnum
 
@@ -96,7 +121,8 @@ from .bonetools import *
 
 from ..gateware.periph_map import p_map
 
-__all__ = ["make_firmware", "ErrorCode"]
+__all__ = ["make_firmware", "ErrorCode", "PERF_COUNTERS",
+    "MAX_TIMESTAMPS_PER_PACKET"]
 
 class ErrorCode(IntEnum):
     NONE = 0x00
@@ -120,6 +146,18 @@ controller_name_to_addr = {
     "apu_freq_advanced": p_map.snes.w_apu_freq_advanced,
 }
 
+# performance counters sent in extended status packets, in order
+PERF_COUNTERS = (
+    ("rx_overruns", p_map.perf.r_rx_overruns),
+    ("rx_high_water", p_map.perf.r_rx_high_water),
+    ("latches", p_map.perf.r_latches),
+    ("latch_delay_max", p_map.perf.r_latch_delay_max),
+    ("idle_polls", p_map.perf.r_idle_polls),
+)
+
+# keep timestamp packets small so they don't hold up the status packets much
+MAX_TIMESTAMPS_PER_PACKET = 32
+
 # MEMORY MAP
 # We have a 32K word RAM into which we have to fit all the code, buffers, and
 # register windows. We need as large a buffer as possible. We don't bother with
@@ -161,6 +199,9 @@ class Vars(IntEnum):
     stream_pos = 2
     last_error = 3
 
+    # nonzero if the next status packet should be an extended one
+    ext_status = 4
+
 # return instructions that calculate the address of the latch from the buffer
 # index (multiply by number of controllers and add base)
 def i_calc_latch_addr(dest, src, num_controllers):
@@ -309,8 +350,9 @@ def f_update_interface(controller_addrs, buf_size):
 
     return fw
 
-# jumps right back to main loop
-def send_status_packet(buf_size):
+# jumps right back to main loop (after sending a timestamp packet if timestamps
+# are enabled)
+def send_status_packet(buf_size, timestamps):
     lp = "_{}_".format(random.randrange(2**32))
     r = RegisterManager(
         "R7:lr R6:comm_word R5:txlr R4:temp "
@@ -340,7 +382,13 @@ def send_status_packet(buf_size):
         # then reset the UART CRC
         STXA(r.temp, p_map.uart.w_crc_reset), # we can write anything
 
+        # the extended status packet has more parameters
         MOVI(r.comm_word, 0x1003),
+        LD(r.temp, r.vars, Vars.ext_status),
+        AND(r.temp, r.temp, r.temp),
+        BZ(lp+"send_result"),
+        MOVI(r.comm_word, 0x1003+len(PERF_COUNTERS)),
+    L(lp+"send_result"),
         JAL(r.txlr, lp+"tx_comm_word"),
         MOV(r.comm_word, r.last_error),
         JAL(r.txlr, lp+"tx_comm_word"),
@@ -348,8 +396,23 @@ def send_status_packet(buf_size):
         JAL(r.txlr, lp+"tx_comm_word"),
         MOV(r.comm_word, r.space_remaining),
         JAL(r.txlr, lp+"tx_comm_word"),
+
+        # send the performance counters if this is an extended packet
+        LD(r.temp, r.vars, Vars.ext_status),
+        AND(r.temp, r.temp, r.temp),
+        BZ(lp+"send_crc"),
+        MOVI(r.stream_pos, 0), # the next one will be regular again
+        ST(r.stream_pos, r.vars, Vars.ext_status),
+    ])
+    for name, counter_addr in PERF_COUNTERS:
+        fw.append([
+            LDXA(r.comm_word, counter_addr),
+            JAL(r.txlr, lp+"tx_comm_word"),
+        ])
+    fw.append([
+    L(lp+"send_crc"),
         # CRC is still being calculated, prepare for return
-        MOVR(r.txlr, "main_loop"), # return destination
+        MOVR(r.txlr, lp+"timestamps" if timestamps else "main_loop"),
         # reset the timer to send another status packet in another 25ms
         MOVI(r.temp, int((12e6*(25/1000))/256)),
         STXA(r.temp, p_map.timer.timer[0].w_value),
@@ -382,6 +445,43 @@ def send_status_packet(buf_size):
         # after this function returns will return garbage
     ])
 
+    if not timestamps:
+        return fw
+
+    r -= "space_remaining stream_pos"
+    r += "R3:ts_status R2:ts_count"
+    fw.append([
+    L(lp+"timestamps"),
+        # are there any timestamps to send?
+        LDXA(r.ts_status, p_map.snes.r_ts_status),
+        ANDI(r.ts_count, r.ts_status, 0x7FFF),
+        BZ("main_loop"), # nope
+        CMPI(r.ts_count, MAX_TIMESTAMPS_PER_PACKET),
+        BLEU(lp+"ts_count_ok"),
+        MOVI(r.ts_count, MAX_TIMESTAMPS_PER_PACKET),
+    L(lp+"ts_count_ok"),
+        MOVI(r.comm_word, 0x7A5A),
+        JAL(r.txlr, lp+"tx_comm_word"),
+        STXA(r.temp, p_map.uart.w_crc_reset),
+        # result code and 2*N+1 parameters
+        ADD(r.comm_word, r.ts_count, r.ts_count),
+        ADDI(r.comm_word, r.comm_word, 0x1101),
+        JAL(r.txlr, lp+"tx_comm_word"),
+        MOV(r.comm_word, r.ts_status),
+        JAL(r.txlr, lp+"tx_comm_word"),
+    L(lp+"ts_loop"),
+        LDXA(r.comm_word, p_map.snes.r_ts_lo),
+        JAL(r.txlr, lp+"tx_comm_word"),
+        LDXA(r.comm_word, p_map.snes.r_ts_hi_and_pop),
+        JAL(r.txlr, lp+"tx_comm_word"),
+        SUBI(r.ts_count, r.ts_count, 1),
+        BNZ(lp+"ts_loop"),
+        # give the CRC time to finish, then send it and return to the main loop
+        MOVR(r.txlr, "main_loop"),
+        LDXA(r.comm_word, p_map.uart.r_crc_value),
+        J(lp+"tx_comm_word"),
+    ])
+
     return fw
 
 # jumps right back to main loop.
@@ -731,11 +831,20 @@ def main_loop_body():
         BEQ("cmd_send_latches"),
         SUBI(r.command, r.command, 0x100),
         BEQ("send_status_packet"),
+        SUBI(r.command, r.command, 0x100),
+        BEQ(lp+"ext_status"),
 
         # oh no, we don't know the command
         MOVI(r.error_code, ErrorCode.INVALID_COMMAND),
         J("handle_error"),
 
+    L(lp+"ext_status"),
+        # flag that the packet should be extended, then send it
+        MOVI(r.command, 1),
+        MOVR(r.lr, "vars"),
+        ST(r.command, r.lr, Vars.ext_status),
+        J("send_status_packet"),
+
     L(lp+"handle_hello"),
         # validate the CRC (the word was already received for us)
         LDXA(r.temp, p_map.uart.r_crc_value),
@@ -758,7 +867,8 @@ def main_loop_body():
 # the extra is nice to jumpstart the buffer.
 def make_firmware(controllers, priming_latches,
         apu_freq_basic=None,
-        apu_freq_advanced=None):
+        apu_freq_advanced=None,
+        timestamp_decimation=None):
 
     num_controllers = len(controllers)
     buf_size = calc_buf_size(num_controllers)
@@ -776,6 +886,11 @@ def make_firmware(controllers, priming_latches,
     if apu_freq_basic is None and apu_freq_advanced is not None:
         raise ValueError("must set apu basic before advanced")
 
+    if timestamp_decimation is not None and \
+            not 1 <= timestamp_decimation <= 0xFFFF:
+        raise ValueError("timestamp decimation must be 1-65535, not {}".format(
+            timestamp_decimation))
+
     num_priming_latches = len(priming_latches)//num_controllers
     if len(priming_latches) % num_controllers != 0:
         raise ValueError("priming latches must have {} words per latch".format(
@@ -823,6 +938,14 @@ def make_firmware(controllers, priming_latches,
     # force a latch so the APU clock generator gets updated
     fw.append(STXA(R2, p_map.snes.w_force_latch))
 
+    # start capturing latch timestamps if requested. the forced latch above is
+    # never captured.
+    if timestamp_decimation is not None:
+        fw.append([
+            MOVI(R2, int(timestamp_decimation) & 0xFFFF),
+            STXA(R2, p_map.snes.w_ts_decimation),
+        ])
+
     # load the initial buttons into the registers
     for controller_i, controller_addr in enumerate(controller_addrs):
         fw.append([
@@ -842,7 +965,7 @@ def make_firmware(controllers, priming_latches,
     # initialization is done. let's get the party started!
     fw.append(J("main_loop"))
 
-    fw.append(send_status_packet(buf_size))
+    fw.append(send_status_packet(buf_size, timestamp_decimation is not None))
     fw.append(main_loop_body())
     fw.append(rx_comm_word())
     fw.append(cmd_send_latches(controller_addrs, buf_size))
@@ -1,6 +1,8 @@
 # calculate clock generator parameters for a desired APU frequency. see
 # apu_clockgen.py for the definition.
 
+import numpy as np
+
 _sys_freq = 24.75 # generator frequency in MHz (of the internal logic).
 
 def calculate_counter(desired):
@@ -38,3 +40,70 @@ def calculate_advanced(desired, jitter=0, jitter_mode=0, polarity=0):
         advanced |= 0x8000
 
     return basic, advanced, actual
+
+# array versions of the above. they accept anything numpy can broadcast
+# together and give exactly the same answers as calling the scalar versions on
+# each element, just without the python loop. the register words come back as
+# uint16 so they can be dropped straight into a latch array.
+
+def calculate_counter_array(desired):
+    desired = np.asarray(desired, dtype=np.float64)
+    count = -((desired/_sys_freq)-1) * (2**24)
+    # int() truncates towards zero, and anything that truncates differently
+    # from floor is negative and gets clamped to 0 anyway
+    count = np.clip(np.trunc(count+0.5), 0, (2**24)-1).astype(np.int64)
+
+    actual = count / (2**24)
+    actual = (1-actual)*_sys_freq
+
+    return count, actual
+
+def calculate_basic_array(desired):
+    count, _ = calculate_counter_array(desired)
+
+    count &= 0x0FFFF0
+
+    actual = count / (2**24)
+    actual = (1-actual)*_sys_freq
+
+    return (count>>4).astype(np.uint16), actual
+
+def calculate_advanced_array(desired, jitter=0, jitter_mode=0, polarity=0):
+    count, actual = calculate_counter_array(desired)
+
+    basic = (count & 0x0FFFF0) >> 4
+    advanced = ((count >> 16) & 0xF0) | (count & 0xF)
+
+    jitter = np.clip(np.asarray(jitter, dtype=np.int64), 0, 7)
+    advanced = advanced | (jitter << 8)
+    advanced = advanced | np.where(np.asarray(jitter_mode, dtype=bool),
+        0x4000, 0)
+    advanced = advanced | np.where(np.asarray(polarity, dtype=bool),
+        0x8000, 0)
+
+    basic, advanced, actual = np.broadcast_arrays(basic, advanced, actual)
+    return basic.astype(np.uint16), advanced.astype(np.uint16), actual.copy()
+
+# spread per-group values out over the latches each group covers. group i gets
+# written to latches[latch_starts[i]:latch_starts[i]+num_latches[i], columns].
+# values is either one value per group or one row (with one entry per column)
+# per group. groups must not overlap, but they don't have to be contiguous;
+# latches not in any group are left alone. like slicing, groups that run past
+# the end of latches are cut off there. latches is modified in place.
+def expand_to_latches(latches, columns, latch_starts, num_latches, values):
+    latch_starts = np.asarray(latch_starts, dtype=np.int64)
+    num_latches = np.asarray(num_latches, dtype=np.int64)
+    num_latches = np.clip(np.minimum(num_latches, len(latches)-latch_starts),
+        0, None)
+    values = np.asarray(values)
+
+    # index of each covered latch: the start of its group plus how far it is
+    # into the group
+    group_offsets = np.cumsum(num_latches) - num_latches
+    rows = np.repeat(latch_starts - group_offsets, num_latches)
+    rows += np.arange(len(rows))
+
+    if values.ndim == 1 and np.ndim(columns) > 0:
+        values = values[:, None] # same value in every column
+    latches[rows[:, None] if np.ndim(columns) > 0 else rows, columns] = \
+        np.repeat(values, num_latches, axis=0)
@@ -91,7 +91,7 @@ BOOTLOADER_VERSION = 4
 
 # very, very temporary. will eventually be automatically detected and managed
 # somehow
-GATEWARE_VERSION = 6
+GATEWARE_VERSION = 7
 
 
 # MEMORY MAP
@@ -33,6 +33,7 @@ class Top(Elaboratable):
 
         self.i_rx = Signal()
         self.o_tx = Signal()
+        self.o_cts = Signal()
 
         self.o_mem_clock = Signal()
         self.o_mem_reset = Signal()
@@ -88,6 +89,7 @@ class Top(Elaboratable):
         uart_signals = UARTSignals(
             i_rx=self.i_rx,
             o_tx=self.o_tx,
+            o_cts=self.o_cts,
         )
 
         memory_signals = MemorySignals(
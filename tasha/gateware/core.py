@@ -7,7 +7,7 @@ from boneless.gateware import ALSRU_4LUT, CoreFSM
 from boneless.arch.opcode import Instr
 from boneless.arch.opcode import *
 
-from . import reset_req, uart, timer, snes
+from . import reset_req, uart, timer, snes, perf
 from .periph_map import p_map
 from .bootloader_fw import make_bootloader
 
@@ -49,6 +49,10 @@ class TASHACore(Elaboratable):
         # the APU clock
         self.snes = snes.SNES(self.snes_signals)
 
+        # the performance counters. they watch the other peripherals so the host
+        # can find out how much headroom there is.
+        self.perf = perf.PerfCounters(rx_fifo_depth=self.uart.rx_fifo.depth)
+
     def elaborate(self, platform):
         m = Module()
         m.submodules.cpu_core = cpu_core = self.cpu_core
@@ -60,6 +64,7 @@ class TASHACore(Elaboratable):
         m.submodules.uart = uart = self.uart
         m.submodules.timer = timer = self.timer
         m.submodules.snes = snes = self.snes
+        m.submodules.perf = perf = self.perf
 
         # hook up main bus. the main RAM gets the first half and the boot ROM
         # gets the second (though nominally, it's from 0xFF00 to 0xFFFF)
@@ -112,7 +117,7 @@ class TASHACore(Elaboratable):
         # regions can be addressed with the 1-word form of the external bus
         # instructions. each peripheral gets 1 read and 1 write enable bit, 4
         # address bits, 16 write data bits, and gives back 16 read data bits
-        NUM_PERIPHS = 4
+        NUM_PERIPHS = 5
         periph_en = tuple(Signal(1) for _ in range(NUM_PERIPHS))
         periph_re = tuple(Signal(1) for _ in range(NUM_PERIPHS))
         periph_we = tuple(Signal(1) for _ in range(NUM_PERIPHS))
@@ -163,6 +168,7 @@ class TASHACore(Elaboratable):
 
             uart.i_rx.eq(self.uart_signals.i_rx),
             self.uart_signals.o_tx.eq(uart.o_tx),
+            self.uart_signals.o_cts.eq(uart.o_cts),
         ]
 
         # hook up the timers
@@ -183,4 +189,19 @@ class TASHACore(Elaboratable):
             periph_rdata[p_map.snes.periph_num].eq(snes.o_rdata),
         ]
 
+        # hook up the performance counters
+        m.d.comb += [
+            perf.i_re.eq(periph_re[p_map.perf.periph_num]),
+            perf.i_we.eq(periph_we[p_map.perf.periph_num]),
+            perf.i_addr.eq(periph_addr),
+            perf.i_wdata.eq(periph_wdata),
+            periph_rdata[p_map.perf.periph_num].eq(perf.o_rdata),
+
+            perf.i_rx_overflow.eq(uart.o_rx_overflow),
+            perf.i_rx_level.eq(uart.o_rx_level),
+            perf.i_rx_empty_read.eq(uart.o_rx_empty_read),
+            perf.i_latched.eq(snes.o_latched),
+            perf.i_latch_ack.eq(snes.o_latch_ack),
+        ]
+
         return m
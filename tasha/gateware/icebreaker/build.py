@@ -12,14 +12,16 @@ from .pll import PLL
 # create the build-specific topmost module. it's responsible for setting up the
 # platform, hooking up the PLL and clocks, and providing access to the main RAM
 class Top(Elaboratable):
-    def __init__(self):
-        pass
+    def __init__(self, flow_control=False):
+        self.flow_control = flow_control
 
     def elaborate(self, platform):
         # add the tas-specific resources through which the system interfaces to
         # the real world and console
         platform.add_resources(pmod_resources.snes_pmod)
         platform.add_resources(pmod_resources.snes_apu_pmod)
+        if self.flow_control:
+            platform.add_resources(pmod_resources.uart_flow_pmod)
 
         m = Module()
 
@@ -86,9 +88,14 @@ class Top(Elaboratable):
 
         # and the UART signals
         uart_pins = platform.request("uart")
+        if self.flow_control:
+            o_cts = platform.request("uart_flow").cts
+        else:
+            o_cts = Signal() # goes nowhere
         uart_signals = UARTSignals(
             i_rx=uart_pins.rx,
             o_tx=uart_pins.tx,
+            o_cts=o_cts,
         )
 
         # now we need to hook up memory. since the available memories can vary
@@ -161,7 +168,10 @@ class Top(Elaboratable):
 parser = argparse.ArgumentParser()
 parser.add_argument("-p", "--program", action="store_true",
     help="program the platform with the built design")
+parser.add_argument("-f", "--flow-control", action="store_true",
+    help="output the UART CTS signal on PMOD1B for hardware flow control")
 args = parser.parse_args()
 
 platform = ICEBreakerPlatform()
-platform.build(Top(), do_program=args.program, synth_opts="-abc9")
+platform.build(Top(flow_control=args.flow_control),
+    do_program=args.program, synth_opts="-abc9")
@@ -32,6 +32,15 @@ snes_pmod = [
     )
 ]
 
+# connect to PMOD1B. wire this to the CTS input of the host's serial adapter to
+# use hardware flow control.
+uart_flow_pmod = [
+    Resource("uart_flow", 0,
+        Subsignal("cts", Pins("10", dir="o", conn=("pmod", 1)),
+            Attrs(IO_STANDARD="SB_LVCMOS33")),
+    )
+]
+
 # connect to PMOD1B
 snes_apu_pmod = [
     Resource("snes_apu", 0,
@@ -0,0 +1,138 @@
+# performance counters, so the host can see how close to the edge the system is
+# running without having to guess from missed latches and resends
+
+from nmigen import *
+
+# Register Map
+
+# all the counters saturate instead of wrapping and are cleared (or, for the
+# high-water mark, reset to the current level) when read. the host accumulates
+# them, so they only need to hold what happens between two status packets.
+
+# 0x0: (R) RX Overrun Count
+#    Read:   15-0: number of characters dropped because the RX FIFO was full
+
+# 0x1: (R) RX FIFO High-Water Mark
+#    Read:   15-0: most characters that were waiting in the RX FIFO at once
+
+# 0x2: (R) Latch Count
+#    Read:   15-0: number of latch events which delivered buttons to the console
+
+# 0x3: (R) Maximum Latch Delay
+#    Read:   15-0: most cycles between a latch event and the CPU acknowledging it
+#   The CPU acknowledges a latch by reading the Missed Latch & Acknowledge
+#   register, which it does once it has loaded the next set of buttons. If this
+#   is close to the time between latches, the CPU is about to start missing them.
+
+# 0x4: (R) Idle Poll Count
+#    Read:   15-0: number of times the CPU read the RX FIFO while it was empty
+#   The CPU polls the RX FIFO when it has nothing better to do, so this is a
+#   measure of how much spare time it has.
+
+# counter which saturates at its maximum value and gets cleared when read
+class _SatCounter:
+    def __init__(self, m, width=16):
+        self.value = Signal(width)
+        self.inc = Signal()
+        self.clear = Signal()
+
+        at_max = Signal()
+        m.d.comb += at_max.eq(self.value == (2**width)-1)
+        with m.If(self.clear):
+            # don't lose the event if it happens while we're being read
+            m.d.sync += self.value.eq(self.inc)
+        with m.Elif(self.inc & ~at_max):
+            m.d.sync += self.value.eq(self.value + 1)
+
+class PerfCounters(Elaboratable):
+    def __init__(self, rx_fifo_depth):
+        # boneless bus inputs
+        self.i_re = Signal()
+        self.i_we = Signal()
+        self.i_addr = Signal(4)
+        self.o_rdata = Signal(16)
+        self.i_wdata = Signal(16)
+
+        # event inputs from the other peripherals
+        self.i_rx_overflow = Signal() # character dropped from RX FIFO
+        self.i_rx_level = Signal(range(rx_fifo_depth+1)) # current RX FIFO level
+        self.i_rx_empty_read = Signal() # RX FIFO read while empty
+        self.i_latched = Signal() # latch event delivered buttons
+        self.i_latch_ack = Signal() # CPU acknowledged latch
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rx_overruns = _SatCounter(m)
+        latches = _SatCounter(m)
+        idle_polls = _SatCounter(m)
+        m.d.comb += [
+            rx_overruns.inc.eq(self.i_rx_overflow),
+            latches.inc.eq(self.i_latched),
+            idle_polls.inc.eq(self.i_rx_empty_read),
+        ]
+
+        # track the highest RX FIFO level
+        rx_high_water = Signal(16)
+        rx_high_water_reset = Signal()
+        with m.If(rx_high_water_reset):
+            m.d.sync += rx_high_water.eq(self.i_rx_level)
+        with m.Elif(self.i_rx_level > rx_high_water):
+            m.d.sync += rx_high_water.eq(self.i_rx_level)
+
+        # time from each latch to its acknowledgement. a new latch restarts the
+        # timing (the SNES peripheral counts that as a missed latch anyway).
+        latch_pending = Signal()
+        latch_delay = Signal(16)
+        latch_delay_max = Signal(16)
+        latch_delay_max_reset = Signal()
+        with m.If(self.i_latched):
+            m.d.sync += [
+                latch_pending.eq(1),
+                latch_delay.eq(0),
+            ]
+        with m.Elif(latch_pending):
+            with m.If(self.i_latch_ack):
+                m.d.sync += latch_pending.eq(0)
+            with m.Elif(latch_delay != 0xFFFF):
+                m.d.sync += latch_delay.eq(latch_delay + 1)
+
+        with m.If(latch_delay_max_reset):
+            m.d.sync += latch_delay_max.eq(0)
+        with m.Elif(latch_pending & self.i_latch_ack &
+                (latch_delay > latch_delay_max)):
+            m.d.sync += latch_delay_max.eq(latch_delay)
+
+        # handle the boneless bus.
+        read_data = Signal(16) # it expects one cycle of read latency
+        m.d.sync += self.o_rdata.eq(read_data)
+
+        with m.If(self.i_re):
+            with m.Switch(self.i_addr[:3]):
+                with m.Case(0):
+                    m.d.comb += [
+                        read_data.eq(rx_overruns.value),
+                        rx_overruns.clear.eq(1),
+                    ]
+                with m.Case(1):
+                    m.d.comb += [
+                        read_data.eq(rx_high_water),
+                        rx_high_water_reset.eq(1),
+                    ]
+                with m.Case(2):
+                    m.d.comb += [
+                        read_data.eq(latches.value),
+                        latches.clear.eq(1),
+                    ]
+                with m.Case(3):
+                    m.d.comb += [
+                        read_data.eq(latch_delay_max),
+                        latch_delay_max_reset.eq(1),
+                    ]
+                with m.Case(4):
+                    m.d.comb += [
+                        read_data.eq(idle_polls.value),
+                        idle_polls.clear.eq(1),
+                    ]
+
+        return m
@@ -87,6 +87,25 @@ _snes = _namedtupleton("snes",
         w_p1d1=5,
         w_p2d0=6,
         w_p2d1=7,
+
+        r_ts_status=8,
+        w_ts_decimation=8,
+        r_ts_lo=9,
+        r_ts_hi_and_pop=0xA,
+    )
+)
+
+_perf_periph_num = 4
+_perf = _namedtupleton("perf",
+    periph_num=_perf_periph_num,
+
+    **_reg_addr(_perf_periph_num,
+        # these must match perf.py!!!!!!
+        r_rx_overruns=0,
+        r_rx_high_water=1,
+        r_latches=2,
+        r_latch_delay_max=3,
+        r_idle_polls=4,
     )
 )
 
@@ -95,4 +114,5 @@ p_map = _namedtupleton("p_map",
     uart=_uart,
     timer=_timer,
     snes=_snes,
+    perf=_perf,
 )
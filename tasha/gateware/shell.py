@@ -41,6 +41,9 @@ SNESSignals = namedtuple("SNESSignals", [
 UARTSignals = namedtuple("UARTSignals", [
     "i_rx",
     "o_tx",
+    # clear to send for hardware flow control. like the other two it's active
+    # low. the platform may leave it unconnected if flow control isn't wired up.
+    "o_cts",
 ])
 
 MemorySignals = namedtuple("MemorySignals", [
@@ -3,6 +3,7 @@
 from nmigen import *
 from nmigen.asserts import Past, Rose, Fell
 from nmigen.lib.cdc import FFSynchronizer
+from nmigen.lib.fifo import SyncFIFOBuffered
 
 from .setreset import *
 from .apu_clockgen import APUClockgen
@@ -55,6 +56,26 @@ from .apu_calc import calculate_counter
 # When a latch event occurs, these registers are transferred to the output shift
 # registers so the console can shift the data out.
 
+# LATCH TIMESTAMP REGISTERS
+# A free-running 32 bit cycle counter is captured into a FIFO when the console
+# latches (forced latches are not captured). This lets the host see exactly when
+# each latch happened, e.g. to find lag frames.
+
+# 0x8: (R) Timestamp FIFO Status / (W) Timestamp Decimation
+#    Read: bit 15: 1 if a timestamp was dropped because the FIFO was full since
+#                  this register was last read. reading clears this bit.
+#            14-0: number of timestamps in the FIFO
+#   Write:   15-0: capture every Nth latch. 0 (the default) disables capture.
+#   Writing this register also makes the next latch be captured.
+
+# 0x9: (R) Timestamp (low)
+#    Read:   15-0: low 16 bits of the oldest timestamp in the FIFO
+
+# 0xA: (R) Timestamp (high) and Pop
+#    Read:   15-0: high 16 bits of the oldest timestamp in the FIFO
+#   Reading this register removes the oldest timestamp from the FIFO. The
+#   timestamp values are undefined if the FIFO is empty.
+
 # drive one controller data line. really just a 16 bit shift register.
 class DataLineDriver(Elaboratable):
     def __init__(self):
@@ -180,7 +201,7 @@ class Controllers(Elaboratable):
 
 
 class SNES(Elaboratable):
-    def __init__(self, snes_signals):
+    def __init__(self, snes_signals, timestamp_fifo_depth=256): # 256x32 = 2 BRAM
         self.snes_signals = snes_signals
 
         # boneless bus inputs
@@ -190,8 +211,14 @@ class SNES(Elaboratable):
         self.o_rdata = Signal(16)
         self.i_wdata = Signal(16)
 
+        # status outputs for the performance counters
+        self.o_latched = Signal() # latch event delivered buttons
+        self.o_latch_ack = Signal() # latch was acknowledged by the CPU
+
         self.controllers = Controllers(self.snes_signals)
         self.apu_clockgen = APUClockgen()
+
+        self.ts_fifo = SyncFIFOBuffered(width=32, depth=timestamp_fifo_depth)
     
     def elaborate(self, platform):
         m = Module()
@@ -231,6 +258,7 @@ class SNES(Elaboratable):
         allowed = Signal()
         m.d.comb += allowed.eq(
             self.controllers.i_enable_latch | self.controllers.i_force_latch)
+        m.d.comb += self.o_latched.eq(self.controllers.o_latched & allowed)
         with m.If(self.controllers.o_latched & allowed):
             m.d.sync += [
                 ac_counter.eq(ar_counter),
@@ -250,12 +278,36 @@ class SNES(Elaboratable):
             self.snes_signals.o_apu_ddr_hi.eq(apu_clockgen.o_apu_ddr_hi),
         ]
 
+        # capture latch timestamps
+        m.submodules.ts_fifo = ts_fifo = self.ts_fifo
+        cycle_counter = Signal(32)
+        m.d.sync += cycle_counter.eq(cycle_counter+1)
+
+        ts_decimation = Signal(16)
+        ts_decimation_ctr = Signal(16)
+        ts_dropped = SetReset(m, priority="set")
+        console_latched = Signal()
+        m.d.comb += [
+            console_latched.eq(
+                self.controllers.o_latched & ~self.controllers.i_force_latch),
+            ts_fifo.w_data.eq(cycle_counter),
+        ]
+        with m.If(console_latched & (ts_decimation != 0)):
+            with m.If(ts_decimation_ctr == 0):
+                m.d.comb += [
+                    ts_fifo.w_en.eq(1),
+                    ts_dropped.set.eq(~ts_fifo.w_rdy),
+                ]
+                m.d.sync += ts_decimation_ctr.eq(ts_decimation-1)
+            with m.Else():
+                m.d.sync += ts_decimation_ctr.eq(ts_decimation_ctr-1)
+
         # handle the boneless bus.
-        read_data = Signal() # it expects one cycle of read latency
-        m.d.sync += self.o_rdata.eq(Cat(read_data, 0))
+        read_data = Signal(16) # it expects one cycle of read latency
+        m.d.sync += self.o_rdata.eq(read_data)
 
         with m.If(self.i_re):
-            with m.Switch(self.i_addr[:1]):
+            with m.Switch(self.i_addr):
                 with m.Case(0):
                     m.d.comb += read_data.eq(did_latch.value)
                 with m.Case(1):
@@ -265,10 +317,24 @@ class SNES(Elaboratable):
                         # and reset the status
                         did_latch.reset.eq(1),
                         missed_latch.reset.eq(1),
+                        self.o_latch_ack.eq(1),
+                    ]
+                with m.Case(8):
+                    m.d.comb += [
+                        read_data[15].eq(ts_dropped.value),
+                        read_data[:15].eq(ts_fifo.level),
+                        ts_dropped.reset.eq(1),
+                    ]
+                with m.Case(9):
+                    m.d.comb += read_data.eq(ts_fifo.r_data[:16])
+                with m.Case(0xA):
+                    m.d.comb += [
+                        read_data.eq(ts_fifo.r_data[16:]),
+                        ts_fifo.r_en.eq(1),
                     ]
 
         with m.If(self.i_we):
-            with m.Switch(self.i_addr[:3]):
+            with m.Switch(self.i_addr):
                 with m.Case(0): # force a latch
                     m.d.comb += controllers.i_force_latch.eq(1)
                 with m.Case(1): # enable latches from the console
@@ -277,6 +343,7 @@ class SNES(Elaboratable):
                         # and reset the status
                         did_latch.reset.eq(1),
                         missed_latch.reset.eq(1),
+                        self.o_latch_ack.eq(1),
                     ]
                 with m.Case(2): # basic APU frequency adjust
                     m.d.sync += ar_counter[4:-4].eq(self.i_wdata)
@@ -296,5 +363,10 @@ class SNES(Elaboratable):
                     m.d.sync += controllers.i_buttons["p2d0"].eq(self.i_wdata)
                 with m.Case(0x7):
                     m.d.sync += controllers.i_buttons["p2d1"].eq(self.i_wdata)
+                with m.Case(0x8): # timestamp decimation
+                    m.d.sync += [
+                        ts_decimation.eq(self.i_wdata),
+                        ts_decimation_ctr.eq(0),
+                    ]
 
         return m
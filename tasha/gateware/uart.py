@@ -70,6 +70,13 @@ from .setreset import *
 #   The behavior of this register is identical to the "low byte" version above,
 #   except for where the character is placed.
 
+# FLOW CONTROL
+# The o_cts output can be wired to the CTS input of the host's serial adapter.
+# It tells the host to stop sending once the RX FIFO is nearly full and lets it
+# start again once the FIFO has drained to half full. The host then can't
+# overflow the FIFO no matter how slowly the CPU is reading it. There is no RTS
+# input; we can always transmit.
+
 def calculate_divisor(freq, baud):
     return int(freq/baud)-1
 
@@ -288,6 +295,10 @@ class KermitCRC(Elaboratable):
 class SysUART(Elaboratable):
     def __init__(self, divisor, rx_fifo_depth=512): # 512x8 = 1 BRAM
         self.divisor = divisor
+        # the host's serial adapter may send a few more characters after we
+        # tell it to stop, so leave plenty of space
+        self.cts_stop_level = rx_fifo_depth - 64
+        self.cts_start_level = rx_fifo_depth // 2
 
         # boneless bus inputs
         self.i_re = Signal()
@@ -299,6 +310,12 @@ class SysUART(Elaboratable):
         # UART signals
         self.i_rx = Signal()
         self.o_tx = Signal(reset=1) # inverted, like usual
+        self.o_cts = Signal() # inverted too: 0 if the host may send
+
+        # status outputs for the performance counters
+        self.o_rx_overflow = Signal() # received character was dropped
+        self.o_rx_level = Signal(range(rx_fifo_depth+1)) # RX FIFO level
+        self.o_rx_empty_read = Signal() # RX FIFO was read while empty
 
         self.rx_fifo = SyncFIFOBuffered(width=8, depth=rx_fifo_depth)
 
@@ -336,8 +353,17 @@ class SysUART(Elaboratable):
             r1_rx_overflow.set.eq(~rx_fifo.w_rdy & rxm.o_we),
             rx_fifo.w_data.eq(rxm.o_data),
             rx_fifo.w_en.eq(rxm.o_we),
+
+            self.o_rx_overflow.eq(~rx_fifo.w_rdy & rxm.o_we),
+            self.o_rx_level.eq(rx_fifo.level),
         ]
 
+        # tell the host to stop before the FIFO overflows
+        with m.If(rx_fifo.level >= self.cts_stop_level):
+            m.d.sync += self.o_cts.eq(1)
+        with m.Elif(rx_fifo.level < self.cts_start_level):
+            m.d.sync += self.o_cts.eq(0)
+
         # hook up the CRC engine
         m.submodules.crc = crc = KermitCRC()
 
@@ -407,6 +433,8 @@ class SysUART(Elaboratable):
                             crc.i_byte.eq(rx_fifo.r_data),
                             crc.i_start.eq(1),
                         ]
+                    with m.Else():
+                        m.d.comb += self.o_rx_empty_read.eq(1)
                 with m.Case(6, 7): # tx fifo status
                     m.d.comb += read_data[0].eq(r6_tx_full.value)
         with m.Elif(self.i_we):
@@ -30,14 +30,15 @@ class Bootloader:
         self.port = None
 
     def _ser_read(self, length):
-        read = b""
-        while length > 0:
-            new = self.port.read(length)
-            if len(new) == 0:
+        read = bytearray(length)
+        view = memoryview(read)
+        got = 0
+        while got < length:
+            new = self.port.readinto(view[got:])
+            if not new:
                 raise Timeout("read timeout")
-            read += new
-            length -= len(new)
-        return read
+            got += new
+        return bytes(read)
 
     def _ser_write(self, data):
         sent_len = 0
@@ -88,13 +89,16 @@ class Bootloader:
             problems.get(resp_words[2], resp_words[2])))
 
     # connect to the target on serial port "port". give up after (about)
-    # "timeout" seconds. return if connected or throw exception if failure
-    def connect(self, port, timeout=None):
+    # "timeout" seconds. return if connected or throw exception if failure. if
+    # rtscts is True, hardware flow control is used; the gateware must have been
+    # built with it and the CTS line must be wired up.
+    def connect(self, port, timeout=None, rtscts=False):
         # create a serial port to connect to the target. we set a 200ms timeout,
         # slightly over the 150ms timeout in the firmware, to make sure we
         # receive timeout errors.
 
-        port = serial.Serial(port=port, baudrate=2_000_000, timeout=0.2)
+        port = serial.Serial(port=port, baudrate=2_000_000, timeout=0.2,
+            rtscts=rtscts)
         self.port = port
 
         # we tolerate 3 errors before giving up. this lets us deal with
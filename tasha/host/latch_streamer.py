@@ -31,7 +31,25 @@
 #   compiled into the gateware are used. Consult calculate_advanced in
 #   gateware/apu_calc.py for information on how to choose the value.
 
+# metrics_period: How often, in seconds, to ask the device for its performance
+#   counters. Each time they arrive, the status callback is given a
+#   MetricsMessage and the totals in the streamer's metrics attribute are
+#   updated. If None, the counters are never requested.
+
+# latch_timestamps: If not None, the device captures the time of every Nth
+#   console latch, where N is this value, and sends the timestamps back. They
+#   can be retrieved with get_latch_timestamps(). The timestamps take bandwidth
+#   away from the status packets, so at high latch rates N should be large
+#   enough that no more than about 1000 latches per second are captured.
+
+# rtscts: If True, use hardware flow control. The gateware stops the host from
+#   sending once its receive FIFO is nearly full, so data is never dropped and
+#   resent because the firmware fell behind. The gateware must be built with
+#   flow control and the CTS line must be wired to the serial adapter, or else
+#   nothing will ever be sent.
+
 import struct
+import time
 import random
 import collections
 import itertools
@@ -43,6 +61,7 @@ import crcmod.predefined
 crc_16_kermit = crcmod.predefined.mkPredefinedCrcFun("kermit")
 
 from ..firmware.latch_streamer import make_firmware, calc_buf_size, ErrorCode
+from ..firmware.latch_streamer import PERF_COUNTERS, MAX_TIMESTAMPS_PER_PACKET
 from . import bootload
 
 # status_cb is called with Messages of the appropriate subclass
@@ -135,6 +154,44 @@ class StatusMessage(Message):
             self.device_pos, self.pc_pos, self.buffer_size-self.buffer_use,
             self.in_transit, self.sent)
 
+class TimestampsDroppedMessage(Message):
+    def __str__(self):
+        return "WARNING: device dropped latch timestamps (increase decimation)"
+
+# totals of the device's performance counters since connection. consult
+# gateware/perf.py for what exactly they count.
+class DeviceMetrics:
+    def __init__(self):
+        self.rx_overruns = 0 # characters the device dropped
+        self.rx_high_water = 0 # most characters waiting in the RX FIFO at once
+        self.latches = 0 # latches delivered to the console
+        self.latch_delay_max = 0 # most cycles between latch and acknowledgement
+        self.idle_polls = 0 # times the CPU found nothing to receive
+
+    # fold in a set of counters (in PERF_COUNTERS order) from the device
+    def update(self, counters):
+        for (name, _), value in zip(PERF_COUNTERS, counters):
+            if name in ("rx_high_water", "latch_delay_max"):
+                setattr(self, name, max(getattr(self, name), value))
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+# sent every processed extended status packet
+class MetricsMessage(Message):
+    # counters: dict of counter name to value since the last extended packet
+    # metrics: the DeviceMetrics totals, including these counters
+    def __init__(self, counters, metrics):
+        self.counters = counters
+        self.metrics = metrics
+
+    def __str__(self):
+        c = self.counters
+        # the device runs at 12MHz, so the delay is more useful in us
+        return ("METRICS: RX overruns:{} FIFO peak:{} latches:{} "
+            "max latch delay:{:.1f}us idle polls:{}".format(
+            c["rx_overruns"], c["rx_high_water"], c["latches"],
+            c["latch_delay_max"]/12, c["idle_polls"]))
+
 # how the communication is proceeding
 class ConnectionState(enum.Enum):
     # ... no connection
@@ -206,7 +263,10 @@ class LatchStreamer:
     def connect(self, port, status_cb=print,
             num_priming_latches=None,
             apu_freq_basic=None,
-            apu_freq_advanced=None):
+            apu_freq_advanced=None,
+            metrics_period=None,
+            latch_timestamps=None,
+            rtscts=False):
         if self.conn_state != ConnectionState.DISCONNECTED:
             raise ValueError("already connected")
 
@@ -226,7 +286,7 @@ class LatchStreamer:
 
         # assume the board is responsive and will get back to us quickly
         try:
-            bootloader.connect(port, timeout=1)
+            bootloader.connect(port, timeout=1, rtscts=rtscts)
             connected_quickly = True
         except bootload.Timeout: # it isn't
             connected_quickly = False
@@ -235,7 +295,7 @@ class LatchStreamer:
             # ask the user to try and reset the board, then wait for however
             # long it takes for the bootloder to start
             status_cb(ConnectionMessage.NOT_RESPONDING)
-            bootloader.connect(port, timeout=None)
+            bootloader.connect(port, timeout=None, rtscts=rtscts)
 
         bootloader.identify()
 
@@ -249,7 +309,8 @@ class LatchStreamer:
 
         firmware = make_firmware(self.controllers, priming_latches,
             apu_freq_basic=apu_freq_basic,
-            apu_freq_advanced=apu_freq_advanced)
+            apu_freq_advanced=apu_freq_advanced,
+            timestamp_decimation=latch_timestamps)
 
         status_cb(ConnectionMessage.DOWNLOADING)
         firmware = tuple(firmware)
@@ -259,7 +320,8 @@ class LatchStreamer:
             raise bootload.BootloadError("verification failed")
 
         bootloader.start_execution(0)
-        self.port = serial.Serial(port=port, baudrate=2_000_000, timeout=0.001)
+        self.port = serial.Serial(port=port, baudrate=2_000_000, timeout=0.001,
+            rtscts=rtscts)
 
         # initialize input and output buffers
         self.out_chunks = collections.deque()
@@ -275,6 +337,15 @@ class LatchStreamer:
         self.resend_buf = collections.deque()
         self.resend_buf_len = 0
 
+        self.metrics = DeviceMetrics()
+        self.metrics_period = metrics_period
+        self.last_metrics_time = time.monotonic()
+
+        # timestamps received but not yet retrieved. the device's counter is
+        # 32 bits, so we extend them to 64 bits as they come in.
+        self.timestamp_chunks = []
+        self.last_timestamp = None
+
         self.status_cb = status_cb
         self.conn_state = ConnectionState.INITIALIZING
 
@@ -305,7 +376,8 @@ class LatchStreamer:
 
         return b''.join(latch_data)
 
-    # find, parse, and return the latest packet from in_chunks
+    # find, parse, and return the latest packet from in_chunks. the counters
+    # from any extended status packets along the way are processed too.
     def _parse_latest_packet(self):
         packet = None
         while True:
@@ -321,8 +393,25 @@ class LatchStreamer:
                     self.in_chunks.clear()
                 break
 
-            packet_data = self.in_chunks[pos:pos+12]
-            if len(packet_data) < 12: # packet is not complete
+            # the packet length depends on the number of parameters
+            if len(self.in_chunks) < pos+4: # don't know it yet
+                self.in_chunks = self.in_chunks[pos:]
+                break
+            num_params = self.in_chunks[pos+2]
+            result_code = self.in_chunks[pos+3]
+            if result_code == 0x10:
+                valid = num_params in (3, 3+len(PERF_COUNTERS))
+            elif result_code == 0x11:
+                valid = num_params % 2 == 1 and \
+                    num_params <= 2*MAX_TIMESTAMPS_PER_PACKET+1
+            else:
+                valid = False
+            if not valid:
+                num_params = 3 # junk, so let the CRC check catch it
+            packet_len = 6 + 2*num_params
+
+            packet_data = self.in_chunks[pos:pos+packet_len]
+            if len(packet_data) < packet_len: # packet is not complete
                 # save what we've got for later
                 self.in_chunks = self.in_chunks[pos:]
                 break
@@ -334,12 +423,68 @@ class LatchStreamer:
                 self.in_chunks = self.in_chunks[pos+2:]
             else:
                 # it is. parse the useful bits from it
-                packet = struct.unpack("<3H", packet_data[4:10])
+                params = struct.unpack("<{}H".format(num_params),
+                    packet_data[4:-2])
+                if result_code == 0x11:
+                    self._process_timestamps(params)
+                else:
+                    packet = params[:3]
+                    if num_params > 3: # it's extended and has the counters
+                        self._process_metrics(params[3:])
                 # and remove it from the stream
-                self.in_chunks = self.in_chunks[pos+12:]
+                self.in_chunks = self.in_chunks[pos+packet_len:]
 
         return packet
 
+    def _process_metrics(self, counters):
+        self.metrics.update(counters)
+        counters = {name: value
+            for (name, _), value in zip(PERF_COUNTERS, counters)}
+        self.status_cb(MetricsMessage(counters, self.metrics))
+
+    def _process_timestamps(self, params):
+        if params[0] & 0x8000:
+            self.status_cb(TimestampsDroppedMessage())
+        if len(params) == 1:
+            return
+
+        words = np.array(params[1:], dtype=np.uint32).reshape(-1, 2)
+        timestamps = (words[:, 0] | (words[:, 1] << 16)).astype(np.int64)
+        # the counter wraps every 2**32 cycles (about 6 minutes), which is much
+        # longer than between two timestamps. accumulate the wrapped
+        # differences to extend it.
+        if self.last_timestamp is None:
+            self.last_timestamp = timestamps[0]
+        diffs = np.diff(timestamps, prepend=self.last_timestamp & 0xFFFFFFFF)
+        timestamps = self.last_timestamp + np.cumsum(diffs & 0xFFFFFFFF)
+        self.last_timestamp = timestamps[-1]
+        self.timestamp_chunks.append(timestamps)
+
+    # Return an int64 ndarray of the latch timestamps, in 12MHz device cycles,
+    # that have arrived since the last call. Only available if latch_timestamps
+    # was set when connecting.
+    def get_latch_timestamps(self):
+        if self.conn_state == ConnectionState.DISCONNECTED:
+            raise ValueError("you must connect before getting timestamps")
+
+        chunks = self.timestamp_chunks
+        self.timestamp_chunks = []
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(chunks)
+
+    # Ask the device to send its performance counters with the next status
+    # packet. They are delivered to the status callback as a MetricsMessage.
+    def request_metrics(self):
+        if self.conn_state == ConnectionState.DISCONNECTED:
+            raise ValueError("you must connect before requesting metrics")
+
+        cmd = struct.pack("<5H", 0x7A5A, 0x1203, 0, 0, 0)
+        self.out_chunks.append(cmd)
+        self.out_chunks.append(
+            crc_16_kermit(cmd[2:]).to_bytes(2, byteorder="little"))
+        self.last_metrics_time = time.monotonic()
+
     # Call repeatedly to perform communication. Reads messages from TASHA and
     # sends latches back out. Returns True if still connected and False to say
     # that the connection has terminated.
@@ -489,6 +634,12 @@ class LatchStreamer:
                 self.device_buf_size, p_stream_pos, self.stream_pos,
                 actual_sent, in_transit))
 
+        # ask for the performance counters if it's time
+        if self.metrics_period is not None and \
+                self.conn_state != ConnectionState.INITIALIZING:
+            if time.monotonic()-self.last_metrics_time >= self.metrics_period:
+                self.request_metrics()
+
         # send out the data we prepared earlier
         while True:
             # get a new chunk
@@ -526,6 +677,7 @@ class LatchStreamer:
         del self.out_curr_chunk
         del self.in_chunks
         del self.resend_buf
+        del self.timestamp_chunks
         del self.status_cb
 
         self.conn_state = ConnectionState.DISCONNECTED
@@ -1,6 +1,10 @@
 import time
+import queue
+import threading
 import collections
 
+import numpy as np
+
 from . import latch_streamer as ls
 
 # print status in a pretty and contextual way
@@ -66,8 +70,141 @@ class StatusPrinter:
             self.latches_sent = 0
             self.last_time = now
 
+class SourceBehindMessage(ls.Message):
+    # rate: how fast the source has produced latches, relative to realtime
+    def __init__(self, rate):
+        self.rate = rate
+
+    def __str__(self):
+        return "WARNING: latch source is falling behind ({:.2f}x realtime)".format(
+            self.rate)
+
+# run a latch source on its own thread so that a slow source (e.g. a pipe from
+# another program) can't hold up communication with the device. the source
+# fills preallocated blocks of latches which are handed to the streamer through
+# a bounded queue.
+class LatchProducer:
+    # fill: called on the producer thread with an (n, C) uint16 array. it must
+    #   fill the start of the array with latches and return how many it put in.
+    #   returning 0 means the source is finished.
+    # num_controllers: C above
+    # block_latches: n above. one block is filled at a time.
+    # num_blocks: number of blocks to allocate. the source can get up to this
+    #   many blocks ahead of the streamer.
+    # latch_rate: how many latches per second the console consumes. if not
+    #   None, a SourceBehindMessage is sent to status_cb (at most once a second)
+    #   when the streamer is waiting on the source and the source has been
+    #   slower than this.
+    def __init__(self, fill, num_controllers, block_latches=2000,
+            num_blocks=16, latch_rate=None, status_cb=print):
+        self.fill = fill
+        self.num_controllers = num_controllers
+        self.latch_rate = latch_rate
+        self.status_cb = status_cb
+
+        # blocks go from the free queue, to the thread to be filled, then to the
+        # ready queue, then to the streamer, then back to the free queue
+        self.free_blocks = queue.Queue()
+        for _ in range(num_blocks):
+            self.free_blocks.put(
+                np.empty((block_latches, num_controllers), dtype=np.uint16))
+        # (block, number of latches) or None once the source is finished
+        self.ready_blocks = queue.Queue(maxsize=num_blocks+1)
+
+        # the block we're currently giving to the streamer and how far into it
+        # we are
+        self.curr_block = None
+        self.curr_len = 0
+        self.curr_pos = 0
+        # the block we last returned. the streamer copies the latches it's given
+        # so it is free again by the next time we're asked.
+        self.lent_block = None
+
+        self.finished = False
+        self.error = None
+        self.latches_produced = 0
+        self.start_time = None
+        self.last_report_time = 0
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.thread.start()
+
+    # stop the producer thread. the source is not called again.
+    def stop(self):
+        self.stop_event.set()
+        # make sure the thread isn't stuck waiting for a block
+        self.free_blocks.put(None)
+        self.thread.join()
+
+    def _produce(self):
+        try:
+            while not self.stop_event.is_set():
+                block = self.free_blocks.get()
+                if block is None: # being stopped
+                    break
+                num_latches = self.fill(block)
+                if num_latches == 0:
+                    break
+                self.latches_produced += num_latches
+                self.ready_blocks.put((block, num_latches))
+        except Exception as e:
+            self.error = e
+        # let the streamer know there won't be any more
+        self.ready_blocks.put(None)
+
+    # get up to num_latches latches without waiting. may return an empty array
+    # if none are ready yet and returns None once the source is finished. the
+    # returned array is only valid until the next call. this works directly as
+    # stream_loop's read_latches.
+    def read_latches(self, num_latches):
+        if self.lent_block is not None:
+            self.free_blocks.put(self.lent_block)
+            self.lent_block = None
+
+        if self.curr_block is None:
+            if self.finished:
+                return None
+            try:
+                got = self.ready_blocks.get_nowait()
+            except queue.Empty:
+                self._check_behind()
+                return np.empty((0, self.num_controllers), dtype=np.uint16)
+            if got is None: # the source is done
+                self.finished = True
+                if self.error is not None:
+                    raise self.error
+                return None
+            self.curr_block, self.curr_len = got
+            self.curr_pos = 0
+
+        start = self.curr_pos
+        end = min(self.curr_len, start+num_latches)
+        latches = self.curr_block[start:end]
+        self.curr_pos = end
+        if end == self.curr_len: # used it all, free it next time
+            self.lent_block = self.curr_block
+            self.curr_block = None
+
+        return latches
+
+    def _check_behind(self):
+        if self.latch_rate is None:
+            return
+        now = time.monotonic()
+        if now-self.last_report_time < 1:
+            return
+        rate = self.latches_produced/(now-self.start_time)/self.latch_rate
+        if rate < 1:
+            self.status_cb(SourceBehindMessage(rate))
+            self.last_report_time = now
+
 # get latches and stream them. if read_latches returns None, it assumes we're
-# out of latches and does the finishing sequence
+# out of latches and does the finishing sequence. read_latches may return an
+# empty array if it has nothing right now.
 def stream_loop(latch_streamer, read_latches):
     finished = False
 
@@ -86,5 +223,7 @@ def stream_loop(latch_streamer, read_latches):
             latch_streamer.add_latches(latches)
             if latches is None: # just told the latch streamer to stop
                 finished = True
+            elif len(latches) == 0: # the source is busy, so keep communicating
+                break
 
         time.sleep(0.01)
@@ -43,6 +43,14 @@ parser.add_argument('--apu_alt_polarity', action="store_true",
     help='Enable alternate skip polarity, where high pulses are skipped '
     '(010 -> 000). By default, low pulses are skipped (101 -> 111).')
 
+parser.add_argument('--flow-control', action="store_true",
+    help='Use hardware (RTS/CTS) flow control. The gateware must be built '
+    'with flow control and its CTS output wired to the serial adapter.')
+parser.add_argument('-m', '--metrics', type=float, default=None,
+    metavar="SECONDS", help='Request and print the device\'s performance '
+    'counters every SECONDS seconds. They show how close playback is to '
+    'dropping data or missing latches.')
+
 args = parser.parse_args()
 
 all_controllers = ["p1d0", "p1d1", "p2d0", "p2d1"]
@@ -115,6 +123,8 @@ latch_streamer.connect(args.port, status_cb=printer.status_cb,
     num_priming_latches=num_priming_latches,
     apu_freq_basic=apu_freq_basic,
     apu_freq_advanced=apu_freq_advanced,
+    metrics_period=args.metrics,
+    rtscts=args.flow_control,
 )
 
 stream_loop(latch_streamer, read_latches)